@@ -0,0 +1,510 @@
+"""
+A load benchmark of the routes in main.py, for comparing the API's speed
+across commits.
+
+It seeds a SQLite DB with `--fetchers` fetchers (and their schedules and
+domains), points the app at it, and then sends each route's requests straight
+to the ASGI app (no sockets or server) from `--concurrency` concurrent
+clients at a time.  For each route and concurrency level it reports the p50,
+p95 and p99 latency, the throughput and the peak RSS so far, as JSON.
+
+    python benchmark.py --fetchers 100000 --concurrency 1,10,50 --output results.json
+
+Seeding is deterministic for a given --fetchers and --seed, and the seeded DB
+is kept (as benchmark-<fetchers>-<seed>.db) and reused, as seeding a million
+fetchers takes a while.  The benchmark writes to it (creates, updates and
+deletes), so delete it for a clean start.  Runs at the same settings are
+comparable; runs at different ones are not.
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import math
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+import urllib.parse
+
+from fastapi.routing import APIRoute
+from sqlalchemy import create_engine, event, insert
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+import crud
+import database
+import downtime
+import models
+from main import app, get_db
+
+
+DEFAULT_FETCHERS = 1000
+DEFAULT_CONCURRENCY = (1, 10, 50)
+DEFAULT_REQUESTS = 200
+DEFAULT_SEED = 1
+
+# How many fetchers to insert per executemany when seeding.
+SEED_BATCH_SIZE = 10000
+
+# Routes which aren't benchmarked, and why.
+SKIPPED_ROUTES = {
+    "POST /fetcher/{fetcherid}:start/": "starts a run, which logs in to a real mail server",
+    "GET /fetcher:watch/": "an endless event stream, so it has no latency to measure",
+}
+
+
+################################### Seeding ###################################
+PROTOCOLS = ["IMAP4", "IMAPS", "POP3", "POP3S"]
+WORDS = ["journal", "archive", "sales", "support", "legal", "billing", "hr", "europe", "asia", "backup",
+         "primary", "secondary", "intradyn", "exchange", "gmail", "office"]
+
+def get_domain(rng, fetchers):
+    """ @return one of about fetchers / 10 domains, so that each is shared by a few fetchers. """
+    return "example{}.com".format(rng.randrange(max(1, fetchers // 10)))
+
+def make_fetcher_row(rng, fetcherid, fetchers):
+    domains = ",".join(sorted({get_domain(rng, fetchers) for _ in range(rng.randint(1, 3))}))
+    return {
+        "fetcherid": fetcherid,
+        "confname": "fetcher{:07}".format(fetcherid),
+        "server": "mail{}.{}".format(rng.randrange(10), domains.split(",")[0]),
+        "description": " ".join(rng.sample(WORDS, 4)),
+        "userid": "user{}".format(fetcherid),
+        "password": "secret",
+        "protocol": rng.choice(PROTOCOLS),
+        "port": None,
+        "quickdelete": rng.random() < 0.5,
+        "active": rng.random() < 0.9,
+        "timelimit": 15,
+        "mailbox": "INBOX",
+        "domains": domains,
+    }
+
+def make_schedule_row(rng, fetcherid):
+    start = rng.randrange(24 * 4) * 15
+    length = rng.randrange(1, 12 * 4) * 15
+    end = (start + length) % (24 * 60)
+    return {
+        "fetcherid": fetcherid,
+        "downtimedays": ",".join(str(day) for day in sorted(rng.sample(range(7), rng.randint(1, 7)))),
+        "downtimestart": datetime.time(start // 60, start % 60),
+        "downtimeend": datetime.time(end // 60, end % 60),
+    }
+
+def seed_db(path, fetchers, seed=DEFAULT_SEED):
+    """
+    Creates a SQLite DB at path with the app's schema and `fetchers`
+    fetchers, each with 0 - 2 schedules and 1 - 3 domains.
+    """
+    rng = random.Random(seed)
+    engine = create_engine("sqlite:///" + path)
+    database.Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        for start in range(1, fetchers + 1, SEED_BATCH_SIZE):
+            fetcher_rows, schedule_rows, domain_rows = [], [], []
+            for fetcherid in range(start, min(start + SEED_BATCH_SIZE, fetchers + 1)):
+                fetcher_row = make_fetcher_row(rng, fetcherid, fetchers)
+                fetcher_rows.append(fetcher_row)
+                schedule_rows += [make_schedule_row(rng, fetcherid) for _ in range(rng.randint(0, 2))]
+                domain_rows += [{"domain": domain, "fetcherid": fetcherid}
+                                for domain in crud.parse_domains(fetcher_row["domains"])]
+            connection.execute(insert(models.Fetcher.__table__), fetcher_rows)
+            if schedule_rows:
+                connection.execute(insert(models.FetcherSchedule.__table__), schedule_rows)
+            connection.execute(insert(models.FetcherDomain.__table__), domain_rows)
+    engine.dispose()
+
+def use_db(path):
+    """
+    Points the app's routes at the SQLite DB at path, with the same kind of
+    session database.USE_ASYNC gives them.  @return a function which points
+    them back.
+    """
+    if database.USE_ASYNC:
+        engine = create_async_engine("sqlite+aiosqlite:///" + path)
+        event.listen(engine.sync_engine, "connect", database.enable_sqlite_foreign_keys)
+        SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine, class_=AsyncSession)
+
+        async def get_benchmark_db():
+            async with SessionLocal() as db:
+                yield db
+    else:
+        engine = create_engine("sqlite:///" + path, connect_args={"check_same_thread": False})
+        event.listen(engine, "connect", database.enable_sqlite_foreign_keys)
+        SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+        def get_benchmark_db():
+            db = SessionLocal()
+            try:
+                yield db
+            finally:
+                db.close()
+
+    app.dependency_overrides[get_db] = get_benchmark_db
+    # The downtime index is loaded from whichever DB it is refreshed from.
+    downtime.downtime_index.invalidate()
+
+    def restore():
+        del app.dependency_overrides[get_db]
+        downtime.downtime_index.invalidate()
+        if database.USE_ASYNC:
+            asyncio.run(engine.dispose())
+        else:
+            engine.dispose()
+    return restore
+
+
+################################# ASGI client #################################
+async def call_app(method, path, params=None, body=None, content_type="application/json", headers=None):
+    """
+    Sends one request straight to the app and reads the whole response.
+    @param params: a dict of query parameters, or an already encoded query
+        string.
+    @param body: bytes, or anything else to send as JSON.
+    @param headers: a dict of any other request headers, e.g. If-None-Match.
+    @return (status code, response body bytes)
+    """
+    if body is not None and not isinstance(body, bytes):
+        body = json.dumps(body).encode()
+    body = body or b""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": (params if isinstance(params, str)
+                         else urllib.parse.urlencode(params or {}, doseq=True)).encode(),
+        "root_path": "",
+        "headers": [(b"host", b"benchmark"), (b"content-type", content_type.encode()),
+                    (b"content-length", str(len(body)).encode())] +
+                   [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                    for name, value in (headers or {}).items()],
+        "client": ("127.0.0.1", 0),
+        "server": ("benchmark", 80),
+    }
+    request_sent = False
+    response_complete = asyncio.Event()
+    status_code = None
+    chunks = []
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        # Streaming responses listen for the client going away.
+        await response_complete.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status_code
+        if message["type"] == "http.response.start":
+            status_code = message["status"]
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                response_complete.set()
+
+    await app(scope, receive, send)
+    return status_code, b"".join(chunks)
+
+
+################################## Scenarios ##################################
+class Scenario:
+    def __init__(self, route, make_request, on_response=None, max_requests=None, name=None, requires=None):
+        """
+        @param route: "METHOD /path/template/" of the route in main.py.
+        @param make_request: make_request(i) which returns the (method, path,
+            params, body) of the i-th request.
+        @param on_response: on_response(body) called with each successful
+            response, e.g. to keep the IDs of created fetchers.
+        @param max_requests: a cap on the requests per concurrency level, for
+            routes whose requests are much slower than the rest.
+        @param name: the name of the results, when a route has more than one
+            scenario.  Defaults to the route.
+        @param requires: the name of the scenario which creates the rows this
+            one writes, which is run first even when --route leaves it out.
+        """
+        self.name = name or route
+        self.requires = requires
+        self.route = route
+        self.make_request = make_request
+        self.on_response = on_response
+        self.max_requests = max_requests
+
+# The scenarios which create the fetchers and schedules the others update and
+# delete: ten per request, so there are always enough.
+CREATES_FETCHERS = "POST /fetcher:batchCreate/"
+CREATES_SCHEDULES = "POST /fetcherschedule:batchCreate/"
+
+def get_scenarios(fetchers, seed=DEFAULT_SEED):
+    """
+    @return a Scenario for each route, reads first.  Writes only change or
+        delete fetchers and schedules which the benchmark created, so that
+        the seeded data stays about the same from run to run.  (Its schedules
+        belong to seeded fetchers, so that deleting its fetchers doesn't
+        delete schedules it still means to update.)
+    """
+    rng = random.Random(seed)
+    run_id = "{:x}".format(int(time.time() * 1000))
+    created_fetcherids = []
+    created_scheduleids = []
+    names = iter(range(10 ** 9))
+
+    def random_id():
+        return rng.randint(1, fetchers)
+
+    def new_fetcher_json():
+        fetcher_row = make_fetcher_row(rng, 0, fetchers)
+        return {
+            "name": "bench-{}-{}".format(run_id, next(names)),
+            "server": fetcher_row["server"],
+            "description": fetcher_row["description"],
+            "username": fetcher_row["userid"],
+            "password": fetcher_row["password"],
+            "protocol": fetcher_row["protocol"],
+            "port": None,
+            "quick_delete": fetcher_row["quickdelete"],
+            "active": fetcher_row["active"],
+            "time_limit": 15,
+            "mailbox": "INBOX",
+            "domains": fetcher_row["domains"],
+        }
+
+    def new_schedule_json(fetcherid):
+        schedule_row = make_schedule_row(rng, fetcherid)
+        return {
+            "fetcher_id": fetcherid,
+            "downtime_days": schedule_row["downtimedays"],
+            "downtime_start": schedule_row["downtimestart"].isoformat(),
+            "downtime_end": schedule_row["downtimeend"].isoformat(),
+        }
+
+    def pop_created(ids, count=1):
+        popped = ids[-count:]
+        del ids[-count:]
+        return popped
+
+    def keep_id(ids):
+        return lambda body: ids.append(json.loads(body)["id"])
+
+    def keep_ids(ids):
+        return lambda body: ids.extend(json.loads(body)["ids"])
+
+    def search_query():
+        return " ".join(word[:rng.randint(2, len(word))] for word in rng.sample(WORDS, rng.randint(1, 2)))
+
+    def at():
+        return "2024-01-0{}T{:02}:{:02}:00".format(rng.randint(1, 7), rng.randrange(24), rng.randrange(60))
+
+    return [
+        # Reads
+        Scenario("GET /fetcher/", lambda i: ("GET", "/fetcher/", {"limit": 50}, None)),
+        Scenario("GET /fetcher/", lambda i: ("GET", "/fetcher/", {
+            "limit": 50, "active": True, "protocol": rng.choice(PROTOCOLS), "order_by": "name"}, None),
+                 name="GET /fetcher/ filtered"),
+        Scenario("GET /fetcher/", lambda i: ("GET", "/fetcher/", {
+            "limit": 50, "fields": ["name", "server", "protocol", "active"]}, None),
+                 name="GET /fetcher/ fields"),
+        Scenario("GET /fetcher/{fetcherid}/", lambda i: ("GET", "/fetcher/{}/".format(random_id()), None, None)),
+        Scenario("GET /fetcher:search/", lambda i: ("GET", "/fetcher:search/", {"q": search_query()}, None)),
+        Scenario("GET /fetcher:export/", lambda i: ("GET", "/fetcher:export/", None, None), max_requests=3),
+        Scenario("GET /fetcher:inDowntime/", lambda i: ("GET", "/fetcher:inDowntime/", {"at": at()}, None)),
+        Scenario("GET /fetcher:runnable/", lambda i: ("GET", "/fetcher:runnable/", {"at": at()}, None)),
+        Scenario("GET /fetcher:changes/", lambda i: ("GET", "/fetcher:changes/", {"since": 0, "limit": 100}, None)),
+        Scenario("GET /fetcher:byDomain/", lambda i: ("GET", "/fetcher:byDomain/", {
+            "domain": "mail." + get_domain(rng, fetchers), "subdomains": True}, None)),
+        Scenario("POST /fetcher:byDomain/", lambda i: ("POST", "/fetcher:byDomain/", None, {
+            "domains": [get_domain(rng, fetchers) for _ in range(20)]})),
+        Scenario("GET /fetcherschedule/", lambda i: ("GET", "/fetcherschedule/", {"limit": 50}, None)),
+        Scenario("GET /fetcherschedule/{fetcherscheduleid}/", lambda i: (
+            "GET", "/fetcherschedule/{}/".format(rng.randint(1, fetchers)), None, None)),
+        Scenario("GET /metrics", lambda i: ("GET", "/metrics", None, None)),
+        Scenario("POST /fetcher/{fetcherid}:stop/", lambda i: (
+            "POST", "/fetcher/{}:stop/".format(random_id()), None, None)),
+        Scenario("POST /fetcher/{fetcherid}:restart/", lambda i: (
+            "POST", "/fetcher/{}:restart/".format(random_id()), None, None)),
+        Scenario("POST /fetcher:restart/", lambda i: ("POST", "/fetcher:restart/", None, {
+            "ids": [random_id() for _ in range(10)]})),
+
+        # Writes
+        Scenario("POST /fetcher/", lambda i: ("POST", "/fetcher/", None, new_fetcher_json()),
+                 keep_id(created_fetcherids)),
+        Scenario("POST /fetcher:batchCreate/", lambda i: ("POST", "/fetcher:batchCreate/", None, [
+            new_fetcher_json() for _ in range(10)]), keep_ids(created_fetcherids)),
+        Scenario("POST /fetcher:import/", lambda i: ("POST", "/fetcher:import/", None, b"".join(
+            json.dumps(new_fetcher_json()).encode() + b"\n" for _ in range(10)))),
+        Scenario("PUT /fetcher/{fetcherid}/", lambda i: ("PUT", "/fetcher/{}/".format(
+            rng.choice(created_fetcherids)), None, dict(new_fetcher_json(), name="bench-{}-put-{}".format(
+            run_id, next(names)))), requires=CREATES_FETCHERS),
+        Scenario("PATCH /fetcher/{fetcherid}/", lambda i: ("PATCH", "/fetcher/{}/".format(
+            rng.choice(created_fetcherids)), None, {"description": search_query()}), requires=CREATES_FETCHERS),
+        Scenario("POST /fetcher:deactivate/", lambda i: ("POST", "/fetcher:deactivate/", None, {
+            "ids": rng.sample(created_fetcherids, 10)}), requires=CREATES_FETCHERS),
+        Scenario("POST /fetcher:activate/", lambda i: ("POST", "/fetcher:activate/", None, {
+            "ids": rng.sample(created_fetcherids, 10)}), requires=CREATES_FETCHERS),
+        Scenario("POST /fetcherschedule/", lambda i: ("POST", "/fetcherschedule/", None, new_schedule_json(
+            random_id())), keep_id(created_scheduleids)),
+        Scenario("POST /fetcherschedule:batchCreate/", lambda i: ("POST", "/fetcherschedule:batchCreate/", None, [
+            new_schedule_json(random_id()) for _ in range(10)]), keep_ids(created_scheduleids)),
+        Scenario("PUT /fetcherschedule/{fetcherscheduleid}/", lambda i: (
+            "PUT", "/fetcherschedule/{}/".format(rng.choice(created_scheduleids)), None,
+            new_schedule_json(random_id())), requires=CREATES_SCHEDULES),
+
+        # Deletes
+        Scenario("DELETE /fetcherschedule/{fetcherscheduleid}/", lambda i: (
+            "DELETE", "/fetcherschedule/{}/".format(pop_created(created_scheduleids)[0]), None, None),
+                 requires=CREATES_SCHEDULES),
+        Scenario("DELETE /fetcher/{fetcherid}/", lambda i: (
+            "DELETE", "/fetcher/{}/".format(pop_created(created_fetcherids)[0]), None, None),
+                 requires=CREATES_FETCHERS),
+        Scenario("POST /fetcher:delete/", lambda i: ("POST", "/fetcher:delete/", None, {
+            "ids": pop_created(created_fetcherids, 5)}), requires=CREATES_FETCHERS),
+    ]
+
+def get_unbenchmarked_routes(scenarios):
+    """ @return the routes of main.py which have no Scenario and aren't in SKIPPED_ROUTES. """
+    benchmarked = {scenario.route for scenario in scenarios} | set(SKIPPED_ROUTES)
+    routes = []
+    for route in app.routes:
+        if not isinstance(route, APIRoute):
+            continue  # e.g. /docs
+        for method in sorted(route.methods - {"HEAD"}):
+            if "{} {}".format(method, route.path) not in benchmarked:
+                routes.append("{} {}".format(method, route.path))
+    return routes
+
+
+################################## Measuring ##################################
+def percentile(sorted_values, percent):
+    """ @return the nearest-rank percentile of a sorted list. """
+    return sorted_values[max(0, math.ceil(percent / 100 * len(sorted_values)) - 1)]
+
+def get_peak_rss_mb():
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return round(peak_rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+async def run_scenario(scenario, concurrency, requests):
+    """ Sends `requests` of a scenario's requests, `concurrency` at a time.  @return its result dict. """
+    latencies = []
+    errors = 0
+    request_numbers = iter(range(requests))
+
+    async def client():
+        nonlocal errors
+        for i in request_numbers:
+            method, path, params, body = scenario.make_request(i)
+            content_type = "application/x-ndjson" if isinstance(body, bytes) else "application/json"
+            started = time.perf_counter()
+            status_code, response_body = await call_app(method, path, params, body, content_type)
+            latencies.append(time.perf_counter() - started)
+            if status_code >= 400:
+                errors += 1
+            elif scenario.on_response is not None:
+                scenario.on_response(response_body)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "scenario": scenario.name,
+        "route": scenario.route,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 1),
+        "peak_rss_mb": get_peak_rss_mb(),
+    }
+
+
+def run_benchmark(fetchers=DEFAULT_FETCHERS, concurrency=DEFAULT_CONCURRENCY, requests=DEFAULT_REQUESTS,
+                  seed=DEFAULT_SEED, db_path=None, routes=None):
+    """
+    Seeds (or reuses) the DB and runs every scenario at every concurrency.
+    @param routes: only run the scenarios whose name contains one of these.
+    @return the results, as written by --output.
+    """
+    db_path = db_path or "benchmark-{}-{}.db".format(fetchers, seed)
+    if not os.path.exists(db_path):
+        started = time.perf_counter()
+        seed_db(db_path, fetchers, seed)
+        print("Seeded {} fetchers into {} in {:.1f}s".format(fetchers, db_path, time.perf_counter() - started),
+              file=sys.stderr)
+
+    scenarios = get_scenarios(fetchers, seed)
+    unbenchmarked_routes = get_unbenchmarked_routes(scenarios)
+    if routes:
+        names = {scenario.name for scenario in scenarios if any(route in scenario.name for route in routes)}
+        names |= {scenario.requires for scenario in scenarios if scenario.name in names}
+        scenarios = [scenario for scenario in scenarios if scenario.name in names]
+
+    restore = use_db(db_path)
+    results = []
+    try:
+        for level in concurrency:
+            for scenario in scenarios:
+                result = asyncio.run(run_scenario(scenario, level, min(requests, scenario.max_requests or requests)))
+                print("{scenario} x{concurrency}: p50 {p50_ms}ms p99 {p99_ms}ms {throughput_rps}/s "
+                      "{errors} errors".format(**result), file=sys.stderr)
+                results.append(result)
+    finally:
+        restore()
+
+    return {
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "use_async": database.USE_ASYNC,
+        "fetchers": fetchers,
+        "seed": seed,
+        "requests": requests,
+        "results": results,
+        "unbenchmarked_routes": unbenchmarked_routes,
+    }
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--fetchers", type=int, default=DEFAULT_FETCHERS, help="e.g. 1000, 100000 or 1000000")
+    parser.add_argument("--concurrency", default=",".join(map(str, DEFAULT_CONCURRENCY)),
+                        help="Comma separated numbers of concurrent clients.")
+    parser.add_argument("--requests", type=int, default=DEFAULT_REQUESTS,
+                        help="Requests per route and concurrency level.")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    parser.add_argument("--db-path", help="Defaults to benchmark-<fetchers>-<seed>.db")
+    parser.add_argument("--route", action="append", help="Only benchmark the routes containing this.")
+    parser.add_argument("--output", help="Write the JSON results here rather than to stdout.")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.fetchers, [int(level) for level in args.concurrency.split(",")], args.requests,
+                            args.seed, args.db_path, args.route)
+    if results["unbenchmarked_routes"]:
+        print("Not benchmarked: " + ", ".join(results["unbenchmarked_routes"]), file=sys.stderr)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
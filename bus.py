@@ -0,0 +1,201 @@
+"""
+Tells this process of the writes other processes commit, such as the other
+uvicorn workers, so that what it keeps in memory (see cache.py and
+downtime.py) follows them within milliseconds rather than going stale.
+
+The writes are passed on through changes.publish(remote=True), as Change
+tuples keyed by table and row ID, to the listeners which asked for them.
+
+ * SQLite: a thread polls PRAGMA data_version every POLL_SECONDS on a
+   connection of its own.  It changes whenever any other connection, in this
+   process or another, commits.  The thread then reads which rows were
+   written since it last looked from the row versions and tombstones (see
+   models.py), up to MAX_IDS per table.  This process's own writes are
+   heard again this way, which the listeners shrug off.
+ * Postgres: a thread LISTENs on models.CHANGE_CHANNEL, which triggers
+   notify of every committed write, and skips the notifications of this
+   process's own writes (see database.WORKER_ID).
+
+Anything which may have been missed, such as writes while the connection
+was down, or more than MAX_IDS rows, is passed on as a write of every row
+of the table (ids None).
+
+Off unless USE_INVALIDATION_BUS is set: one worker hears all of its own
+writes already.
+"""
+
+import abc
+import json
+import logging
+import select
+import threading
+
+from sqlalchemy import select as sql_select
+from starlette.concurrency import run_in_threadpool
+
+import changes
+import database
+import models
+
+
+logger = logging.getLogger(__name__)
+
+# Turn on when running more than one worker.
+USE_INVALIDATION_BUS = False
+# How often SQLite is asked whether another connection has committed.
+POLL_SECONDS = 0.01
+# The most row IDs passed on per table per poll.  More is passed on as a
+# write of every row.
+MAX_IDS = 1000
+# How long to wait for a notification before checking whether to stop.
+LISTEN_TIMEOUT_SECONDS = 1.0
+# How long to wait before reconnecting after an error.
+RECONNECT_SECONDS = 1.0
+
+VERSIONED_MODELS = [models.Fetcher, models.FetcherSchedule]
+
+_bus = None
+
+
+def get_everything_changed():
+    """ @return Changes which mark every row of the versioned tables as written. """
+    return [changes.Change(model.__tablename__, op, None)
+            for model in VERSIONED_MODELS for op in ["update", "delete"]]
+
+def get_ids_change(table, op, ids):
+    return changes.Change(table, op, None if ids is None or len(ids) > MAX_IDS else frozenset(ids))
+
+
+class InvalidationBus(abc.ABC):
+    """
+    Runs a thread which publishes other processes' writes until stop() is
+    called.  Subclasses listen to their DB in _listen.
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        # Set once it is listening: writes committed after that are heard.
+        self.ready = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run_forever, name=type(self).__name__, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+
+    def _run_forever(self):
+        connected_before = False
+        while not self._stopping.is_set():
+            try:
+                # Anything written while disconnected was missed.
+                self._listen(connected_before)
+            except Exception:
+                logger.exception("Lost track of other processes' writes, reconnecting")
+            connected_before = True
+            self._stopping.wait(RECONNECT_SECONDS)
+
+    @abc.abstractmethod
+    def _listen(self, reconnected):
+        """
+        Connects, sets ready, and publishes the writes heard until stopping or
+        an error.
+        @param reconnected: whether it has connected before, and so may have
+            missed writes, which it then publishes as get_everything_changed().
+        """
+
+
+class SQLitePoller(InvalidationBus):
+    def _listen(self, reconnected):
+        with self.engine.connect() as connection:
+            data_version = connection.exec_driver_sql("PRAGMA data_version").scalar()
+            last_version = connection.execute(sql_select(models.sync_state.c.version)).scalar()
+            if reconnected:
+                changes.publish(get_everything_changed(), remote=True)
+            self.ready.set()
+            while not self._stopping.wait(POLL_SECONDS):
+                new_data_version = connection.exec_driver_sql("PRAGMA data_version").scalar()
+                if new_data_version != data_version:
+                    data_version = new_data_version
+                    last_version = self.publish_changes_since(connection, last_version)
+
+    def publish_changes_since(self, connection, last_version):
+        """
+        Publishes the rows written, and deleted, after version last_version.
+        @return the version they are as of.
+        """
+        version, purged_version = connection.execute(sql_select(
+            models.sync_state.c.version, models.sync_state.c.purgedversion)).one()
+        if version == last_version:
+            return version
+
+        committed_changes = []
+        for model in VERSIONED_MODELS:
+            id_column = model.__mapper__.primary_key[0]
+            ids = connection.execute(sql_select(id_column).where(model.rowversion > last_version)
+                                     .limit(MAX_IDS + 1)).scalars().all()
+            if ids:
+                committed_changes.append(get_ids_change(model.__tablename__, "update", ids))
+            if purged_version > last_version:
+                # The tombstones of some deletes may already be gone.
+                committed_changes.append(changes.Change(model.__tablename__, "delete", None))
+                continue
+            deleted_ids = connection.execute(sql_select(models.Tombstone.id).where(
+                models.Tombstone.tablename == model.__tablename__,
+                models.Tombstone.rowversion > last_version).limit(MAX_IDS + 1)).scalars().all()
+            if deleted_ids:
+                committed_changes.append(get_ids_change(model.__tablename__, "delete", deleted_ids))
+        if committed_changes:
+            changes.publish(committed_changes, remote=True)
+        return version
+
+
+class PostgresListener(InvalidationBus):
+    def _listen(self, reconnected):
+        connection = self.engine.raw_connection()
+        try:
+            dbapi_connection = connection.connection
+            dbapi_connection.autocommit = True
+            with dbapi_connection.cursor() as cursor:
+                cursor.execute("LISTEN " + models.CHANGE_CHANNEL)
+            if reconnected:
+                changes.publish(get_everything_changed(), remote=True)
+            self.ready.set()
+            while not self._stopping.is_set():
+                if select.select([dbapi_connection], [], [], LISTEN_TIMEOUT_SECONDS) == ([], [], []):
+                    continue
+                dbapi_connection.poll()
+                notifies = list(dbapi_connection.notifies)
+                del dbapi_connection.notifies[:]
+                committed_changes = self.parse_notifies(notifies)
+                if committed_changes:
+                    changes.publish(committed_changes, remote=True)
+        finally:
+            # Not fit for the pool after LISTEN and autocommit.
+            connection.invalidate()
+
+    def parse_notifies(self, notifies):
+        """ @return Changes for the notifications of other processes' writes. """
+        committed_changes = []
+        for notify in notifies:
+            payload = json.loads(notify.payload)
+            if payload["origin"] != database.WORKER_ID:
+                committed_changes.append(get_ids_change(payload["table"], payload["op"], payload["ids"]))
+        return committed_changes
+
+
+async def start():
+    global _bus
+    if not USE_INVALIDATION_BUS or _bus is not None:
+        return
+    _bus = (SQLitePoller if database.USE_SQLITE else PostgresListener)(database.engine)
+    _bus.start()
+
+async def stop():
+    global _bus
+    if _bus is None:
+        return
+    bus, _bus = _bus, None
+    await run_in_threadpool(bus.stop)
@@ -0,0 +1,138 @@
+"""
+In-memory read-through caches of single fetchers and schedules by ID, in
+front of crud.retrieve_fetcher and crud.retrieve_fetcherschedule, which the
+detail routes read the same hot rows through.  The start, stop, restart and
+delete routes read the DB instead, so that they never act on a row another
+process has already deleted.
+
+Each cache holds up to CACHE_SIZE IDs, dropping the least recently used, and
+each entry expires CACHE_TTL_SECONDS after it was read from the DB.  An ID
+has one entry, in one shape (a fetcher is the serialize_fetcher dict with
+its schedules), which crud cuts down to whatever shape was asked for (as a
+schema or a dict, with or without schedules, and which ?fields=), so every
+reader of a row shares its entry.
+
+Entries follow committed writes through changes.py, just as the downtime
+index does: the written IDs are dropped, or the whole cache when a write
+doesn't say which rows it touched.  Bulk writes such as :activate,
+:deactivate and :delete name their rows, so they drop just those.  Fetchers
+are cached with their schedules, and a schedule write can add to or move
+schedules between any fetchers, so every schedule write drops every fetcher
+entry.
+
+With bus.py running, the writes of other workers (and ad hoc SQL) drop
+entries too, within milliseconds.  The expiry bounds how stale an entry can
+get from any writes this process still doesn't hear of.
+
+Cached values are shared between requests, so they must not be changed.
+"""
+
+import collections
+import threading
+import time
+
+import changes
+import metrics
+import models
+
+
+# Whether crud reads through the caches at all.
+USE_CACHE = True
+# The most IDs each cache keeps.
+CACHE_SIZE = 10000
+# How long an entry is served for after it was read from the DB.
+CACHE_TTL_SECONDS = 10
+
+
+class CacheEntry:
+    def __init__(self, value, expires):
+        self.value = value
+        self.expires = expires
+
+
+class RowCache:
+    def __init__(self, name, table, related_tables=(), size=None, ttl_seconds=None):
+        """
+        @param table: the name of the table whose rows are cached by primary
+            key.
+        @param related_tables: the other tables the values are read from,
+            whose writes drop every entry.
+        @param size, ttl_seconds: default to CACHE_SIZE and CACHE_TTL_SECONDS.
+        """
+        self.name = name
+        self.table = table
+        self.related_tables = frozenset(related_tables)
+        self._size = size
+        self._ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        # id -> CacheEntry, least recently used first.
+        self._entries = collections.OrderedDict()
+        # Bumped by every write which drops entries, so that a value read
+        # from the DB before the write isn't cached after it.
+        self._generation = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def is_used(self, db):
+        """ @return whether reads with db go through the cache: not while db has uncommitted writes. """
+        return USE_CACHE and not changes.has_pending_changes(db)
+
+    def get_or_load(self, db, id, load):
+        """
+        @param db: the sync Session load reads with.  Its own uncommitted
+            writes aren't cached, as they may yet be rolled back.
+        @param load: load() reads the value from the DB.  Its exceptions,
+            e.g. NoResultFound, aren't cached.
+        @return the cached value, else load()'s.
+        """
+        if not self.is_used(db):
+            return load()
+        labels = {"cache": self.name}
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(id)
+            if entry is not None and entry.expires > now:
+                self._entries.move_to_end(id)
+                metrics.cache_hits_total.inc(labels)
+                return entry.value
+            generation = self._generation
+        metrics.cache_misses_total.inc(labels)
+
+        value = load()
+        ttl_seconds = CACHE_TTL_SECONDS if self._ttl_seconds is None else self._ttl_seconds
+        with self._lock:
+            if self._generation == generation:
+                self._entries[id] = CacheEntry(value, now + ttl_seconds)
+                self._entries.move_to_end(id)
+                size = CACHE_SIZE if self._size is None else self._size
+                while len(self._entries) > size:
+                    self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def on_commit(self, committed_changes):
+        """ A changes.py listener which drops the entries of the written rows. """
+        with self._lock:
+            for change in committed_changes:
+                if change.table == self.table:
+                    self._generation += 1
+                    if change.ids is None:
+                        self._entries.clear()
+                    else:
+                        for id in change.ids:
+                            self._entries.pop(id, None)
+                elif change.table in self.related_tables:
+                    self._generation += 1
+                    self._entries.clear()
+
+
+fetcher_cache = RowCache("fetchers", models.Fetcher.__tablename__,
+                         related_tables=[models.FetcherSchedule.__tablename__])
+schedule_cache = RowCache("schedules", models.FetcherSchedule.__tablename__)
+changes.add_listener(fetcher_cache.on_commit, remote=True)
+changes.add_listener(schedule_cache.on_commit, remote=True)
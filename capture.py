@@ -0,0 +1,187 @@
+"""
+Records the API calls the app serves, one JSON object per line, so that real
+traffic can be replayed against another build with replay.py.
+
+Capturing is off unless CAPTURE_PATH is set.  Each line holds:
+
+    {"time": 1700000000.123,      // when the request arrived, in epoch seconds
+     "method": "POST", "path": "/fetcher/", "query": "limit=50",
+     "content_type": "application/json",
+     "headers": {"if-none-match": "\"...\""},  // the request's other headers
+     "body": "{...}",             // null if empty, or base64 if it isn't UTF-8
+     "body_encoding": "base64",   // only when it is
+     "truncated": true,           // only when the body was over MAX_BODY_BYTES
+     "status": 201, "duration_ms": 8.1}
+
+Passwords in JSON bodies (including each line of an import) are replaced
+with REDACTED_PASSWORD, and the SKIPPED_HEADERS (credentials among them) are
+not kept, so a capture holds no credentials.  A replayed fetcher gets that
+password.
+
+Lines are written by a background thread, so that a request never waits on
+the file.
+"""
+
+import base64
+import json
+import logging
+import queue
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# The file to append captured requests to, or None not to capture.
+CAPTURE_PATH = None
+# Bodies longer than this aren't kept, and their requests aren't replayed.
+MAX_BODY_BYTES = 1024 * 1024
+REDACTED_PASSWORD = "REDACTED"
+# Request headers which aren't kept: credentials, and those which replaying
+# sets itself.
+SKIPPED_HEADERS = {"authorization", "proxy-authorization", "cookie", "host", "content-length", "content-type"}
+
+# (path, line) pairs for _write_forever to append.
+_queue = queue.Queue()
+_writer = None
+_lock = threading.Lock()
+# The open capture file, and the path it was opened for.
+_file = None
+_file_path = None
+
+
+def redact(value):
+    """ @return a JSON value with every "password" replaced by REDACTED_PASSWORD. """
+    if isinstance(value, dict):
+        return {key: REDACTED_PASSWORD if key == "password" and item is not None else redact(item)
+                for key, item in value.items()}
+    if isinstance(value, list):
+        return [redact(item) for item in value]
+    return value
+
+def redact_body(body):
+    """ @return the body, a JSON document or JSON lines, with its passwords redacted. """
+    if b"password" not in body:
+        return body
+    lines = []
+    for line in body.split(b"\n"):
+        try:
+            line = json.dumps(redact(json.loads(line))).encode() if line.strip() else line
+        except ValueError:
+            pass  # The app rejects it anyway, and it isn't JSON to look in.
+        lines.append(line)
+    return b"\n".join(lines)
+
+def get_kept_headers(scope):
+    """ @return the request's headers, but the SKIPPED_HEADERS, by lowercase name. """
+    headers = {}
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").lower()
+        if name not in SKIPPED_HEADERS:
+            value = value.decode("latin-1")
+            headers[name] = headers[name] + ", " + value if name in headers else value
+    return headers
+
+def make_entry(scope, started, body, truncated, status_code, seconds):
+    """ @return the capture line of a request, as a dict. """
+    entry = {
+        "time": round(started, 6),
+        "method": scope["method"],
+        "path": scope["path"],
+        "query": scope.get("query_string", b"").decode("latin-1"),
+        "content_type": dict(scope["headers"]).get(b"content-type", b"").decode("latin-1") or None,
+        "headers": get_kept_headers(scope),
+        "body": None,
+    }
+    if truncated:
+        entry["truncated"] = True
+    elif body:
+        body = redact_body(body)
+        try:
+            entry["body"] = body.decode()
+        except UnicodeDecodeError:
+            entry["body"] = base64.b64encode(body).decode()
+            entry["body_encoding"] = "base64"
+    entry["status"] = status_code
+    entry["duration_ms"] = round(seconds * 1000, 3)
+    return entry
+
+def write_entry(entry):
+    """ Queues the entry to be appended to CAPTURE_PATH, starting the writer thread if need be. """
+    global _writer
+    _queue.put((CAPTURE_PATH, json.dumps(entry) + "\n"))
+    with _lock:
+        if _writer is None:
+            _writer = threading.Thread(target=_write_forever, name="capture-writer", daemon=True)
+            _writer.start()
+
+def _write_forever():
+    global _file, _file_path
+    while True:
+        path, line = _queue.get()
+        try:
+            with _lock:
+                if _file_path != path:
+                    _close_file()
+                    _file = open(path, "a")
+                    _file_path = path
+                _file.write(line)
+                if _queue.empty():
+                    _file.flush()
+        except OSError:
+            logger.exception("Could not write a captured request to %s.", path)
+        finally:
+            _queue.task_done()
+
+def close_capture():
+    """
+    Waits for the queued lines to be written, then closes the capture file,
+    if open, e.g. to move it away.  Capturing reopens it.
+    """
+    _queue.join()
+    with _lock:
+        _close_file()
+
+def _close_file():
+    global _file, _file_path
+    if _file is not None:
+        _file.close()
+    _file = _file_path = None
+
+
+class CaptureMiddleware:
+    """ An ASGI middleware which appends each request to CAPTURE_PATH, once its response is sent. """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or CAPTURE_PATH is None:
+            await self.app(scope, receive, send)
+            return
+
+        started = time.time()
+        started_counter = time.perf_counter()
+        chunks = []
+        size = 0
+        status_code = 500
+
+        async def receive_and_keep():
+            nonlocal size
+            message = await receive()
+            if message["type"] == "http.request" and size <= MAX_BODY_BYTES:
+                chunk = message.get("body", b"")
+                size += len(chunk)
+                chunks.append(chunk)
+            return message
+
+        async def send_and_keep(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive_and_keep, send_and_keep)
+        finally:
+            write_entry(make_entry(scope, started, b"".join(chunks), size > MAX_BODY_BYTES, status_code,
+                                   time.perf_counter() - started_counter))
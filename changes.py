@@ -0,0 +1,142 @@
+"""
+Keeps track of the writes made to each table as they are committed.
+
+Every committed transaction which wrote to a table bumps that table's version
+counter, and is then passed to the listeners registered with add_listener as
+a list of Change tuples.
+
+This is driven by Session events rather than by the routes, so every write
+path is covered: ORM adds, changes and deletes are picked up when they are
+flushed (with the primary keys of the rows), and bulk query.update() /
+query.delete() / insert statements when they are executed (without them,
+as the rows they touch aren't known, unless the statement names them with
+the CHANGED_IDS execution option).  Nothing is bumped or passed on for a
+transaction which is rolled back.
+
+Versions are per process and start over when it restarts, so they are
+paired with a random EPOCH whenever they are handed out (e.g. in ETags).
+
+Writes committed by other processes (other workers, or ad hoc SQL) are
+published too when bus.py is running, to the listeners which ask for them.
+"""
+
+import collections
+import threading
+import uuid
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+
+EPOCH = uuid.uuid4().hex[:8]
+
+# op is "insert", "update" or "delete", or a more specific kind of update
+# named with CHANGE_OP such as "activate".  ids is a frozenset of the primary
+# keys of the rows which were written, or None if they are not known.
+Change = collections.namedtuple("Change", ["table", "op", "ids"])
+
+# e.g. update(...).execution_options(changed_ids=[fetcherid]) says which rows
+# a bulk statement writes.
+CHANGED_IDS = "changed_ids"
+# e.g. update(...).execution_options(change_op="activate") says what a bulk
+# statement's write was more specifically than its statement type does.
+CHANGE_OP = "change_op"
+
+_versions = {}
+_versions_lock = threading.Lock()
+# (listener, whether it hears other processes' writes)
+_listeners = []
+
+
+def get_versions(*tables):
+    """ @return a tuple with the current version of each of the tables. """
+    return tuple(_versions.get(table, 0) for table in tables)
+
+def bump_versions(tables):
+    with _versions_lock:
+        for table in tables:
+            _versions[table] = _versions.get(table, 0) + 1
+
+def add_listener(listener, remote=False):
+    """
+    Registers listener(changes) to be called with the list of Change tuples
+    of every transaction once it has committed.  It is called on whatever
+    thread committed, so it must be quick and thread safe.
+
+    @param remote: whether to also call it with the writes other processes
+        committed, as bus.py hears of them.  Those may repeat this process's
+        own writes, and their op is only "insert", "update" or "delete", so
+        this suits listeners which just mark rows as stale.
+    """
+    _listeners.append((listener, remote))
+
+def remove_listener(listener):
+    _listeners[:] = [(other, remote) for other, remote in _listeners if other != listener]
+
+def publish(committed_changes, remote=False):
+    """
+    Bumps the versions of the written tables and calls the listeners with a
+    list of Change tuples.
+    @param remote: whether another process committed them.
+    """
+    bump_versions({change.table for change in committed_changes})
+    for listener, hears_remote in list(_listeners):
+        if hears_remote or not remote:
+            listener(committed_changes)
+
+
+def has_pending_changes(session):
+    """ @return whether session has written anything it hasn't committed yet. """
+    return bool(session.info.get("pending_changes"))
+
+def _get_pending_changes(session):
+    """ @return a dict of (table, op) -> set of ids, or None if not known. """
+    return session.info.setdefault("pending_changes", {})
+
+def _add_pending_change(session, table, op, ids):
+    pending_changes = _get_pending_changes(session)
+    key = (table, op)
+    if ids is None or pending_changes.get(key, set()) is None:
+        pending_changes[key] = None
+    else:
+        pending_changes.setdefault(key, set()).update(ids)
+
+def record_change(session, table, op, ids):
+    """
+    Records a write which the Session events can't see the rows of, such as
+    the rows an UPDATE ... RETURNING returned, to be published with the rest
+    of session's transaction.
+    """
+    _add_pending_change(session, table, op, ids)
+
+@event.listens_for(Session, "after_flush")
+def _record_flushed_rows(session, flush_context):
+    # new, dirty and deleted still hold their pre-flush contents here, and
+    # new objects already have their primary keys.
+    for op, objs in [("insert", session.new), ("update", session.dirty), ("delete", session.deleted)]:
+        for obj in objs:
+            if op == "update" and not session.is_modified(obj):
+                continue
+            primary_key = inspect(obj).mapper.primary_key_from_instance(obj)[0]
+            _add_pending_change(session, obj.__table__.name, op,
+                                None if primary_key is None else [primary_key])
+
+@event.listens_for(Session, "do_orm_execute")
+def _record_bulk_statement(orm_execute_state):
+    for op in ["insert", "update", "delete"]:
+        if getattr(orm_execute_state, "is_" + op):
+            _add_pending_change(orm_execute_state.session, orm_execute_state.statement.table.name,
+                                orm_execute_state.execution_options.get(CHANGE_OP, op),
+                                orm_execute_state.execution_options.get(CHANGED_IDS))
+
+@event.listens_for(Session, "after_commit")
+def _publish_committed_changes(session):
+    pending_changes = session.info.pop("pending_changes", None)
+    if not pending_changes:
+        return
+    publish([Change(table, op, None if ids is None else frozenset(ids))
+             for (table, op), ids in pending_changes.items()])
+
+@event.listens_for(Session, "after_rollback")
+def _forget_rolled_back_changes(session):
+    session.info.pop("pending_changes", None)
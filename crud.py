@@ -0,0 +1,947 @@
+"""
+The DB work behind each route in main.py.
+
+Every function here is plain synchronous SQLAlchemy code which takes the
+session as its first argument, so main.py can run it either on the
+threadpool with a regular Session or through AsyncSession.run_sync (see
+database.run_db).  For the same reason, functions serialize their results
+to schemas before returning: nothing may lazy load from the DB once the
+function has returned.
+
+Lookups of a single row raise sqlalchemy.exc.NoResultFound when the row does
+not exist, and main.py turns that into a 404.
+"""
+
+import functools
+import re
+from contextlib import contextmanager
+
+import sqlalchemy
+from sqlalchemy import bindparam, delete, func, insert, select, update
+from sqlalchemy.exc import NoResultFound
+from sqlalchemy.orm import load_only, selectinload, noload
+
+import changes
+import schemas
+import models
+from cache import fetcher_cache, schedule_cache
+from downtime import downtime_index
+from fastapiutils import add_keyset_pagination, get_page, get_prefix_filter
+from pydanticutils import make_serializer
+
+
+################################## Fetchers ###################################
+def get_fetcher_load_options(with_schedules, fields=None, extra_columns=()):
+    """
+    @return ORM loader options for models.Fetcher.schedules.  Schedules for
+        every fetcher in a query are loaded with one extra SELECT ... IN
+        rather than one lazy load per fetcher.
+
+    @param fields: FetcherRead field names.  When given, only their columns
+        (and the primary key and extra_columns) are selected.
+    """
+    options = [selectinload(models.Fetcher.schedules) if with_schedules else noload(models.Fetcher.schedules)]
+    if fields is not None:
+        options.append(load_only(models.Fetcher.fetcherid, *extra_columns,
+                                 *[getattr(models.Fetcher, name) for name in fields if name != "schedules"]))
+    return options
+
+# For main.py's fast JSON path: see pydanticutils.make_serializer.
+serialize_schedule = make_serializer(schemas.FetcherScheduleRead)
+serialize_fetcher = make_serializer(schemas.FetcherRead, {"schedules": serialize_schedule})
+
+@functools.lru_cache(maxsize=128)
+def get_fetcher_serializer(fields=None):
+    """ @param fields: a frozenset of the FetcherRead field names to serialize, or None for all of them. """
+    if fields is None:
+        return serialize_fetcher
+    return make_serializer(schemas.FetcherRead, {"schedules": serialize_schedule}, fields)
+
+def get_fetcher_schema(fetcher, with_schedules=True, as_dict=False, fields=None):
+    """
+    @param as_dict: return the JSON-ready dict from serialize_fetcher rather
+        than a schemas.FetcherRead.
+    @param fields: a frozenset of FetcherRead field names.  When given, the
+        fetcher is returned as a dict of just those fields.
+    """
+    if fields is not None or as_dict:
+        fetcher_schema = get_fetcher_serializer(fields)(fetcher)
+        if not with_schedules and "schedules" in fetcher_schema:
+            fetcher_schema["schedules"] = None
+        return fetcher_schema
+    fetcher_schema = schemas.FetcherRead.from_orm(fetcher)
+    if not with_schedules:
+        fetcher_schema.schedules = None
+    return fetcher_schema
+
+def selects_schedules(with_schedules, fields):
+    return with_schedules and (fields is None or "schedules" in fields)
+
+@functools.lru_cache(maxsize=128)
+def get_fetcher_aliases(fields=None):
+    """ @return the aliases of the FetcherRead fields in fields (all of them if None), in field order. """
+    return [field.alias for name, field in schemas.FetcherRead.__fields__.items() if fields is None or name in fields]
+
+def project_fetcher_dict(fetcher_dict, with_schedules=True, as_dict=False, fields=None):
+    """
+    @param fetcher_dict: a fetcher with its schedules, from serialize_fetcher.
+    @return the fetcher as get_fetcher_schema returns it, from fetcher_dict
+        rather than from the ORM object.  fetcher_dict isn't changed.
+    """
+    if fields is not None or as_dict:
+        fetcher_schema = {alias: fetcher_dict[alias] for alias in get_fetcher_aliases(fields)}
+        if not with_schedules and "schedules" in fetcher_schema:
+            fetcher_schema["schedules"] = None
+        return fetcher_schema
+    fetcher_schema = schemas.FetcherRead.parse_obj(fetcher_dict)
+    if not with_schedules:
+        fetcher_schema.schedules = None
+    return fetcher_schema
+
+def get_schedule_schema(schedule, as_dict=False):
+    return serialize_schedule(schedule) if as_dict else schemas.FetcherScheduleRead.from_orm(schedule)
+
+def project_schedule_dict(schedule_dict, as_dict=False):
+    """ @return a schedule from serialize_schedule as get_schedule_schema returns it. """
+    return schedule_dict if as_dict else schemas.FetcherScheduleRead.parse_obj(schedule_dict)
+
+def create_fetcher(db, fetcher):
+    new_fetcher = models.Fetcher(
+        confname = fetcher.confname,
+        server = fetcher.server,
+        description = fetcher.description,
+        userid = fetcher.userid,
+        password = fetcher.password,
+        protocol = fetcher.protocol,
+        port = fetcher.port,
+        quickdelete = fetcher.quickdelete,
+        active = fetcher.active,
+        timelimit = fetcher.timelimit,
+        mailbox = fetcher.mailbox,
+        domains = fetcher.domains,
+    )
+    db.add(new_fetcher)
+    db.flush()
+    set_fetcher_domains(db, {new_fetcher.fetcherid: new_fetcher.domains})
+    db.commit()
+    db.refresh(new_fetcher)
+    return schemas.FetcherRead.from_orm(new_fetcher)
+
+def update_row(db, model, primary_key_value, values):
+    """
+    Sets the columns in `values` (a dict of column name -> value) of one row
+    of model's table, and @return the row as it is after the update.
+
+    Where the DB supports it this is one UPDATE ... RETURNING.  SQLAlchemy 1.4
+    can't render RETURNING for SQLite, so there it is an UPDATE and then a
+    SELECT by primary key.  Doesn't commit.
+
+    @raise NoResultFound if there is no such row.
+    """
+    table = model.__table__
+    primary_key = table.primary_key.columns[0]
+    select_row = select(*table.columns).where(primary_key == primary_key_value)
+    if not values:
+        return db.execute(select_row).one()
+
+    statement = update(model).where(primary_key == primary_key_value).values(values).execution_options(
+        synchronize_session=False, **{changes.CHANGED_IDS: [primary_key_value]})
+    if db.get_bind().dialect.full_returning:
+        return db.execute(statement.returning(*table.columns)).one()
+    if db.execute(statement).rowcount == 0:
+        raise NoResultFound("No row was found for one()")
+    return db.execute(select_row).one()
+
+def get_updated_fetcher_schema(db, fetcher_row, with_schedules=True):
+    """ @return a FetcherRead of a row from update_row, with its schedules loaded if asked for. """
+    fetcher_schema = schemas.FetcherRead.from_orm(fetcher_row)
+    if with_schedules:
+        fetcher_schema.schedules = [schemas.FetcherScheduleRead.from_orm(schedule) for schedule in
+            db.execute(select(models.FetcherSchedule).where(
+                models.FetcherSchedule.fetcherid == fetcher_row.fetcherid).order_by(
+                models.FetcherSchedule.fetcherscheduleid)).scalars()]
+    else:
+        fetcher_schema.schedules = None
+    return fetcher_schema
+
+def update_fetcher(db, fetcherid, fetcher, with_schedules=True):
+    """
+    Replaces every field of a fetcher.
+    @raise NoResultFound if there is no such fetcher.
+    @raise sqlalchemy.exc.IntegrityError, rolled back, if the fields break
+        a constraint, e.g. the name is already used.
+    """
+    return write_fetcher_values(db, fetcherid, fetcher.dict(), with_schedules)
+
+def patch_fetcher(db, fetcherid, fetcher, with_schedules=True):
+    """
+    Sets the fields of a fetcher which are given and not null.
+    @raise NoResultFound, sqlalchemy.exc.IntegrityError: see update_fetcher.
+    """
+    return write_fetcher_values(db, fetcherid, fetcher.dict(exclude_none=True), with_schedules)
+
+def write_fetcher_values(db, fetcherid, values, with_schedules):
+    try:
+        fetcher_row = update_row(db, models.Fetcher, fetcherid, values)
+        if "domains" in values:
+            set_fetcher_domains(db, {fetcherid: values["domains"]})
+        db.commit()
+    except sqlalchemy.exc.IntegrityError:
+        db.rollback()
+        raise
+    return get_updated_fetcher_schema(db, fetcher_row, with_schedules)
+
+def get_fetcher_filters(active=None, protocol=None, server=None, server_prefix=None, name_prefix=None):
+    """ @return a list of conditions for the fetcher list.  Filters which are None are left out. """
+    filters = []
+    if active is not None:
+        filters.append(models.Fetcher.active == active)
+    if protocol is not None:
+        filters.append(models.Fetcher.protocol == protocol)
+    if server is not None:
+        filters.append(models.Fetcher.server == server)
+    if server_prefix is not None:
+        filters.append(get_prefix_filter(models.Fetcher.server, server_prefix))
+    if name_prefix is not None:
+        filters.append(get_prefix_filter(models.Fetcher.confname, name_prefix))
+    return filters
+
+def retrieve_fetchers(db, order_by, field_to_column_map, limit=None, cursor=None, with_schedules=True,
+                      filters=(), as_dicts=False, fields=None):
+    """
+    @param filters: conditions from get_fetcher_filters.
+    @param as_dicts, fields: see get_fetcher_schema.  Only the columns of
+        `fields` (and those the list is sorted by) are selected, and schedules
+        are only loaded if they are one of them.
+    @return (fetcher_schemas, next_cursor)
+    @raise ValueError if the cursor is not valid for this sort order.
+    """
+    with_schedules = selects_schedules(with_schedules, fields)
+    fetcher_query = db.query(models.Fetcher).filter(*filters)
+    fetcher_query, order_by_dicts = add_keyset_pagination(fetcher_query, order_by,
+        field_to_column_map, models.Fetcher.fetcherid, cursor, limit)
+    # The next cursor is read from the sort columns of the last fetcher.
+    fetcher_query = fetcher_query.options(*get_fetcher_load_options(with_schedules, fields,
+        [order_by_dict["column"] for order_by_dict in order_by_dicts]))
+
+    fetchers, next_cursor = get_page(fetcher_query.all(), order_by_dicts, limit)
+    fetcher_schemas = [get_fetcher_schema(fetcher, with_schedules, as_dicts, fields) for fetcher in fetchers]
+    return fetcher_schemas, next_cursor
+
+def retrieve_fetcher(db, fetcherid, with_schedules=True, as_dict=False, fields=None, cached=True):
+    """
+    @param as_dict, fields: see retrieve_fetchers.
+    @param cached: whether to read through cache.fetcher_cache, which holds
+        each whole fetcher in one shape, whichever is asked for.  Writes, and
+        anything else which acts on the fetcher, mustn't: an entry can be
+        CACHE_TTL_SECONDS behind other processes' writes.  Uncached, only the
+        fields asked for are read.
+    """
+    with_schedules = selects_schedules(with_schedules, fields)
+    if not cached or not fetcher_cache.is_used(db):
+        fetcher = db.query(models.Fetcher).options(*get_fetcher_load_options(with_schedules, fields)).filter(
+            models.Fetcher.fetcherid == fetcherid).one()
+        return get_fetcher_schema(fetcher, with_schedules, as_dict, fields)
+
+    def load():
+        fetcher = db.query(models.Fetcher).options(*get_fetcher_load_options(True)).filter(
+            models.Fetcher.fetcherid == fetcherid).one()
+        return serialize_fetcher(fetcher)
+    return project_fetcher_dict(fetcher_cache.get_or_load(db, fetcherid, load), with_schedules, as_dict, fields)
+
+def get_search_terms(q):
+    """
+    @return the words in a search string.  Anything but letters and digits
+        separates words, just as the search index splits the text it indexes.
+    """
+    return re.findall(r"[^\W_]+", q)
+
+def search_fetchers(db, q, limit, with_schedules=True, as_dicts=False):
+    """
+    @return the fetchers with every word of q at the start of a word in their
+        confname, description, server or domains, best match first (see
+        models.fetcher_search).
+    """
+    terms = get_search_terms(q)
+    if not terms:
+        return []
+
+    fetcher_query = db.query(models.Fetcher).options(*get_fetcher_load_options(with_schedules))
+    if db.get_bind().dialect.name == "sqlite":
+        # e.g. "mail"* AND "exam"*
+        match = " AND ".join('"{}"*'.format(term) for term in terms)
+        fetcher_query = fetcher_query.join(models.fetcher_search,
+            models.fetcher_search.c.rowid == models.Fetcher.fetcherid).filter(
+            models.fetcher_search.c.fetchersearch.match(match)).order_by(
+            models.fetcher_search.c.rank)
+    else:
+        # e.g. mail:* & exam:*
+        tsquery = func.to_tsquery("simple", " & ".join(term + ":*" for term in terms))
+        fetcher_query = fetcher_query.filter(models.fetcher_searchvector.op("@@")(tsquery)).order_by(
+            func.ts_rank(models.fetcher_searchvector, tsquery).desc())
+
+    fetchers = fetcher_query.order_by(models.Fetcher.fetcherid).limit(limit).all()
+    return [get_fetcher_schema(fetcher, with_schedules, as_dicts) for fetcher in fetchers]
+
+def get_fetcher_export_statement():
+    """ @return a select of every fetcher, with its schedules, in ID order. """
+    return select(models.Fetcher).options(*get_fetcher_load_options(True)).order_by(
+        models.Fetcher.fetcherid)
+
+def get_fetcher_export_lines(fetchers):
+    """ @return the fetchers as newline-delimited FetcherRead JSON. """
+    return "".join(get_fetcher_schema(fetcher).json(by_alias=True) + "\n" for fetcher in fetchers)
+
+def delete_fetcher(db, fetcherid, with_schedules=True):
+    deletable_fetcher = retrieve_fetcher(db, fetcherid, with_schedules, cached=False)
+    delete_fetchers_cascade(db, models.Fetcher.fetcherid == fetcherid)
+    db.commit()
+    return deletable_fetcher
+
+
+def get_fetchers_in_downtime(db, at):
+    """ @return a schemas.BatchFetcherIds of the fetchers in downtime at datetime at. """
+    downtime_index.refresh(db)
+    return schemas.BatchFetcherIds(ids=sorted(downtime_index.get_fetchers_in_downtime(at)))
+
+def get_runnable_fetchers(db, at):
+    """ @return a schemas.BatchFetcherIds of the active fetchers not in downtime at datetime at. """
+    downtime_index.refresh(db)
+    in_downtime = downtime_index.get_fetchers_in_downtime(at)
+    active_fetcherids = db.execute(select(models.Fetcher.fetcherid).where(
+        models.Fetcher.active == True).order_by(models.Fetcher.fetcherid)).scalars()
+    return schemas.BatchFetcherIds(ids=[fetcherid for fetcherid in active_fetcherids
+                                        if fetcherid not in in_downtime])
+
+def retrieve_active_fetchers(db, fetcherids):
+    """
+    @return schemas (without schedules) of the fetchers in fetcherids which
+        are active, in ID order.  IDs which don't exist are ignored.
+    """
+    fetchers = []
+    for chunk in chunks(sorted(set(fetcherids)), MAX_BIND_PARAMS):
+        fetchers += db.query(models.Fetcher).options(*get_fetcher_load_options(False)).filter(
+            models.Fetcher.fetcherid.in_(chunk), models.Fetcher.active == True).order_by(
+            models.Fetcher.fetcherid).all()
+    return [get_fetcher_schema(fetcher, with_schedules=False) for fetcher in fetchers]
+
+
+
+################################ Fetcher Domains ##############################
+def normalize_domain(domain):
+    """ @return domain lower cased, without surrounding space or a trailing dot. """
+    return domain.strip().lower().rstrip(".")
+
+def parse_domains(domains):
+    """ @return the set of normalized domains in a fetcher's comma separated `domains`. """
+    return {normalize_domain(domain) for domain in (domains or "").split(",") if normalize_domain(domain)}
+
+def get_parent_domains(domain):
+    """ @return domain and then each of its parent domains, e.g. a.b.com, b.com, com. """
+    labels = domain.split(".")
+    return [".".join(labels[i:]) for i in range(len(labels))]
+
+def delete_fetcher_domains(db, fetcherids):
+    db.execute(delete(models.FetcherDomain).where(models.FetcherDomain.fetcherid.in_(
+        select_ids(db, fetcherids))).execution_options(synchronize_session=False))
+
+def set_fetcher_domains(db, domains_by_fetcherid):
+    """
+    Replaces the fetcherdomains rows of each fetcher with the domains in its
+    `domains` string.  Doesn't commit: call it in the transaction which
+    writes `domains`.
+
+    @param domains_by_fetcherid: a dict of fetcherid -> `domains` string.
+    """
+    if not domains_by_fetcherid:
+        return
+    delete_fetcher_domains(db, domains_by_fetcherid)
+    rows = [{"domain": domain, "fetcherid": fetcherid}
+            for fetcherid, domains in domains_by_fetcherid.items() for domain in sorted(parse_domains(domains))]
+    if rows:
+        db.execute(insert(models.FetcherDomain), rows)
+
+def find_fetchers_by_domains(db, domains, subdomains=True):
+    """
+    @param subdomains: when True, a domain with no fetchers of its own is
+        matched to the fetchers of its closest parent domain, e.g. a
+        fetcher of example.com is found for mail.example.com.
+    @return a schemas.FetcherDomainMatch for each of domains, in order.
+    """
+    candidates_by_domain = {}
+    for domain in domains:
+        normalized_domain = normalize_domain(domain)
+        candidates = get_parent_domains(normalized_domain) if subdomains else [normalized_domain]
+        candidates_by_domain[domain] = [candidate for candidate in candidates if candidate]
+
+    fetcherids_by_domain = {}
+    all_candidates = list({candidate for candidates in candidates_by_domain.values() for candidate in candidates})
+    for candidates_chunk in chunks(all_candidates, MAX_BIND_PARAMS):
+        for domain, fetcherid in db.execute(select(models.FetcherDomain.domain, models.FetcherDomain.fetcherid).where(
+                models.FetcherDomain.domain.in_(candidates_chunk))):
+            fetcherids_by_domain.setdefault(domain, []).append(fetcherid)
+
+    matches = []
+    for domain in domains:
+        match = schemas.FetcherDomainMatch(domain=domain)
+        for candidate in candidates_by_domain[domain]:
+            if candidate in fetcherids_by_domain:
+                match.matched_domain = candidate
+                match.ids = sorted(fetcherids_by_domain[candidate])
+                break
+        matches.append(match)
+    return matches
+
+##################### Customer Batch Fetcher Operations #######################
+# SQLite before 3.32 allows at most 999 bound parameters in one statement.
+MAX_BIND_PARAMS = 999
+
+class BatchCreateError(Exception):
+    """ Raised when a batch create fails because of errors in some of its items. """
+    def __init__(self, errors):
+        super().__init__("{} items in the batch could not be created.".format(len(errors)))
+        self.errors = errors
+
+# The kinds of constraint get_integrity_error_constraint tells apart, by
+# Postgres SQLSTATE.
+CONSTRAINT_KINDS = {"23502": "not null", "23503": "foreign key", "23505": "unique", "23514": "check"}
+
+def get_integrity_error_constraint(exc):
+    """
+    @return (kind, column) of the constraint which an
+        sqlalchemy.exc.IntegrityError broke.  kind is one of
+        CONSTRAINT_KINDS' values, or None if it isn't known, and column is
+        None if the DB doesn't say.
+    """
+    orig = exc.orig
+    sqlstate = getattr(orig, "pgcode", None)
+    if sqlstate is not None:
+        # psycopg2 has the details in diag, and asyncpg on the error it wraps.
+        details = getattr(orig, "diag", None) or orig.__cause__
+        column = getattr(details, "column_name", None)
+        constraint = getattr(details, "constraint_name", None) or ""
+        table = getattr(details, "table_name", None) or ""
+        # Postgres names a column's UNIQUE constraint <table>_<column>_key.
+        if column is None and constraint.startswith(table + "_") and constraint.endswith("_key"):
+            column = constraint[len(table) + 1:-len("_key")]
+        return CONSTRAINT_KINDS.get(sqlstate), column
+
+    # SQLite, e.g. "NOT NULL constraint failed: fetchers.server"
+    kind, failed, columns = str(orig.args[0] if orig.args else "").partition(" constraint failed")
+    if not failed:
+        return None, None
+    column = columns.lstrip(": ").split(",")[0].rpartition(".")[2].strip()
+    kind = kind.lower()
+    return (kind if kind in CONSTRAINT_KINDS.values() else None), column or None
+
+def describe_integrity_error(exc, schema, item=None):
+    """
+    @param schema: the Create schema of what was being written.
+    @param item: the one item which was being written, if known.
+    @return why the constraint an sqlalchemy.exc.IntegrityError broke
+        failed the write, for the API user.
+    """
+    kind, column = get_integrity_error_constraint(exc)
+    field = schema.__fields__[column].alias if column in schema.__fields__ else column
+    if kind == "not null":
+        return "'{}' must not be null.".format(field)
+    if kind == "unique" and column == models.Fetcher.confname.key:
+        if item is None:
+            return "A configuration name in the batch is already used by another fetcher."
+        return "Configuration name '{}' is already used by another fetcher.".format(item.confname)
+    if kind == "foreign key" and isinstance(item, schemas.FetcherScheduleCreate):
+        return "Fetcher with ID {} was not found.".format(item.fetcherid)
+    return "It breaks a{} constraint of the DB{}.".format(
+        " " + kind if kind else "", " on '{}'".format(field) if field else "")
+
+def get_not_null_error(model, item):
+    """
+    @return why a Create schema item can't be written to model's table
+        because a NOT NULL column's field is null, or None if it can.
+    """
+    values = item.dict()
+    for column in model.__table__.columns:
+        if not column.nullable and values.get(column.key, "") is None:
+            return "'{}' must not be null.".format(type(item).__fields__[column.key].alias)
+    return None
+
+@contextmanager
+def carry_on_after_error(db):
+    """
+    Lets a transaction go on after a statement in the with block fails, so
+    that what went before it can still be committed.  SQLite only undoes the
+    failed statement, but Postgres aborts the whole transaction, so there
+    the block is under a SAVEPOINT.
+    """
+    if db.get_bind().dialect.name == "sqlite":
+        yield
+    else:
+        with db.begin_nested():
+            yield
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def bulk_insert(db, model, rows):
+    """
+    Inserts rows (a list of column name -> value dicts, all with the same
+    keys) into model's table with one multi-row INSERT per chunk of rows.
+
+    @return the generated primary keys, in the same order as rows.
+    """
+    if not rows:
+        return []
+    primary_key = model.__table__.primary_key.columns[0]
+    chunk_size = max(1, MAX_BIND_PARAMS // len(rows[0]))
+    ids = []
+    for chunk in chunks(rows, chunk_size):
+        statement = insert(model).values(chunk)
+        if db.get_bind().dialect.name == "postgresql":
+            ids += db.execute(statement.returning(primary_key)).scalars().all()
+        else:
+            # SQLite gives the rows of one INSERT consecutive rowids since
+            # nothing else can write while it runs, and reports the last one.
+            last_id = db.execute(statement).lastrowid
+            ids += range(last_id - len(chunk) + 1, last_id + 1)
+    return ids
+
+def batch_create(db, model, items, errors, partial, after_insert=None):
+    """
+    Bulk inserts the items (pydantic Create schemas whose fields are named
+    after model's columns) which have no entry in `errors`, in one
+    transaction.
+
+    @param errors: a dict of item index -> error message for the items
+        which already failed validation.
+    @param partial: when False, any error fails the whole batch.  When
+        True, and the DB rejects the bulk insert anyway (say another writer
+        took a name first), the items are inserted one at a time so that
+        only the ones it rejects fail.
+    @param after_insert: if given, after_insert(db, new_ids, inserted_items)
+        is called just before the commit.
+    @return a schemas.BatchCreateResult
+    @raise BatchCreateError if there are errors and partial is False.
+    """
+    for index, item in enumerate(items):
+        if index not in errors and (error := get_not_null_error(model, item)) is not None:
+            errors[index] = error
+    if errors and not partial:
+        raise BatchCreateError([schemas.BatchCreateError(index=index, detail=detail)
+                                for index, detail in sorted(errors.items())])
+
+    valid_indexes = [index for index in range(len(items)) if index not in errors]
+    try:
+        with carry_on_after_error(db):
+            new_ids = bulk_insert(db, model, [items[index].dict() for index in valid_indexes])
+    except sqlalchemy.exc.IntegrityError:
+        if not partial:
+            raise
+        new_ids = []
+        for index in list(valid_indexes):
+            try:
+                with carry_on_after_error(db):
+                    new_ids += bulk_insert(db, model, [items[index].dict()])
+            except sqlalchemy.exc.IntegrityError as exc:
+                errors[index] = describe_integrity_error(exc, type(items[index]), items[index])
+                valid_indexes.remove(index)
+
+    valid_items = [items[index] for index in valid_indexes]
+    batch_errors = [schemas.BatchCreateError(index=index, detail=detail)
+                    for index, detail in sorted(errors.items())]
+    if after_insert is not None:
+        after_insert(db, new_ids, valid_items)
+    db.commit()
+
+    ids = [None] * len(items)
+    for index, new_id in zip(valid_indexes, new_ids):
+        ids[index] = new_id
+    return schemas.BatchCreateResult(ids=ids, errors=batch_errors)
+
+def batch_create_fetchers(db, fetchers, partial=False):
+    errors = {}
+    names = [fetcher.confname for fetcher in fetchers]
+    existing_names = set()
+    for names_chunk in chunks(list(set(names)), MAX_BIND_PARAMS):
+        existing_names.update(db.execute(select(models.Fetcher.confname).where(
+            models.Fetcher.confname.in_(names_chunk))).scalars())
+
+    seen_names = set()
+    for index, name in enumerate(names):
+        if name in existing_names:
+            errors[index] = "Configuration name '{}' is already used by another fetcher.".format(name)
+        elif name in seen_names:
+            errors[index] = "Configuration name '{}' is used more than once in this batch.".format(name)
+        seen_names.add(name)
+
+    return batch_create(db, models.Fetcher, fetchers, errors, partial, after_insert=set_new_fetcher_domains)
+
+def set_new_fetcher_domains(db, fetcherids, fetchers):
+    set_fetcher_domains(db, {fetcherid: fetcher.domains for fetcherid, fetcher in zip(fetcherids, fetchers)})
+
+# A temporary table of IDs, for statements about more rows than fit in the
+# bound parameters of one IN (...).  Each DB connection has its own.
+batch_ids_table = sqlalchemy.Table("batch_ids", sqlalchemy.MetaData(),
+    sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True), prefixes=["TEMPORARY"])
+
+def select_ids(db, ids):
+    """
+    @return what to pass to column.in_() to match ids: the ids themselves if
+        they fit in one statement's bound parameters, or else a SELECT of
+        them from batch_ids_table, filled with one executemany INSERT.
+        Either way the statement which uses it is one statement, for ten IDs
+        or a hundred thousand.  The SELECT is only good until the next call.
+    """
+    ids = list(set(ids))
+    if len(ids) <= MAX_BIND_PARAMS:
+        return ids
+    # The table is written through the connection so that its writes aren't
+    # reported to changes.py.
+    connection = db.connection()
+    connection.exec_driver_sql("CREATE TEMPORARY TABLE IF NOT EXISTS batch_ids (id INTEGER PRIMARY KEY)")
+    connection.execute(batch_ids_table.delete())
+    connection.execute(batch_ids_table.insert(), [{"id": id} for id in ids])
+    return select(batch_ids_table.c.id)
+
+def get_fetcher_selection_condition(db, selection):
+    """ @return a condition matching the fetchers of a schemas.BatchFetcherSelection. """
+    if selection.filter is not None:
+        return sqlalchemy.and_(*get_fetcher_filters(**selection.filter.dict()))
+    return models.Fetcher.fetcherid.in_(select_ids(db, selection.ids))
+
+def update_rows(db, model, condition, values, op="update"):
+    """
+    Sets the columns in `values` of every row of model's table which matches
+    condition.  Doesn't commit.
+
+    @param op: the op changes.py records the update as (see changes.CHANGE_OP).
+
+    @return the sorted primary keys of the rows which were updated: from
+        UPDATE ... RETURNING where the DB supports it, or else from a SELECT
+        of the matching rows just before the UPDATE.
+    """
+    primary_key = model.__table__.primary_key.columns[0]
+    statement = update(model).values(values).execution_options(synchronize_session=False,
+                                                               **{changes.CHANGE_OP: op})
+    if db.get_bind().dialect.full_returning:
+        ids = db.execute(statement.where(condition).returning(primary_key).execution_options(
+            **{changes.CHANGED_IDS: []})).scalars().all()
+        changes.record_change(db, model.__tablename__, op, ids)
+    else:
+        ids = db.execute(select(primary_key).where(condition)).scalars().all()
+        db.execute(statement.where(condition).execution_options(**{changes.CHANGED_IDS: ids}))
+    return sorted(ids)
+
+def delete_rows(db, model, condition):
+    """
+    Deletes every row of model's table which matches condition.  Doesn't
+    commit.  @return the sorted primary keys of the rows which were deleted,
+    as update_rows does.
+    """
+    primary_key = model.__table__.primary_key.columns[0]
+    statement = delete(model).execution_options(synchronize_session=False)
+    if db.get_bind().dialect.full_returning:
+        ids = db.execute(statement.where(condition).returning(primary_key).execution_options(
+            **{changes.CHANGED_IDS: []})).scalars().all()
+        changes.record_change(db, model.__tablename__, "delete", ids)
+    else:
+        ids = db.execute(select(primary_key).where(condition)).scalars().all()
+        db.execute(statement.where(condition).execution_options(**{changes.CHANGED_IDS: ids}))
+    return sorted(ids)
+
+def set_fetchers_active(db, selection, active):
+    """
+    Activates or deactivates the fetchers of a schemas.BatchFetcherSelection.
+    @return a schemas.BatchFetcherIds of the fetchers which changed.
+    """
+    condition = sqlalchemy.and_(get_fetcher_selection_condition(db, selection),
+                                models.Fetcher.active.isnot(active))
+    ids = update_rows(db, models.Fetcher, condition, {models.Fetcher.active: active},
+                      "activate" if active else "deactivate")
+    db.commit()
+    return schemas.BatchFetcherIds(ids=ids)
+
+def delete_fetchers_cascade(db, condition):
+    """
+    Deletes the fetchers which match condition along with their schedules
+    and domains, in the same handful of set-based statements for one fetcher
+    or a hundred thousand.  Doesn't commit.
+
+    The foreign keys would cascade the deletes on their own, but deleting the
+    children first and explicitly means changes.py (and so the downtime
+    index) hears exactly which schedules went.
+
+    @return the sorted IDs of the fetchers which were deleted.
+    """
+    selected_fetcherids = select(models.Fetcher.fetcherid).where(condition)
+    delete_rows(db, models.FetcherSchedule, models.FetcherSchedule.fetcherid.in_(selected_fetcherids))
+    db.execute(delete(models.FetcherDomain).where(models.FetcherDomain.fetcherid.in_(
+        selected_fetcherids)).execution_options(synchronize_session=False))
+    return delete_rows(db, models.Fetcher, condition)
+
+def delete_fetchers(db, selection):
+    """
+    Deletes the fetchers of a schemas.BatchFetcherSelection.
+    @return a schemas.BatchFetcherIds of the fetchers which were deleted.
+    """
+    ids = delete_fetchers_cascade(db, get_fetcher_selection_condition(db, selection))
+    db.commit()
+    return schemas.BatchFetcherIds(ids=ids)
+
+def delete_orphans(db, batch_size):
+    """
+    Deletes up to batch_size schedules, and the domains of up to batch_size
+    fetchers, whose fetcher no longer exists, and commits.  Such rows were
+    left behind by deletes from before they cascaded.
+
+    @return the number of schedule rows and domain rows deleted.
+    """
+    schedule_orphan = ~sqlalchemy.exists().where(models.Fetcher.fetcherid == models.FetcherSchedule.fetcherid)
+    orphan_scheduleids = db.execute(select(models.FetcherSchedule.fetcherscheduleid).where(
+        schedule_orphan).limit(batch_size)).scalars().all()
+    if orphan_scheduleids:
+        delete_rows(db, models.FetcherSchedule, models.FetcherSchedule.fetcherscheduleid.in_(orphan_scheduleids))
+
+    domain_orphan = ~sqlalchemy.exists().where(models.Fetcher.fetcherid == models.FetcherDomain.fetcherid)
+    orphan_fetcherids = db.execute(select(models.FetcherDomain.fetcherid).where(
+        domain_orphan).distinct().limit(batch_size)).scalars().all()
+    deleted_domains = 0
+    if orphan_fetcherids:
+        deleted_domains = db.execute(delete(models.FetcherDomain).where(
+            models.FetcherDomain.fetcherid.in_(orphan_fetcherids)).execution_options(
+            synchronize_session=False)).rowcount
+
+    db.commit()
+    return len(orphan_scheduleids), deleted_domains
+
+
+def bulk_update(db, model, rows):
+    """
+    Updates model's table with one executemany UPDATE ... WHERE <primary key>
+    for rows, a list of column name -> value dicts which all have the same
+    keys, including the primary key.
+    """
+    if not rows:
+        return
+    table = model.__table__
+    primary_key = table.primary_key.columns[0]
+    # bindparam names may not clash with the column names in SET.
+    params = [{"b_" + key: value for key, value in row.items()} for row in rows]
+    statement = update(table).where(primary_key == bindparam("b_" + primary_key.name)).values(
+        {key: bindparam("b_" + key) for key in rows[0] if key != primary_key.name})
+    db.execute(statement, params)
+
+def write_fetcher_rows(db, insert_rows, update_rows):
+    """ Inserts and updates fetchers (FetcherCreate dicts, with fetcherid for updates) and their domains. """
+    new_ids = bulk_insert(db, models.Fetcher, insert_rows)
+    bulk_update(db, models.Fetcher, update_rows)
+    domains_by_fetcherid = {row["fetcherid"]: row["domains"] for row in update_rows}
+    domains_by_fetcherid.update(zip(new_ids, [row["domains"] for row in insert_rows]))
+    set_fetcher_domains(db, domains_by_fetcherid)
+
+def import_fetchers(db, numbered_fetchers, upsert=False):
+    """
+    Inserts a chunk of fetchers from an import and commits them.
+
+    @param numbered_fetchers: a list of (line number, FetcherCreate) tuples.
+    @param upsert: when True, a fetcher whose confname is already used
+        replaces the fetcher with that name.  When False it is rejected.
+    @return (inserted count, updated count, list of schemas.ImportRejectedLine)
+    """
+    names = list({fetcher.confname for _, fetcher in numbered_fetchers})
+    existing_ids = {}
+    for names_chunk in chunks(names, MAX_BIND_PARAMS):
+        existing_ids.update(db.execute(select(models.Fetcher.confname, models.Fetcher.fetcherid).where(
+            models.Fetcher.confname.in_(names_chunk))).all())
+
+    inserts = {}
+    updates = {}
+    # name -> (line number, FetcherCreate) of the line inserts or updates has.
+    lines = {}
+    rejected_lines = []
+    for line_number, fetcher in numbered_fetchers:
+        name = fetcher.confname
+        error = get_not_null_error(models.Fetcher, fetcher)
+        if error is not None:
+            rejected_lines.append(schemas.ImportRejectedLine(line=line_number, detail=error))
+            continue
+        if name in existing_ids or name in inserts:
+            if not upsert:
+                rejected_lines.append(schemas.ImportRejectedLine(line=line_number,
+                    detail="Configuration name '{}' is already used by another fetcher.".format(name)))
+                continue
+            if name in inserts:
+                inserts[name] = fetcher.dict()
+            else:
+                updates[name] = dict(fetcher.dict(), fetcherid=existing_ids[name])
+        else:
+            inserts[name] = fetcher.dict()
+        lines[name] = (line_number, fetcher)
+
+    try:
+        write_fetcher_rows(db, list(inserts.values()), list(updates.values()))
+        db.commit()
+        return len(inserts), len(updates), rejected_lines
+    except sqlalchemy.exc.IntegrityError:
+        db.rollback()
+
+    # Another writer got in first, or a line breaks a constraint which isn't
+    # checked above.  Write the chunk a line at a time, so that only the
+    # lines the DB rejects are rejected.
+    inserted = updated = 0
+    for name, row in [*inserts.items(), *updates.items()]:
+        line_number, fetcher = lines[name]
+        is_insert = name in inserts
+        try:
+            with carry_on_after_error(db):
+                write_fetcher_rows(db, [row] if is_insert else [], [] if is_insert else [row])
+        except sqlalchemy.exc.IntegrityError as exc:
+            rejected_lines.append(schemas.ImportRejectedLine(line=line_number,
+                detail=describe_integrity_error(exc, schemas.FetcherCreate, fetcher)))
+        else:
+            inserted += is_insert
+            updated += not is_insert
+    db.commit()
+    return inserted, updated, sorted(rejected_lines, key=lambda rejected_line: rejected_line.line)
+
+
+################################# Delta Sync ##################################
+class ChangesPurged(Exception):
+    """ Raised when the tombstones of changes since a token have been purged. """
+
+def get_sync_state(db):
+    """ @return (version, purgedversion): see models.sync_state. """
+    return tuple(db.execute(select(models.sync_state.c.version, models.sync_state.c.purgedversion)).one())
+
+def retrieve_changes(db, since, limit=None):
+    """
+    @param since: a token from a previous call, or 0 for everything.
+    @param limit: the most fetchers, schedules and deletes to return in all.
+    @return a schemas.FetcherChanges of the rows inserted, updated or deleted
+        after version `since`, oldest first.
+    @raise ChangesPurged if deletes since `since` may have been purged.
+    """
+    # Read before the rows, so a row written in between is returned again
+    # next time rather than missed.
+    version, purged_version = get_sync_state(db)
+    if since < purged_version:
+        raise ChangesPurged("Changes since {} are no longer kept.".format(since))
+
+    # One more of each kind than limit, so that any kind with more changes
+    # than fit shows in `more`.
+    def select_changed(entity, version_column, options=()):
+        return db.execute(select(entity).options(*options).where(version_column > since).order_by(
+            version_column).limit(None if limit is None else limit + 1)).scalars().all()
+
+    changed = [(fetcher.rowversion, "fetchers", fetcher) for fetcher in
+               select_changed(models.Fetcher, models.Fetcher.rowversion, get_fetcher_load_options(False))]
+    changed += [(schedule.rowversion, "schedules", schedule) for schedule in
+                select_changed(models.FetcherSchedule, models.FetcherSchedule.rowversion)]
+    changed += [(tombstone.rowversion, "deleted_" + tombstone.tablename, tombstone) for tombstone in
+                select_changed(models.Tombstone, models.Tombstone.rowversion)]
+    changed.sort(key=lambda change: change[0])
+
+    # Everything up to the last change returned has been, as each kind of
+    # change was selected in version order, and the next token starts after
+    # it.
+    more = limit is not None and len(changed) > limit
+    if more:
+        changed = changed[:limit]
+        version = changed[-1][0]
+
+    result = schemas.FetcherChanges(token=version, more=more)
+    for _, kind, row in changed:
+        if kind == "fetchers":
+            result.fetchers.append(get_fetcher_schema(row, with_schedules=False))
+        elif kind == "schedules":
+            result.schedules.append(schemas.FetcherScheduleRead.from_orm(row))
+        elif kind == "deleted_" + models.Fetcher.__tablename__:
+            result.deleted_fetcher_ids.append(row.id)
+        else:
+            result.deleted_schedule_ids.append(row.id)
+    return result
+
+def purge_tombstones(db, deleted_before):
+    """
+    Deletes the tombstones of rows deleted before datetime deleted_before
+    (naive UTC, as the DB keeps them), and commits.  Tokens from before the
+    last of them can no longer be synced from.
+
+    @return the number of tombstones deleted.
+    """
+    last_version = db.execute(select(func.max(models.Tombstone.rowversion)).where(
+        models.Tombstone.deletedat < deleted_before)).scalar()
+    if last_version is None:
+        return 0
+    purged = db.execute(delete(models.Tombstone).where(models.Tombstone.rowversion <= last_version)).rowcount
+    db.execute(update(models.sync_state).where(models.sync_state.c.purgedversion < last_version).values(
+        purgedversion=last_version))
+    db.commit()
+    return purged
+
+
+############################# Fetcher Schedules ###############################
+def batch_create_fetcherschedules(db, schedules, partial=False):
+    errors = {}
+    fetcherids = list({schedule.fetcherid for schedule in schedules})
+    existing_fetcherids = set()
+    for fetcherids_chunk in chunks(fetcherids, MAX_BIND_PARAMS):
+        existing_fetcherids.update(db.execute(select(models.Fetcher.fetcherid).where(
+            models.Fetcher.fetcherid.in_(fetcherids_chunk))).scalars())
+
+    for index, schedule in enumerate(schedules):
+        if schedule.fetcherid not in existing_fetcherids:
+            errors[index] = "Fetcher with ID {} was not found.".format(schedule.fetcherid)
+
+    return batch_create(db, models.FetcherSchedule, schedules, errors, partial)
+
+def create_fetcherschedule(db, schedule):
+    new_schedule = models.FetcherSchedule(
+        fetcherid = schedule.fetcherid,
+        downtimedays = schedule.downtimedays,
+        downtimestart = schedule.downtimestart,
+        downtimeend = schedule.downtimeend,
+    )
+    db.add(new_schedule)
+    db.commit()
+    db.refresh(new_schedule)
+    return schemas.FetcherScheduleRead.from_orm(new_schedule)
+
+def update_fetcherschedule(db, fetcherscheduleid, schedule):
+    """ @raise NoResultFound if there is no such schedule. """
+    schedule_row = update_row(db, models.FetcherSchedule, fetcherscheduleid, schedule.dict())
+    db.commit()
+    return schemas.FetcherScheduleRead.from_orm(schedule_row)
+
+def retrieve_fetcherschedules(db, limit=None, cursor=None, as_dicts=False):
+    """
+    @param as_dicts: see get_fetcher_schema.
+    @return (schedule_schemas, next_cursor)
+    @raise ValueError if the cursor is not valid.
+    """
+    schedule_query = db.query(models.FetcherSchedule)
+    schedule_query, order_by_dicts = add_keyset_pagination(schedule_query, [], {},
+        models.FetcherSchedule.fetcherscheduleid, cursor, limit)
+
+    schedules, next_cursor = get_page(schedule_query.all(), order_by_dicts, limit)
+    fetcher_schedule_schemas = [get_schedule_schema(schedule, as_dicts) for schedule in schedules]
+    return fetcher_schedule_schemas, next_cursor
+
+def retrieve_fetcherschedule(db, fetcherscheduleid, as_dict=False, cached=True):
+    """
+    @param cached: whether to read through cache.schedule_cache, which holds
+        each schedule as a dict.  See retrieve_fetcher.
+    """
+    def load():
+        schedule = db.query(models.FetcherSchedule).filter(
+            models.FetcherSchedule.fetcherscheduleid == fetcherscheduleid).one()
+        return serialize_schedule(schedule)
+    if not cached:
+        return project_schedule_dict(load(), as_dict)
+    return project_schedule_dict(schedule_cache.get_or_load(db, fetcherscheduleid, load), as_dict)
+
+def delete_fetcherschedule(db, fetcherscheduleid):
+    deletable_schedule = retrieve_fetcherschedule(db, fetcherscheduleid, cached=False)
+    delete_rows(db, models.FetcherSchedule, models.FetcherSchedule.fetcherscheduleid == fetcherscheduleid)
+    db.commit()
+    return deletable_schedule
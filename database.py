@@ -1,25 +1,67 @@
-from sqlalchemy import create_engine
+import asyncio
+import uuid
+from contextlib import asynccontextmanager
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, Session
+from starlette.concurrency import run_in_threadpool
 
 
 USE_SQLITE = True
 
+# When True, routes get an AsyncSession on an async driver (aiosqlite or
+# asyncpg) and never block a threadpool thread on the DB.  When False they
+# get a regular Session and run their DB work on Starlette's threadpool.
+# Both modes run exactly the same query code (see run_db).
+USE_ASYNC = False
+
+# When True, the app runs the active fetchers in the background (see
+# supervisor.py), logging in to every one's mailbox every POLL_SECONDS.  Turn
+# it on in one process only: with several workers, each would poll every
+# mailbox, and the :start, :stop and :restart routes only reach the
+# supervisor of the worker which got the request.
+USE_SUPERVISOR = False
+
+# Identifies this process's connections to Postgres, as the fetcher.worker
+# setting, so that bus.py can tell the notifications of its own writes from
+# those of other workers.
+WORKER_ID = uuid.uuid4().hex[:8]
+
 
 if USE_SQLITE:
     ### SQLite Settings ###
     SQLALCHEMY_DB_URL = "sqlite:///./sqlapp.db"
+    SQLALCHEMY_ASYNC_DB_URL = "sqlite+aiosqlite:///./sqlapp.db"
     # "check_same_thread": False is as recommended by FastAPI for SQLite only
     engine = create_engine(SQLALCHEMY_DB_URL, connect_args={"check_same_thread": False})
 else:
     ### Postgres Settings ###
     SQLALCHEMY_DB_URL = 'postgresql+psycopg2://postgres:@172.16.155.129/cvxthree'
-    engine = create_engine(SQLALCHEMY_DB_URL)
+    SQLALCHEMY_ASYNC_DB_URL = 'postgresql+asyncpg://postgres:@172.16.155.129/cvxthree'
+    engine = create_engine(SQLALCHEMY_DB_URL, connect_args={"options": "-c fetcher.worker=" + WORKER_ID})
+
+
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    """
+    SQLite only enforces foreign keys (and their ON DELETE CASCADE) on a
+    connection which asks it to.  Registered for every new connection.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys = ON")
+    cursor.close()
+
+if USE_SQLITE:
+    event.listen(engine, "connect", enable_sqlite_foreign_keys)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
 
+# The type of the `db` argument routes get: see USE_ASYNC.
+AnySession = Session | AsyncSession
+
 
 def get_db_session():
     db = SessionLocal()
@@ -27,3 +69,89 @@ def get_db_session():
         yield db
     finally:
         db.close()
+
+
+# The async engine is only created when it is used so that the async drivers
+# are not required to run in sync mode.
+async_engine = None
+AsyncSessionLocal = None
+
+def get_async_engine():
+    global async_engine, AsyncSessionLocal
+    if async_engine is None:
+        if USE_SQLITE:
+            async_engine = create_async_engine(SQLALCHEMY_ASYNC_DB_URL)
+        else:
+            async_engine = create_async_engine(SQLALCHEMY_ASYNC_DB_URL,
+                connect_args={"server_settings": {"fetcher.worker": WORKER_ID}})
+        if USE_SQLITE:
+            event.listen(async_engine.sync_engine, "connect", enable_sqlite_foreign_keys)
+        AsyncSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=async_engine,
+                                         class_=AsyncSession)
+    return async_engine
+
+async def get_async_db_session():
+    get_async_engine()
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+@asynccontextmanager
+async def open_db_session():
+    """
+    Opens a session of the kind USE_ASYNC asks for, for code which runs
+    outside of a request, such as background tasks.
+    """
+    if USE_ASYNC:
+        get_async_engine()
+        async with AsyncSessionLocal() as db:
+            yield db
+    else:
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            await run_in_threadpool(db.close)
+
+
+async def run_db(db, fn, *args, **kwargs):
+    """
+    Calls fn(session, *args, **kwargs) without blocking the event loop and
+    returns its result.
+
+    fn is ordinary synchronous SQLAlchemy code.  With an AsyncSession it runs
+    through AsyncSession.run_sync, which drives the async driver from fn's
+    blocking-style calls (lazy loads included).  With a regular Session it
+    runs on Starlette's threadpool just like a sync `def` route would.
+    """
+    if isinstance(db, AsyncSession):
+        return await db.run_sync(fn, *args, **kwargs)
+    task = asyncio.ensure_future(run_in_threadpool(fn, db, *args, **kwargs))
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        # The thread can't be stopped, and db (say, closed by the caller's
+        # cleanup) mustn't be used by two threads at once, so wait it out.
+        await asyncio.wait([task])
+        raise
+
+
+async def stream_partitions(db, statement, partition_size):
+    """
+    Runs an ORM select statement with a server-side cursor and yields its
+    ORM objects in lists of up to partition_size, fetching each list from the
+    DB only when it is asked for.  Eager loads such as selectinload are run
+    once per list.
+
+    Works with either session type without blocking the event loop.
+    """
+    statement = statement.execution_options(yield_per=partition_size)
+    if isinstance(db, AsyncSession):
+        result = await db.stream(statement)
+        async for partition in result.scalars().partitions():
+            yield partition
+    else:
+        result = await run_in_threadpool(db.execute, statement)
+        partitions = result.scalars().partitions()
+        while (partition := await run_in_threadpool(next, partitions, None)) is not None:
+            yield partition
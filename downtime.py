@@ -0,0 +1,235 @@
+"""
+An in-memory index of fetcher schedule downtime, for answering "which
+fetchers are in downtime at time T" without reading or parsing every schedule.
+
+Every schedule is compiled into windows of minutes of the week (0 is Sunday
+00:00).  The week is cut into segments at every minute where some window
+starts or ends, and each segment keeps a count of the windows which cover it
+per fetcher.  A lookup is a binary search for the segment, so its cost does
+not depend on the number of schedules.
+
+The index follows committed writes through changes.py: the schedules (and
+deleted fetchers) which were written are marked stale, and refresh() reloads
+just those rows.  Writes which don't say which rows they touched, such as a
+bulk delete of fetchers, make the next refresh() reload everything.
+"""
+
+import bisect
+import datetime
+import threading
+
+from sqlalchemy import select
+
+import changes
+import models
+
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+# The most schedule IDs to put in one IN (...) when reloading.
+MAX_RELOAD_IDS = 500
+
+
+def to_local_time(at=None):
+    """
+    @return at as a naive datetime in the server's local time, which is what
+        schedule times are in.  Defaults to now.
+    """
+    if at is None:
+        return datetime.datetime.now()
+    if at.tzinfo is not None:
+        return at.astimezone().replace(tzinfo=None)
+    return at
+
+def get_minute_of_week(at):
+    """ @return the minute of the week of a datetime, where 0 is Sunday 00:00. """
+    day = (at.weekday() + 1) % 7  # weekday() has Monday as 0.
+    return day * MINUTES_PER_DAY + at.hour * 60 + at.minute
+
+def parse_downtime_days(downtimedays):
+    """
+    @return the set of days (0 - 6, Sunday is 0) in a comma separated
+        downtimedays string.  Anything else in the string is ignored.
+    """
+    days = set()
+    for day in downtimedays.split(","):
+        day = day.strip()
+        if day.isdigit() and int(day) < 7:
+            days.add(int(day))
+    return days
+
+def get_windows(downtimedays, downtimestart, downtimeend):
+    """
+    @return the downtime of a schedule as a list of (start, end) minutes of
+        the week, where start is in the window and end is not.
+
+    A window which ends at or before its start time runs past midnight into
+    the next day (wrapping from Saturday to Sunday), so one whose start and
+    end are the same lasts a whole day.
+    """
+    start = downtimestart.hour * 60 + downtimestart.minute
+    end = downtimeend.hour * 60 + downtimeend.minute
+    if end <= start:
+        end += MINUTES_PER_DAY
+
+    windows = []
+    for day in sorted(parse_downtime_days(downtimedays)):
+        window_start = day * MINUTES_PER_DAY + start
+        window_end = day * MINUTES_PER_DAY + end
+        if window_end > MINUTES_PER_WEEK:
+            windows.append((window_start, MINUTES_PER_WEEK))
+            windows.append((0, window_end - MINUTES_PER_WEEK))
+        else:
+            windows.append((window_start, window_end))
+    return windows
+
+
+class DowntimeIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Segment i covers the minutes from _boundaries[i] up to the next
+        # boundary, and maps fetcherid -> number of windows covering it.
+        self._boundaries = [0]
+        self._segments = [{}]
+        # fetcherscheduleid -> (fetcherid, windows)
+        self._schedules = {}
+        # fetcherid -> set of fetcherscheduleids
+        self._fetcher_schedules = {}
+
+        self._needs_full_reload = True
+        self._stale_scheduleids = set()
+        self._deleted_fetcherids = set()
+
+    ############################ Lookups #############################
+    def get_fetchers_in_downtime(self, at):
+        """ @return the set of fetcherids which are in downtime at datetime at. """
+        minute = get_minute_of_week(at)
+        with self._lock:
+            segment = self._segments[bisect.bisect_right(self._boundaries, minute) - 1]
+            return set(segment)
+
+    def is_in_downtime(self, fetcherid, at):
+        minute = get_minute_of_week(at)
+        with self._lock:
+            segment = self._segments[bisect.bisect_right(self._boundaries, minute) - 1]
+            return fetcherid in segment
+
+    ############################ Updates #############################
+    def _split_at(self, minute):
+        """ Makes minute a segment boundary.  @return its segment index. """
+        index = bisect.bisect_right(self._boundaries, minute) - 1
+        if self._boundaries[index] == minute:
+            return index
+        self._boundaries.insert(index + 1, minute)
+        self._segments.insert(index + 1, dict(self._segments[index]))
+        return index + 1
+
+    def _add_window(self, fetcherid, start, end, count):
+        first = self._split_at(start)
+        last = self._split_at(end) if end < MINUTES_PER_WEEK else len(self._segments)
+        for segment in self._segments[first:last]:
+            covering = segment.get(fetcherid, 0) + count
+            if covering:
+                segment[fetcherid] = covering
+            else:
+                del segment[fetcherid]
+
+    def _remove_schedule(self, fetcherscheduleid):
+        fetcherid, windows = self._schedules.pop(fetcherscheduleid, (None, []))
+        for start, end in windows:
+            self._add_window(fetcherid, start, end, -1)
+        if fetcherid is not None:
+            self._fetcher_schedules[fetcherid].discard(fetcherscheduleid)
+            if not self._fetcher_schedules[fetcherid]:
+                del self._fetcher_schedules[fetcherid]
+
+    def _set_schedule(self, fetcherscheduleid, fetcherid, downtimedays, downtimestart, downtimeend):
+        self._remove_schedule(fetcherscheduleid)
+        windows = get_windows(downtimedays, downtimestart, downtimeend)
+        for start, end in windows:
+            self._add_window(fetcherid, start, end, 1)
+        self._schedules[fetcherscheduleid] = (fetcherid, windows)
+        self._fetcher_schedules.setdefault(fetcherid, set()).add(fetcherscheduleid)
+
+    def _clear(self):
+        self._boundaries = [0]
+        self._segments = [{}]
+        self._schedules = {}
+        self._fetcher_schedules = {}
+
+    ###################### Following DB changes ######################
+    def on_commit(self, committed_changes):
+        """ A changes.py listener which marks the written rows as stale. """
+        with self._lock:
+            for change in committed_changes:
+                if change.table == models.FetcherSchedule.__tablename__:
+                    if change.ids is None:
+                        self._needs_full_reload = True
+                    else:
+                        self._stale_scheduleids.update(change.ids)
+                elif change.table == models.Fetcher.__tablename__ and change.op == "delete":
+                    if change.ids is None:
+                        self._needs_full_reload = True
+                    else:
+                        self._deleted_fetcherids.update(change.ids)
+
+    def invalidate(self):
+        """ Makes the next refresh() reload every schedule. """
+        with self._lock:
+            self._needs_full_reload = True
+
+    def refresh(self, db):
+        """
+        Brings the index up to date with the DB by reloading whatever was
+        marked stale since the last refresh.  Takes a sync Session (see
+        database.run_db).
+        """
+        with self._lock:
+            needs_full_reload = self._needs_full_reload
+            stale_scheduleids = self._stale_scheduleids
+            deleted_fetcherids = self._deleted_fetcherids
+            self._needs_full_reload = False
+            self._stale_scheduleids = set()
+            self._deleted_fetcherids = set()
+        if not (needs_full_reload or stale_scheduleids or deleted_fetcherids):
+            return
+        try:
+            self._reload(db, needs_full_reload, stale_scheduleids, deleted_fetcherids)
+        except Exception:
+            self.invalidate()
+            raise
+
+    def _reload(self, db, needs_full_reload, stale_scheduleids, deleted_fetcherids):
+        # Schedules are joined to their fetcher so that schedules left behind
+        # by a fetcher which has been deleted are never indexed.
+        schedule_query = select(models.FetcherSchedule.fetcherscheduleid,
+            models.FetcherSchedule.fetcherid, models.FetcherSchedule.downtimedays,
+            models.FetcherSchedule.downtimestart, models.FetcherSchedule.downtimeend).join(
+            models.Fetcher, models.Fetcher.fetcherid == models.FetcherSchedule.fetcherid)
+
+        if needs_full_reload:
+            rows = db.execute(schedule_query).all()
+            with self._lock:
+                self._clear()
+                for row in rows:
+                    self._set_schedule(*row)
+            return
+
+        stale_scheduleids = list(stale_scheduleids)
+        rows = []
+        for start in range(0, len(stale_scheduleids), MAX_RELOAD_IDS):
+            rows += db.execute(schedule_query.where(models.FetcherSchedule.fetcherscheduleid.in_(
+                stale_scheduleids[start:start + MAX_RELOAD_IDS]))).all()
+        with self._lock:
+            for fetcherid in deleted_fetcherids:
+                for fetcherscheduleid in list(self._fetcher_schedules.get(fetcherid, [])):
+                    self._remove_schedule(fetcherscheduleid)
+            for fetcherscheduleid in stale_scheduleids:
+                self._remove_schedule(fetcherscheduleid)
+            for row in rows:
+                self._set_schedule(*row)
+
+
+downtime_index = DowntimeIndex()
+changes.add_listener(downtime_index.on_commit, remote=True)
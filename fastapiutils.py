@@ -1,3 +1,17 @@
+import base64
+import binascii
+import json
+import sys
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from fastapi import Query, Response
+from sqlalchemy import and_, or_, false, literal
+
+
 def get_sort_query(sortable_fields):
     """
     @return a FastAPI Query object that can be used to make a list URL sortable.
@@ -21,3 +35,299 @@ def get_sort_query(sortable_fields):
         allowed_values.append("field asc")
 
     return Query()
+
+
+def get_order_by_dicts(order_by_query_vals, field_to_column_map):
+    order_by_dicts = []
+    for order_by_val in order_by_query_vals:
+        try:
+            order_by_val = order_by_val.value  # extract the string from an enum value.
+        except AttributeError:
+            pass  # assume order_by_val is already a string.
+
+        try:
+            field, direction = order_by_val.rsplit(" ", 1)
+        except ValueError:
+            field = order_by_val
+            direction = "asc"
+
+        if direction not in ["asc", "desc"]:
+            raise ValueError("Direction must be asc or desc, but it was {} instead.".format(direction))
+
+        try:
+            column = field_to_column_map[field]
+        except KeyError:
+            raise ValueError("The field {} has no column mapping".format(field))
+
+        order_by_dict = {
+            "field": field,
+            "direction": direction,
+            "column": column
+        }
+        order_by_dicts.append(order_by_dict)
+    return order_by_dicts
+
+def add_order_by_clause(select_query, order_by_query_vals, field_to_column_map):
+    """
+    Takes an existing select_query and adds an order_by clause to it based on
+    the passed in order_by_query_vals and field_to_column_map.
+
+    @param order_by_query_vals: A list as returned by a FastAPI query param
+        Example: ["name asc", "active desc", "protocol"]
+    @param field_to_column_map: a dictionary that maps field names to table
+        columns.
+        Example: {
+            "name": models.Fetcher.confname,
+            "active": models.Fetcher.active
+        }
+    """
+    order_by_dicts = get_order_by_dicts(order_by_query_vals, field_to_column_map)
+    return _add_order_by_dicts(select_query, order_by_dicts)
+
+def _add_order_by_dicts(select_query, order_by_dicts):
+    for order_by_dict in order_by_dicts:
+        if order_by_dict['direction'] == 'desc':
+            select_query = select_query.order_by(order_by_dict['column'].desc())
+        else:
+            select_query = select_query.order_by(order_by_dict['column'].asc())
+    return select_query
+
+
+################################## Filtering ##################################
+def get_prefix_filter(column, prefix):
+    """
+    @return a condition that column starts with prefix.
+
+    It is written as a range, `column >= 'abc' AND column < 'abd'`, rather
+    than `LIKE 'abc%'`, so that it is case sensitive and can be answered from
+    a plain index on column: SQLite's LIKE is case insensitive and can't use
+    one.  This assumes the column sorts by code point, as SQLite's default
+    BINARY collation and Postgres' "C" collation do.
+    """
+    upper_bound = prefix.rstrip(chr(sys.maxunicode))
+    if not upper_bound:
+        return column >= prefix
+    return and_(column >= prefix, column < upper_bound[:-1] + chr(ord(upper_bound[-1]) + 1))
+
+
+############################## Keyset pagination ##############################
+# Response header carrying the cursor for the next page of a paginated list.
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+# Dialects which sort NULL below every other value (so NULLs come first in an
+# ascending sort).  Postgres and Oracle sort NULL above every other value.
+NULLS_SORT_LOW_DIALECTS = ["sqlite", "mysql", "mssql"]
+
+# The types of the sort key values a cursor may hold, besides None.
+CURSOR_KEY_TYPES = (str, int, float, bool)
+
+def encode_cursor(order_by_dicts, row):
+    """
+    @return an opaque string which encodes the sort key of `row` (the last row
+        of a page) along with the sort order it was taken from.
+    """
+    payload = {
+        "order": ["{} {}".format(d['field'], d['direction']) for d in order_by_dicts],
+        "key": [getattr(row, d['column'].key) for d in order_by_dicts],
+    }
+    raw = json.dumps(payload, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor, order_by_dicts):
+    """
+    @return the list of sort key values encoded in `cursor`.
+    @raise ValueError if the cursor is malformed or was issued for a
+        different sort order than `order_by_dicts`.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        payload = json.loads(raw)
+        order = payload["order"]
+        key = payload["key"]
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        raise ValueError("The cursor '{}' is not valid.".format(cursor))
+
+    if not isinstance(key, list) or not all(value is None or isinstance(value, CURSOR_KEY_TYPES) for value in key):
+        raise ValueError("The cursor '{}' is not valid.".format(cursor))
+    expected_order = ["{} {}".format(d['field'], d['direction']) for d in order_by_dicts]
+    if order != expected_order or len(key) != len(order_by_dicts):
+        raise ValueError("The cursor '{}' was not issued for this sort order.".format(cursor))
+    return key
+
+def _sorts_after(column, direction, value, nulls_sort_low):
+    """ @return a condition matching values of column which sort after value. """
+    nulls_first = (direction == "asc") == nulls_sort_low
+    if value is None:
+        if nulls_first:
+            return column.isnot(None)
+        return false()
+
+    # literal() because SQLAlchemy refuses to compare a column to a bare
+    # True/False with anything other than == and !=.
+    if direction == "desc":
+        condition = column < literal(value, column.type)
+    else:
+        condition = column > literal(value, column.type)
+    if not nulls_first and column.nullable:
+        condition = or_(condition, column.is_(None))
+    return condition
+
+def _sorts_at_or_after(column, direction, value, nulls_sort_low):
+    """
+    @return a condition matching values of column which sort the same as or
+        after value, or None if every value does.  Unlike _sorts_after's OR,
+        it is a range which the DB can seek an index to, unless column may be
+        NULL and NULLs sort last.
+    """
+    nulls_first = (direction == "asc") == nulls_sort_low
+    if value is None:
+        return None if nulls_first else column.is_(None)
+
+    if direction == "desc":
+        condition = column <= literal(value, column.type)
+    else:
+        condition = column >= literal(value, column.type)
+    if not nulls_first and column.nullable:
+        condition = or_(condition, column.is_(None))
+    return condition
+
+def _sorts_equal(column, value):
+    if value is None:
+        return column.is_(None)
+    return column == value
+
+def add_keyset_pagination(select_query, order_by_query_vals, field_to_column_map,
+                          id_column, cursor=None, limit=None):
+    """
+    Like add_order_by_clause, but appends id_column as a final tiebreaker so
+    the sort order is total, and then restricts select_query to the rows
+    which come after `cursor`.
+
+    The page boundary is a WHERE condition on the sort key of the previous
+    page's last row rather than an OFFSET, so every page costs about the same
+    to fetch no matter how deep into the list it is, as long as an index
+    covers the sort order and its first column isn't a nullable one sorted
+    with NULLs last.
+
+    One more row than `limit` is selected so that the caller can tell whether
+    there is a next page.  See get_page.
+
+    @param id_column: a unique column such as the primary key.
+    @param cursor: a value previously returned by get_page, or None for the
+        first page.
+    @param limit: the page size, or None for no limit.
+    @return (select_query, order_by_dicts)
+    @raise ValueError if the cursor is not valid for this sort order.
+    """
+    order_by_dicts = get_order_by_dicts(order_by_query_vals, field_to_column_map)
+    order_by_dicts.append({
+        "field": "id",
+        "direction": "asc",
+        "column": id_column
+    })
+
+    if cursor is not None:
+        key = decode_cursor(cursor, order_by_dicts)
+        nulls_sort_low = select_query.session.get_bind().dialect.name in NULLS_SORT_LOW_DIALECTS
+
+        # (c1 at or after v1) AND ((c1 after v1) OR (c1 = v1 AND c2 after v2) OR ...)
+        # The first condition is redundant, but the DB can't seek an index
+        # to the rows the OR matches, only scan up to them.
+        first = order_by_dicts[0]
+        bound = _sorts_at_or_after(first['column'], first['direction'], key[0], nulls_sort_low)
+        if bound is not None:
+            select_query = select_query.filter(bound)
+        conditions = []
+        for i, order_by_dict in enumerate(order_by_dicts):
+            equal_prefix = [_sorts_equal(d['column'], v) for d, v in zip(order_by_dicts[:i], key[:i])]
+            after = _sorts_after(order_by_dict['column'], order_by_dict['direction'], key[i], nulls_sort_low)
+            conditions.append(and_(*equal_prefix, after))
+        select_query = select_query.filter(or_(*conditions))
+
+    select_query = _add_order_by_dicts(select_query, order_by_dicts)
+    if limit is not None:
+        select_query = select_query.limit(limit + 1)
+    return select_query, order_by_dicts
+
+def get_page(rows, order_by_dicts, limit=None):
+    """
+    Trims rows fetched by a query from add_keyset_pagination down to one page.
+
+    @return (rows, next_cursor) where next_cursor is None on the last page.
+    """
+    if limit is None or len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(order_by_dicts, rows[-1])
+
+
+############################# Conditional GETs ################################
+class NotModified(Exception):
+    """
+    Raised to answer a request with 304 Not Modified.  Register
+    not_modified_handler for it on the app.
+    """
+    def __init__(self, etag):
+        self.etag = etag
+
+async def not_modified_handler(request, exc):
+    return Response(status_code=304, headers={"ETag": exc.etag})
+
+def make_etag(*parts):
+    """ @return a strong ETag made out of the given parts. """
+    return '"{}"'.format("-".join(str(part) for part in parts))
+
+def etag_matches(etag, if_none_match):
+    """
+    @return whether etag matches an If-None-Match header value.  As the RFC
+        requires for If-None-Match, weak and strong tags compare equal.
+    """
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+################################# Fast JSON ###################################
+class FastJSONResponse(Response):
+    """
+    A JSONResponse for content which is already JSON-ready (e.g. from
+    pydanticutils.make_serializer), encoded with orjson when it is installed.
+    Gives exactly the same bytes as JSONResponse.
+    """
+    media_type = "application/json"
+
+    def render(self, content):
+        if orjson is not None:
+            return orjson.dumps(content)
+        return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None,
+                          separators=(",", ":")).encode("utf-8")
+
+
+############################## Streaming bodies ###############################
+async def iter_lines(byte_stream):
+    """
+    Splits an async stream of byte chunks, such as Request.stream(), into
+    lines without holding more than one line (plus one chunk) in memory.
+
+    @return an async generator of (line number, line bytes) for every line
+        which isn't blank.  Line numbers start at 1.
+    """
+    line_number = 0
+    remainder = b""
+    async for chunk in byte_stream:
+        lines = (remainder + chunk).split(b"\n")
+        remainder = lines.pop()
+        for line in lines:
+            line_number += 1
+            if line.strip():
+                yield line_number, line
+    if remainder.strip():
+        yield line_number + 1, remainder
@@ -0,0 +1,196 @@
+"""
+A Server-Sent Events feed of the writes to fetchers and schedules, for
+clients which would otherwise poll the lists to notice them.
+
+Each committed write (see changes.py) becomes one event per table and kind
+of write, e.g. `fetcher.create`, `fetcher.activate` or `schedule.delete`,
+whose data is the IDs of the rows written, or null when they aren't known (in
+which case the client should reload them all).  An event is formatted once
+and the same bytes are queued for every subscriber, so a commit costs one
+put_nowait per subscriber and no DB work at all.
+
+Backpressure: each subscriber's queue holds at most QUEUE_SIZE events.  A
+client which falls that far behind has its queue emptied and gets a `reset`
+event instead, telling it to reload everything, so that one slow client
+never holds up the others or makes the server buffer without end.
+
+Resuming: event IDs are "<changes.EPOCH>-<sequence number>", and the last
+BUFFER_SIZE events are kept, so a client which reconnects with a
+Last-Event-ID header gets the events it missed.  If they are no longer kept,
+or were sent by an earlier run of the server, it gets a `reset` instead.
+"""
+
+import asyncio
+import collections
+import json
+import threading
+
+import changes
+import models
+
+
+# The most events kept for clients which reconnect.
+BUFFER_SIZE = 1000
+# The most events queued for one client before it gets a reset instead.
+QUEUE_SIZE = 100
+# How often to send a comment down an idle stream, so that proxies keep it
+# open and a client which went away is noticed.
+HEARTBEAT_SECONDS = 15
+HEARTBEAT = b": heartbeat\n\n"
+# How long a client waits before reconnecting, in milliseconds.
+RETRY_MILLISECONDS = 3000
+
+EVENT_TABLES = {
+    models.Fetcher.__tablename__: "fetcher",
+    models.FetcherSchedule.__tablename__: "schedule",
+}
+EVENT_OPS = {"insert": "create"}
+
+
+def format_event(event_id, event, data):
+    """ @return the bytes of one SSE event. """
+    return "id: {}\nevent: {}\ndata: {}\n\n".format(event_id, event, json.dumps(data)).encode()
+
+def parse_event_id(event_id):
+    """ @return the sequence number of one of our event IDs, or None if it isn't one from this run. """
+    epoch, _, sequence = (event_id or "").partition("-")
+    if epoch != changes.EPOCH or not sequence.isdigit():
+        return None
+    return int(sequence)
+
+
+class Subscriber:
+    def __init__(self, queue_size, last_sequence):
+        self.queue = asyncio.Queue(queue_size)
+        # Events up to this one were sent some other way, or skipped.
+        self.last_sequence = last_sequence
+
+
+class ChangeFeed:
+    def __init__(self, buffer_size=BUFFER_SIZE, queue_size=QUEUE_SIZE, heartbeat_seconds=HEARTBEAT_SECONDS):
+        self._queue_size = queue_size
+        self._heartbeat_seconds = heartbeat_seconds
+        # Guards the buffer and sequence numbers, which commits on any thread
+        # add to.  Subscribers are only touched on the event loop.
+        self._lock = threading.Lock()
+        # (sequence, event bytes) of the latest events.
+        self._events = collections.deque(maxlen=buffer_size)
+        self._last_sequence = 0
+        self._subscribers = set()
+        # The event loop of the subscribers, and the task which sends their
+        # heartbeats, held only while there are any.  One task for every
+        # subscriber is much cheaper than a timeout on each one's wait.
+        self._loop = None
+        self._heartbeat_task = None
+
+    def get_subscriber_count(self):
+        return len(self._subscribers)
+
+    ########################### Publishing ###########################
+    def on_commit(self, committed_changes):
+        """ A changes.py listener which publishes the writes to fetchers and schedules. """
+        with self._lock:
+            events = []
+            for change in committed_changes:
+                table = EVENT_TABLES.get(change.table)
+                # e.g. the schedules of fetchers which had none being deleted.
+                if table is None or change.ids == frozenset():
+                    continue
+                self._last_sequence += 1
+                event = "{}.{}".format(table, EVENT_OPS.get(change.op, change.op))
+                data = {"ids": None if change.ids is None else sorted(change.ids)}
+                events.append((self._last_sequence, format_event(self.get_event_id(self._last_sequence),
+                                                                 event, data)))
+            if not events:
+                return
+            self._events.extend(events)
+            # Scheduled under the lock so that commits on different threads
+            # are fanned out in sequence order.
+            if self._loop is not None:
+                try:
+                    self._loop.call_soon_threadsafe(self._fan_out, events)
+                except RuntimeError:
+                    pass  # The loop has closed.
+
+    def get_event_id(self, sequence):
+        return "{}-{}".format(changes.EPOCH, sequence)
+
+    def _fan_out(self, events):
+        for subscriber in self._subscribers:
+            for sequence, message in events:
+                if sequence <= subscriber.last_sequence:
+                    continue
+                try:
+                    subscriber.queue.put_nowait(message)
+                except asyncio.QueueFull:
+                    self._reset(subscriber, events[-1][0])
+                    break
+                subscriber.last_sequence = sequence
+
+    def _reset(self, subscriber, sequence):
+        """ Replaces whatever the subscriber has queued with a reset as of event `sequence`. """
+        while not subscriber.queue.empty():
+            subscriber.queue.get_nowait()
+        subscriber.queue.put_nowait(format_event(self.get_event_id(sequence), "reset", {"ids": None}))
+        subscriber.last_sequence = sequence
+
+    ########################## Subscribing ###########################
+    def subscribe(self, last_event_id=None):
+        """
+        Registers a subscriber, which is first sent the events after
+        last_event_id (or a reset if they are gone), if it is given.  Call on
+        the event loop, and unsubscribe() when done.
+        """
+        with self._lock:
+            self._loop = asyncio.get_running_loop()
+            subscriber = Subscriber(self._queue_size, self._last_sequence)
+            if last_event_id is not None:
+                sequence = parse_event_id(last_event_id)
+                oldest = self._events[0][0] if self._events else self._last_sequence + 1
+                if sequence is None or sequence > self._last_sequence or sequence < oldest - 1:
+                    self._reset(subscriber, self._last_sequence)
+                else:
+                    missed = [message for event_sequence, message in self._events if event_sequence > sequence]
+                    if len(missed) > self._queue_size:
+                        self._reset(subscriber, self._last_sequence)
+                    else:
+                        for message in missed:
+                            subscriber.queue.put_nowait(message)
+            self._subscribers.add(subscriber)
+        if self._heartbeat_task is None:
+            self._heartbeat_task = asyncio.create_task(self._heartbeat_forever())
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+            if not self._subscribers:
+                self._loop = None
+        if not self._subscribers and self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
+
+    async def _heartbeat_forever(self):
+        while True:
+            await asyncio.sleep(self._heartbeat_seconds)
+            for subscriber in self._subscribers:
+                if subscriber.queue.empty():
+                    subscriber.queue.put_nowait(HEARTBEAT)
+
+    async def stream(self, last_event_id=None):
+        """ Yields the bytes of a subscriber's SSE stream until it is closed. """
+        subscriber = self.subscribe(last_event_id)
+        try:
+            yield "retry: {}\n\n".format(RETRY_MILLISECONDS).encode()
+            while True:
+                # Everything queued goes out in one write.
+                messages = [await subscriber.queue.get()]
+                while not subscriber.queue.empty():
+                    messages.append(subscriber.queue.get_nowait())
+                yield b"".join(messages)
+        finally:
+            self.unsubscribe(subscriber)
+
+
+fetcher_feed = ChangeFeed()
+changes.add_listener(fetcher_feed.on_commit)
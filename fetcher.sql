@@ -12,9 +12,46 @@ CREATE TABLE Fetchers (
   uidvalidkey   INTEGER DEFAULT NULL,          --  Last good UIDVALIDITY or UIDL
   timelimit     INTEGER DEFAULT 15,            --  Hard email-fetch time limit, in minutes.
   mailbox       TEXT NOT NULL DEFAULT 'inbox', --  mailbox to fetch from (not used for POP)
-  domains       TEXT                           --  domains expected from this fetcher
+  domains       TEXT,                          --  domains expected from this fetcher
+  rowversion    INTEGER NOT NULL DEFAULT 0,    --  SyncState version of the last insert or update
+  updatedat     TIMESTAMP                      --  Time of the last insert or update, in UTC
 );
 
+-- Each index ends in the fetcher list's default order (active desc, confname
+-- asc, then the fetcherid tiebreaker), so filtering on its leading column and
+-- sorting that way is one index scan with no sort step.
+CREATE INDEX ix_fetchers_active_confname ON Fetchers (active DESC, confname, fetcherid);
+CREATE INDEX ix_fetchers_protocol_active_confname ON Fetchers (protocol, active DESC, confname, fetcherid);
+CREATE INDEX ix_fetchers_server_active_confname ON Fetchers (server, active DESC, confname, fetcherid);
+
+-- Full-text search over confname, description, server and domains: an FTS5
+-- table over Fetchers (external content, so the text isn't stored twice)
+-- kept up to date by triggers, ranked by bm25 weighted towards the name and
+-- then the server and domains.  models.py creates the same objects.
+CREATE VIRTUAL TABLE FetcherSearch USING fts5(
+  confname, description, server, domains,
+  content='Fetchers', content_rowid='fetcherid', prefix='2 3'
+);
+INSERT INTO FetcherSearch(FetcherSearch, rank) VALUES ('rank', 'bm25(10.0, 1.0, 5.0, 5.0)');
+
+CREATE TRIGGER Fetchers_search_insert AFTER INSERT ON Fetchers BEGIN
+  INSERT INTO FetcherSearch(rowid, confname, description, server, domains)
+  VALUES (new.fetcherid, new.confname, new.description, new.server, new.domains);
+END;
+
+CREATE TRIGGER Fetchers_search_delete AFTER DELETE ON Fetchers BEGIN
+  INSERT INTO FetcherSearch(FetcherSearch, rowid, confname, description, server, domains)
+  VALUES ('delete', old.fetcherid, old.confname, old.description, old.server, old.domains);
+END;
+
+CREATE TRIGGER Fetchers_search_update AFTER UPDATE OF confname, description, server, domains
+    ON Fetchers BEGIN
+  INSERT INTO FetcherSearch(FetcherSearch, rowid, confname, description, server, domains)
+  VALUES ('delete', old.fetcherid, old.confname, old.description, old.server, old.domains);
+  INSERT INTO FetcherSearch(rowid, confname, description, server, domains)
+  VALUES (new.fetcherid, new.confname, new.description, new.server, new.domains);
+END;
+
 CREATE TABLE FetcherSchedules (
   fetcherscheduleid  INTEGER PRIMARY KEY AUTOINCREMENT,
   fetcherid       INTEGER NOT NULL
@@ -23,6 +60,87 @@ CREATE TABLE FetcherSchedules (
                       on update cascade,
   downtimedays    TEXT NOT NULL,  -- TODO: for Postgresql should be an Array type.
   downtimestart   TIME NOT NULL,
-  downtimeend     TIME NOT NULL
+  downtimeend     TIME NOT NULL,
+  rowversion      INTEGER NOT NULL DEFAULT 0,
+  updatedat       TIMESTAMP
+);
+
+-- For loading the schedules of a page of fetchers.
+CREATE INDEX ix_fetcherschedules_fetcherid ON FetcherSchedules (fetcherid);
+
+-- One row per domain in Fetchers.domains, lower cased, so that the fetchers of
+-- a domain can be looked up by index.  Kept in step with domains by crud.py.
+CREATE TABLE FetcherDomains (
+  domain          TEXT NOT NULL,
+  fetcherid       INTEGER NOT NULL
+                      references fetchers
+                      on delete cascade
+                      on update cascade,
+  PRIMARY KEY (domain, fetcherid)
+);
+
+CREATE INDEX ix_fetcherdomains_fetcherid ON FetcherDomains (fetcherid);
+
+-- Row versions: every insert into or update of Fetchers and FetcherSchedules
+-- takes the next SyncState version as the row's rowversion, and every delete
+-- takes one for a row in Tombstones, so that clients can ask for just what
+-- changed since the version they last saw.  models.py creates the same objects.
+CREATE TABLE SyncState (
+  version         INTEGER NOT NULL,  -- The last version handed out
+  purgedversion   INTEGER NOT NULL   -- Tombstones up to this version have been purged
+);
+INSERT INTO SyncState (version, purgedversion) VALUES (0, 0);
+
+CREATE TABLE Tombstones (
+  tablename       TEXT NOT NULL,     -- fetchers or fetcherschedules
+  id              INTEGER NOT NULL,  -- The deleted row's primary key
+  rowversion      INTEGER NOT NULL,
+  deletedat       TIMESTAMP NOT NULL,
+  PRIMARY KEY (tablename, id)
 );
 
+CREATE INDEX ix_fetchers_rowversion ON Fetchers (rowversion);
+CREATE INDEX ix_fetcherschedules_rowversion ON FetcherSchedules (rowversion);
+CREATE INDEX ix_tombstones_rowversion ON Tombstones (rowversion);
+
+CREATE TRIGGER Fetchers_version_insert AFTER INSERT ON Fetchers BEGIN
+  UPDATE SyncState SET version = version + 1;
+  UPDATE Fetchers SET rowversion = (SELECT version FROM SyncState), updatedat = CURRENT_TIMESTAMP
+  WHERE fetcherid = new.fetcherid;
+  DELETE FROM Tombstones WHERE tablename = 'fetchers' AND id = new.fetcherid;
+END;
+
+-- Skips the UPDATEs made by the version triggers, which change rowversion.
+CREATE TRIGGER Fetchers_version_update AFTER UPDATE ON Fetchers
+    WHEN new.rowversion IS old.rowversion BEGIN
+  UPDATE SyncState SET version = version + 1;
+  UPDATE Fetchers SET rowversion = (SELECT version FROM SyncState), updatedat = CURRENT_TIMESTAMP
+  WHERE fetcherid = new.fetcherid;
+END;
+
+CREATE TRIGGER Fetchers_version_delete AFTER DELETE ON Fetchers BEGIN
+  UPDATE SyncState SET version = version + 1;
+  INSERT OR REPLACE INTO Tombstones (tablename, id, rowversion, deletedat)
+  VALUES ('fetchers', old.fetcherid, (SELECT version FROM SyncState), CURRENT_TIMESTAMP);
+END;
+
+CREATE TRIGGER FetcherSchedules_version_insert AFTER INSERT ON FetcherSchedules BEGIN
+  UPDATE SyncState SET version = version + 1;
+  UPDATE FetcherSchedules SET rowversion = (SELECT version FROM SyncState), updatedat = CURRENT_TIMESTAMP
+  WHERE fetcherscheduleid = new.fetcherscheduleid;
+  DELETE FROM Tombstones WHERE tablename = 'fetcherschedules' AND id = new.fetcherscheduleid;
+END;
+
+-- Skips the UPDATEs made by the version triggers, which change rowversion.
+CREATE TRIGGER FetcherSchedules_version_update AFTER UPDATE ON FetcherSchedules
+    WHEN new.rowversion IS old.rowversion BEGIN
+  UPDATE SyncState SET version = version + 1;
+  UPDATE FetcherSchedules SET rowversion = (SELECT version FROM SyncState), updatedat = CURRENT_TIMESTAMP
+  WHERE fetcherscheduleid = new.fetcherscheduleid;
+END;
+
+CREATE TRIGGER FetcherSchedules_version_delete AFTER DELETE ON FetcherSchedules BEGIN
+  UPDATE SyncState SET version = version + 1;
+  INSERT OR REPLACE INTO Tombstones (tablename, id, rowversion, deletedat)
+  VALUES ('fetcherschedules', old.fetcherscheduleid, (SELECT version FROM SyncState), CURRENT_TIMESTAMP);
+END;
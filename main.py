@@ -3,18 +3,55 @@ Visit http://localhost:8000/docs/ to see API documentation and to test running
 the API calls.
 """
 
-from fastapi import FastAPI, HTTPException, Depends, status, Response
+import datetime
+import zlib
+
+from fastapi import FastAPI, HTTPException, Depends, Header, status, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm  import Session
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from sqlalchemy.exc import NoResultFound
-
+import pydantic
+
+import bus
+import capture
+import changes
+import crud
+import metrics
+import downtime
 import schemas
 import sqlalchemy
+import sweeper
 import models
-from database import get_db_session
+import database
+from feed import fetcher_feed
+from supervisor import fetcher_supervisor
+from database import AnySession, get_db_session, get_async_db_session, run_db, stream_partitions
+from pydanticutils import get_field_names
+from fastapiutils import NEXT_CURSOR_HEADER, FastJSONResponse, NotModified, not_modified_handler, make_etag, etag_matches, iter_lines
 
 app = FastAPI()
 
+# Every route gets its session from get_db.  See database.USE_ASYNC.
+get_db = get_async_db_session if database.USE_ASYNC else get_db_session
+
+# When True, the GET routes which list or read fetchers and schedules build
+# their JSON straight from the ORM objects (see pydanticutils.make_serializer)
+# and skip the response_model validation, which they would otherwise do twice.
+# The JSON is byte for byte the same either way.
+USE_FAST_JSON = False
+
+def fast_json_response(response, content, as_dicts=None):
+    """
+    @param response: the route's Response, whose headers (e.g. the ETag) are
+        kept.
+    @param as_dicts: whether content was built as dicts for the fast path.
+        Defaults to USE_FAST_JSON.
+    @return content as is, or as a FastJSONResponse when as_dicts.
+    """
+    if USE_FAST_JSON if as_dicts is None else as_dicts:
+        return FastJSONResponse(content, headers=response.headers)
+    return content
+
 # Cross-origin resource sharing: allow requests from other hosts & ports
 origins = [
     "http://localhost:4200"  # Our Angular POC port
@@ -25,112 +62,87 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER, "ETag"],
 )
 
+app.add_exception_handler(NotModified, not_modified_handler)
+
+# Records the requests served, for replay.py, when capture.CAPTURE_PATH is set.
+app.add_middleware(capture.CaptureMiddleware)
+
+# Request and DB query metrics, served at GET /metrics (see metrics.py).
+# Added last so that it times the other middleware too.
+app.add_middleware(metrics.MetricsMiddleware)
+metrics.instrument_engines()
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def get_metrics():
+    return PlainTextResponse(metrics.render_metrics(), media_type="text/plain; version=0.0.4")
+
+# The supervisor runs the active fetchers in the background for as long as
+# the app is up, if database.USE_SUPERVISOR is set (see supervisor.py), the
+# sweeper deletes orphaned rows (see
+# sweeper.py), and the bus hears of other workers' writes (see bus.py).
+@app.on_event("startup")
+async def start_background_tasks():
+    await bus.start()
+    if database.USE_SUPERVISOR:
+        await fetcher_supervisor.start()
+    await sweeper.start()
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    await sweeper.stop()
+    await fetcher_supervisor.stop()
+    await bus.stop()
+
+FETCHER_TABLES = (models.Fetcher.__tablename__, models.FetcherSchedule.__tablename__)
+SCHEDULE_TABLES = (models.FetcherSchedule.__tablename__,)
+# The orphan sweep (see sweeper.py) writes just the domains.
+DOMAIN_TABLES = FETCHER_TABLES + (models.FetcherDomain.__tablename__,)
+# Purging tombstones (see sweeper.py) turns an old token's 200 into a 410.
+CHANGES_TABLES = FETCHER_TABLES + (models.Tombstone.__tablename__, models.sync_state.name)
+
+def conditional_get(tables):
+    """
+    @return a route dependency which gives the response a strong ETag made
+        from the versions of `tables` (see changes.py) and answers 304 Not
+        Modified when the request's If-None-Match already has that ETag.
+
+    Use it in the route decorator's `dependencies` so it runs before the
+    route's DB session dependency: a 304 never touches the DB.
+    """
+    async def check_etag(request: Request, response: Response):
+        url_hash = zlib.crc32("{}?{}".format(request.url.path, request.url.query).encode())
+        etag = make_etag(changes.EPOCH, *changes.get_versions(*tables), "{:08x}".format(url_hash))
+        if etag_matches(etag, request.headers.get("If-None-Match")):
+            raise NotModified(etag)
+        response.headers["ETag"] = etag
+    return check_etag
+
 ################################## Fetchers ###################################
 # Create a new fetcher
 @app.post("/fetcher/", status_code=status.HTTP_201_CREATED, response_model=schemas.FetcherRead)
-def create_fetcher(fetcher: schemas.FetcherCreate, db: Session = Depends(get_db_session)):
-    new_fetcher = models.Fetcher(
-        confname = fetcher.confname,
-        server = fetcher.server,
-        description = fetcher.description,
-        userid = fetcher.userid,
-        password = fetcher.password,
-        protocol = fetcher.protocol,
-        port = fetcher.port,
-        quickdelete = fetcher.quickdelete,
-        active = fetcher.active,
-        timelimit = fetcher.timelimit,
-        mailbox = fetcher.mailbox,
-        domains = fetcher.domains,
-    )
-    # db.add(new_fetcher)
-    # db.commit()
-    # db.refresh(new_fetcher)
-    # return schemas.FetcherRead.from_orm(new_fetcher)
+async def create_fetcher(fetcher: schemas.FetcherCreate, db: AnySession = Depends(get_db)):
     try:
-        db.add(new_fetcher)
-        db.commit()
-        db.refresh(new_fetcher)
-        return schemas.FetcherRead.from_orm(new_fetcher)
+        return await run_db(db, crud.create_fetcher, fetcher)
     except sqlalchemy.exc.IntegrityError as exc:
-        if 'confname' in str(exc):
-            raise HTTPException(status_code=500,
-                detail="Configuration name '{}' is already used by another fetcher.".format(fetcher.confname))
+        raise HTTPException(status_code=500,
+                            detail=crud.describe_integrity_error(exc, schemas.FetcherCreate, fetcher))
 
-# Update an existing fetcher
-@app.put("/fetcher/{fetcherid}/")
-def update_fetcher(fetcherid: int, fetcher: schemas.FetcherCreate, db: Session = Depends(get_db_session)):
-    fetcher_query = db.query(models.Fetcher).filter(models.Fetcher.fetcherid == fetcherid)
-    try:
-        existing_fetcher = fetcher_query.one()
-    except NoResultFound:
-        raise HTTPException(status_code = status.HTTP_404_NOT_FOUND,
-                            detail="Fetcher with ID {} was not found.".format(fetcherid))
-
-    existing_fetcher.confname = fetcher.confname
-    existing_fetcher.server = fetcher.server
-    existing_fetcher.description = fetcher.description
-    existing_fetcher.userid = fetcher.userid
-    existing_fetcher.password = fetcher.password
-    existing_fetcher.protocol = fetcher.protocol
-    existing_fetcher.port = fetcher.port
-    existing_fetcher.quickdelete = fetcher.quickdelete
-    existing_fetcher.active = fetcher.active
-    existing_fetcher.timelimit = fetcher.timelimit
-    existing_fetcher.mailbox = fetcher.mailbox
-    existing_fetcher.domains = fetcher.domains
-    #fetcher_query.update(dict(fetcher))
-    db.add(existing_fetcher)
-    db.commit()
-    db.refresh(existing_fetcher)
-    return schemas.FetcherRead.from_orm(existing_fetcher)
-
-# Partially update an existing fetcher
-@app.patch("/fetcher/{fetcherid}/")
-def update_fetcher(fetcherid: int, fetcher: schemas.FetcherPatch, db: Session = Depends(get_db_session)):
-    fetcher_query = db.query(models.Fetcher).filter(models.Fetcher.fetcherid == fetcherid)
-    try:
-        existing_fetcher = fetcher_query.one()
-    except NoResultFound:
-        raise HTTPException(status_code = status.HTTP_404_NOT_FOUND,
-                            detail="Fetcher with ID {} was not found.".format(fetcherid))
 
-    if fetcher.confname is not None:
-        existing_fetcher.confname = fetcher.confname
-    if fetcher.server is not None:
-        existing_fetcher.server = fetcher.server
-    if fetcher.description is not None:
-        existing_fetcher.description = fetcher.description
-    if fetcher.userid is not None:
-        existing_fetcher.userid = fetcher.userid
-    if fetcher.password is not None:
-        existing_fetcher.password = fetcher.password
-    if fetcher.protocol is not None:
-        existing_fetcher.protocol = fetcher.protocol
-    if fetcher.port is not None:
-        existing_fetcher.port = fetcher.port
-    if fetcher.quickdelete is not None:
-        existing_fetcher.quickdelete = fetcher.quickdelete
-    if fetcher.active is not None:
-        existing_fetcher.active = fetcher.active
-    if fetcher.timelimit is not None:
-        existing_fetcher.timelimit = fetcher.timelimit
-    if fetcher.mailbox is not None:
-        existing_fetcher.mailbox = fetcher.mailbox
-    if fetcher.domains is not None:
-        existing_fetcher.domains = fetcher.domains
-
-    db.add(existing_fetcher)
-    db.commit()
-    db.refresh(existing_fetcher)
-    return schemas.FetcherRead.from_orm(existing_fetcher)
-
-
-# TODO: eventually move this and query param definition to fastapiutils
+# TODO: eventually move this query param definition to fastapiutils
 from enum import Enum
 from fastapi import Query
+
+LIMIT_QUERY = Query(default=None, ge=1, le=1000,
+    description=("The maximum number of items to return.  If there are more, "
+        "the response has an `{}` header which can be passed back as "
+        "`cursor` to get the next page.  Returns every item when not given.".format(NEXT_CURSOR_HEADER)))
+CURSOR_QUERY = Query(default=None,
+    description=("Opaque value from the `{}` header of the previous page.  "
+        "Must be used with the same `order_by` as that page.".format(NEXT_CURSOR_HEADER)))
+
 class FetcherOrderEnum(str, Enum):
     name      = "name"
     name_asc  = "name asc"
@@ -145,70 +157,89 @@ class FetcherOrderEnum(str, Enum):
     active_asc  = "active asc"
     active_desc = "active desc"
 
-def get_order_by_dicts(order_by_query_vals, field_to_column_map):
-    order_by_dicts = []
-    for order_by_val in order_by_query_vals:
-        try:
-            order_by_val = order_by_val.value  # extract the string from an enum value.
-        except AttributeError:
-            pass  # assume order_by_val is already a string.
+class FetcherExpandEnum(str, Enum):
+    schedules = "schedules"
+    none      = "none"
 
-        try:
-            field, direction = order_by_val.rsplit(" ", 1)
-        except ValueError:
-            field = order_by_val
-            direction = "asc"
+EXPAND_QUERY = Query(default=None,
+    description=("Related items to include in each fetcher.  Defaults to "
+        "`schedules`.  Use `?expand=none` to leave them out, in which case "
+        "`schedules` is null and they are not loaded from the DB at all."))
 
-        if direction not in ["asc", "desc"]:
-            raise ValueError("Direction must be asc or desc, but it was {} instead.".format(direction))
+def expands_schedules(expand):
+    return expand is None or FetcherExpandEnum.schedules in expand
+
+# The names of the fields of a fetcher, as the API shows them.
+FetcherFieldEnum = Enum("FetcherFieldEnum",
+    {field.alias: field.alias for field in schemas.FetcherRead.__fields__.values()}, type=str)
+
+FIELDS_QUERY = Query(default=None,
+    description=("The only fields to include in each fetcher, e.g. "
+        "`?fields=name&fields=server`.  Only their columns are read from the "
+        "DB, and schedules are only loaded if `schedules` is one of them.  "
+        "Defaults to every field."))
+
+def get_fetcher_fields(fields):
+    """ @return the FetcherRead field names of a `fields` query value, or None for every field. """
+    if fields is None:
+        return None
+    return get_field_names(schemas.FetcherRead, {field.value for field in fields})
+
+# Update an existing fetcher
+@app.put("/fetcher/{fetcherid}/")
+async def update_fetcher(fetcherid: int, fetcher: schemas.FetcherCreate, db: AnySession = Depends(get_db),
+        expand: list[FetcherExpandEnum] | None = EXPAND_QUERY):
+    try:
+        return await run_db(db, crud.update_fetcher, fetcherid, fetcher, expands_schedules(expand))
+    except NoResultFound:
+        raise HTTPException(status_code = status.HTTP_404_NOT_FOUND,
+                            detail="Fetcher with ID {} was not found.".format(fetcherid))
+    except sqlalchemy.exc.IntegrityError as exc:
+        raise HTTPException(status_code=500,
+                            detail=crud.describe_integrity_error(exc, schemas.FetcherCreate, fetcher))
+
+# Partially update an existing fetcher
+@app.patch("/fetcher/{fetcherid}/")
+async def update_fetcher(fetcherid: int, fetcher: schemas.FetcherPatch, db: AnySession = Depends(get_db),
+        expand: list[FetcherExpandEnum] | None = EXPAND_QUERY):
+    try:
+        return await run_db(db, crud.patch_fetcher, fetcherid, fetcher, expands_schedules(expand))
+    except NoResultFound:
+        raise HTTPException(status_code = status.HTTP_404_NOT_FOUND,
+                            detail="Fetcher with ID {} was not found.".format(fetcherid))
+    except sqlalchemy.exc.IntegrityError as exc:
+        raise HTTPException(status_code=500,
+                            detail=crud.describe_integrity_error(exc, schemas.FetcherCreate, fetcher))
+
+ACTIVE_QUERY = Query(default=None, description="Only list fetchers which are (or aren't) active.")
+PROTOCOL_QUERY = Query(default=None, description="Only list fetchers with this protocol, e.g. `IMAP4`.")
+SERVER_QUERY = Query(default=None, description="Only list fetchers of exactly this server.")
+SERVER_PREFIX_QUERY = Query(default=None,
+    description="Only list fetchers whose server starts with this (case sensitive).")
+NAME_PREFIX_QUERY = Query(default=None,
+    description="Only list fetchers whose name starts with this (case sensitive).")
 
-        try:
-            column = field_to_column_map[field]
-        except KeyError:
-            raise ValueError("The field {} has no column mapping".format(field))
-
-        order_by_dict = {
-            "field": field,
-            "direction": direction,
-            "column": column
-        }
-        order_by_dicts.append(order_by_dict)
-    return order_by_dicts
-
-def add_order_by_clause(select_query, order_by_query_vals, field_to_column_map):
-    """
-    Takes an existing select_query and adds an order_by clause to it based on
-    the passed in order_by_query_vals and field_to_column_map.
-
-    @param order_by_query_vals: A list as returned by a FastAPI query param
-        Example: ["name asc", "active desc", "protocol"]
-    @param field_to_column_map: a dictionary that maps field names to table
-        columns.
-        Example: {
-            "name": models.Fetcher.confname,
-            "active": models.Fetcher.active
-        }
-    """
-    order_by_dicts = get_order_by_dicts(order_by_query_vals, field_to_column_map)
-    order_list = []
-    for order_by_dict in order_by_dicts:
-        if order_by_dict['direction'] == 'desc':
-            select_query = select_query.order_by(order_by_dict['column'].desc())
-        else:
-            select_query = select_query.order_by(order_by_dict['column'].asc())
-    return select_query
-# End code to move to fastapiutils, but include a factory to create the Query below.
 
 # Get all fetchers
-@app.get("/fetcher/", response_model=list[schemas.FetcherRead])
-def retrieve_fetchers(db: Session = Depends(get_db_session),
+@app.get("/fetcher/", response_model=list[schemas.FetcherRead],
+         dependencies=[Depends(conditional_get(FETCHER_TABLES))])
+async def retrieve_fetchers(response: Response, db: AnySession = Depends(get_db),
         order_by: list[FetcherOrderEnum] | None = Query(
             default=None,
             description=("Specifies which fields to sort the fetcher list by "
                 "and whether to sort in ascending or descending orders.  "
                 "Allowed sortable fields are 'name', 'server', 'protocol', and 'active'.  "
                 "If sort order is not specified it is assumed to be ascending."
-                "Example: `?order_by=active asc, name desc`"))):
+                "Example: `?order_by=active asc, name desc`")),
+        limit: int | None = LIMIT_QUERY,
+        cursor: str | None = CURSOR_QUERY,
+        expand: list[FetcherExpandEnum] | None = EXPAND_QUERY,
+        active: bool | None = ACTIVE_QUERY,
+        protocol: str | None = PROTOCOL_QUERY,
+        server: str | None = SERVER_QUERY,
+        server_prefix: str | None = SERVER_PREFIX_QUERY,
+        name_prefix: str | None = NAME_PREFIX_QUERY,
+        fields: list[FetcherFieldEnum] | None = FIELDS_QUERY):
 
     if order_by is None:
         order_by = ["active desc", "name asc"]
@@ -219,49 +250,282 @@ def retrieve_fetchers(db: Session = Depends(get_db_session),
         "protocol": models.Fetcher.protocol,
         "active": models.Fetcher.active
     }
-    fetcher_query = db.query(models.Fetcher)
-    fetcher_query = add_order_by_clause(fetcher_query, order_by, field_to_column_map)
-    fetchers = fetcher_query.all()
-    fetcher_schemas = [schemas.FetcherRead.from_orm(fetcher) for fetcher in fetchers]
-    return fetcher_schemas
+    # A fetcher with only some of its fields can't go through response_model.
+    as_dicts = USE_FAST_JSON or fields is not None
+    try:
+        fetcher_schemas, next_cursor = await run_db(db, crud.retrieve_fetchers, order_by,
+            field_to_column_map, limit, cursor, expands_schedules(expand),
+            crud.get_fetcher_filters(active, protocol, server, server_prefix, name_prefix), as_dicts,
+            get_fetcher_fields(fields))
+    except ValueError as exc:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(exc))
+
+    if next_cursor is not None:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+    return fast_json_response(response, fetcher_schemas, as_dicts)
 
 # Get a specific fetcher
-@app.get("/fetcher/{fetcherid}/", response_model=schemas.FetcherRead)
-def retrieve_fetcher(fetcherid: int, db: Session = Depends(get_db_session)):
+@app.get("/fetcher/{fetcherid}/", response_model=schemas.FetcherRead,
+         dependencies=[Depends(conditional_get(FETCHER_TABLES))])
+async def retrieve_fetcher(fetcherid: int, response: Response, db: AnySession = Depends(get_db),
+        expand: list[FetcherExpandEnum] | None = EXPAND_QUERY,
+        fields: list[FetcherFieldEnum] | None = FIELDS_QUERY):
+    as_dicts = USE_FAST_JSON or fields is not None
     try:
-        fetcher = db.query(models.Fetcher).filter(models.Fetcher.fetcherid == fetcherid).one()
+        return fast_json_response(response, await run_db(db, crud.retrieve_fetcher, fetcherid,
+            expands_schedules(expand), as_dicts, get_fetcher_fields(fields)), as_dicts)
     except NoResultFound:
         raise HTTPException(status_code = status.HTTP_404_NOT_FOUND,
                             detail="Fetcher with ID {} was not found.".format(fetcherid))
-    return schemas.FetcherRead.from_orm(fetcher)
 
-# Restart a fetcher
-@app.post("/fetcher/{fetcherid}:restart/", description="Restarts a fetcher if it is running, else noop.")
-def restart_fetcher(fetcherid: int, db: Session = Depends(get_db_session)):
+SEARCH_LIMIT_QUERY = Query(default=50, ge=1, le=1000, description="The maximum number of fetchers to return.")
+
+# Search fetchers
+@app.get("/fetcher:search/", response_model=list[schemas.FetcherRead],
+         dependencies=[Depends(conditional_get(FETCHER_TABLES))], description="""
+    Lists the fetchers which have every word of `q` at the start of a word in
+    their name, description, server or domains, best match first.  A match in
+    the name counts most, then in the server or domains.
+
+    Example: `?q=journal intra` finds a fetcher described as "Fetch from
+    Intradyns journaling mailbox".
+    """)
+async def search_fetchers(response: Response, q: str = Query(..., description="The words to search for."),
+        limit: int = SEARCH_LIMIT_QUERY, db: AnySession = Depends(get_db),
+        expand: list[FetcherExpandEnum] | None = EXPAND_QUERY):
+    return fast_json_response(response, await run_db(db, crud.search_fetchers, q, limit,
+                                                     expands_schedules(expand), USE_FAST_JSON))
+
+# How many fetchers the export reads from the DB (and writes out) at a time.
+EXPORT_BATCH_SIZE = 500
+
+# Export every fetcher
+@app.get("/fetcher:export/", response_class=StreamingResponse,
+    responses={200: {"content": {"application/x-ndjson": {}}}}, description="""
+    Streams every fetcher, with its schedules, as newline-delimited JSON: one
+    fetcher per line in the same format as GET /fetcher/{fetcherid}/, in ID
+    order.
+
+    Rows are read from the DB in batches as the response is sent, so the
+    export starts right away and memory use doesn't grow with the number of
+    fetchers.
+    """)
+async def export_fetchers(db: AnySession = Depends(get_db)):
+    async def export_lines():
+        async for fetchers in stream_partitions(db, crud.get_fetcher_export_statement(), EXPORT_BATCH_SIZE):
+            yield crud.get_fetcher_export_lines(fetchers)
+
+    return StreamingResponse(export_lines(), media_type="application/x-ndjson")
+
+# Import fetchers
+@app.post("/fetcher:import/", response_model=schemas.ImportSummary, openapi_extra={
+    "requestBody": {"content": {"application/x-ndjson": {"schema": {"type": "string"}}}}}, description="""
+    Creates fetchers from a newline-delimited JSON request body: one fetcher
+    per line in the format POST /fetcher/ takes.  (Extra fields are ignored,
+    so the output of GET /fetcher:export/ can be imported as-is.)
+
+    The body is read and validated a line at a time and committed every
+    `chunk_size` fetchers, so it can be arbitrarily large.  A line which is
+    not valid, or whose name is already used when `upsert` is false, is
+    rejected without stopping the import.
+
+    Returns how many fetchers were inserted and updated, and the line numbers
+    of the rejected lines.
+    """)
+async def import_fetchers(request: Request, db: AnySession = Depends(get_db),
+        chunk_size: int = Query(default=500, ge=1, le=10000,
+            description="How many fetchers to insert per transaction."),
+        upsert: bool = Query(default=False,
+            description="Replace fetchers whose name is already used instead of rejecting them.")):
+    summary = schemas.ImportSummary()
+
+    async def import_chunk(numbered_fetchers):
+        inserted, updated, rejected_lines = await run_db(db, crud.import_fetchers, numbered_fetchers, upsert)
+        summary.inserted += inserted
+        summary.updated += updated
+        summary.rejected_lines += rejected_lines
+
+    numbered_fetchers = []
+    async for line_number, line in iter_lines(request.stream()):
+        try:
+            numbered_fetchers.append((line_number, schemas.FetcherCreate.parse_raw(line)))
+        except pydantic.ValidationError as exc:
+            detail = "; ".join("{}: {}".format(".".join(str(loc) for loc in error['loc']), error['msg'])
+                               for error in exc.errors())
+            summary.rejected_lines.append(schemas.ImportRejectedLine(line=line_number, detail=detail))
+        if len(numbered_fetchers) >= chunk_size:
+            await import_chunk(numbered_fetchers)
+            numbered_fetchers = []
+    if numbered_fetchers:
+        await import_chunk(numbered_fetchers)
+
+    summary.rejected_lines.sort(key=lambda rejected_line: rejected_line.line)
+    summary.rejected = len(summary.rejected_lines)
+    return summary
+
+AT_QUERY = Query(default=None,
+    description=("The time to check, e.g. `2024-01-06T23:30:00` (server local time) or "
+        "`2024-01-06T23:30:00+00:00`.  Defaults to now."))
+
+# Get the fetchers which are in downtime
+@app.get("/fetcher:inDowntime/", response_model=schemas.BatchFetcherIds, description="""
+    Lists the IDs of the fetchers whose schedules put them in downtime at the
+    given time.
+    """)
+async def retrieve_fetchers_in_downtime(at: datetime.datetime | None = AT_QUERY,
+        db: AnySession = Depends(get_db)):
+    return await run_db(db, crud.get_fetchers_in_downtime, downtime.to_local_time(at))
+
+# Get the fetchers which can run
+@app.get("/fetcher:runnable/", response_model=schemas.BatchFetcherIds, description="""
+    Lists the IDs of the active fetchers which are not in downtime at the
+    given time.
+    """)
+async def retrieve_runnable_fetchers(at: datetime.datetime | None = AT_QUERY,
+        db: AnySession = Depends(get_db)):
+    return await run_db(db, crud.get_runnable_fetchers, downtime.to_local_time(at))
+
+# Get the changes since a token
+@app.get("/fetcher:changes/", response_model=schemas.FetcherChanges,
+         dependencies=[Depends(conditional_get(CHANGES_TABLES))], description="""
+    Lists the fetchers and schedules which were inserted, updated or deleted
+    since `since`, for clients which keep their own copy of them.  Start with
+    `?since=0` to get every fetcher and schedule, and then pass the `token`
+    of each response as the next `since`.
+
+    A `since` which is too old to have its deletes kept (see sweeper.py) is a
+    410, after which the client has to start over from `?since=0`.
+    """)
+async def retrieve_changes(since: int = Query(..., ge=0, description="The `token` of the last changes."),
+        limit: int | None = Query(default=None, ge=1, le=10000,
+            description="The most changes to return.  If there are more, `more` is true."),
+        db: AnySession = Depends(get_db)):
+    try:
+        return await run_db(db, crud.retrieve_changes, since, limit)
+    except crud.ChangesPurged as exc:
+        raise HTTPException(status_code=status.HTTP_410_GONE, detail=str(exc))
+
+# Watch for changes
+@app.get("/fetcher:watch/", response_class=StreamingResponse, description="""
+    A Server-Sent Events stream with an event for every committed write to
+    fetchers and schedules, such as `fetcher.create`, `fetcher.update`,
+    `fetcher.delete`, `fetcher.activate`, `fetcher.deactivate` and
+    `schedule.create`.  Its data is `{"ids": [...]}`, the IDs of the rows
+    written, or `{"ids": null}` when they aren't known.
+
+    A client which reconnects with a `Last-Event-ID` header (as EventSource
+    does) gets the events it missed.  A `reset` event means events were
+    missed which can't be sent: reload everything.
+    """)
+async def watch_fetchers(last_event_id: str | None = Header(default=None)):
+    return StreamingResponse(fetcher_feed.stream(last_event_id), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+SUBDOMAINS_QUERY = Query(default=True,
+    description=("When true, a domain which no fetcher lists is matched to the fetchers "
+        "of its closest parent domain, e.g. `mail.example.com` to those of `example.com`."))
+
+# Find the fetchers of a domain
+@app.get("/fetcher:byDomain/", response_model=schemas.FetcherDomainMatch,
+         dependencies=[Depends(conditional_get(DOMAIN_TABLES))], description="""
+    Finds the fetchers which list a domain in their `domains`, e.g. to route an
+    incoming message to its fetcher.  Domains are matched case insensitively.
+    """)
+async def retrieve_fetchers_by_domain(domain: str = Query(..., description="e.g. `mail.example.com`"),
+        subdomains: bool = SUBDOMAINS_QUERY, db: AnySession = Depends(get_db)):
+    matches = await run_db(db, crud.find_fetchers_by_domains, [domain], subdomains)
+    return matches[0]
+
+async def get_fetcher_or_404(db, fetcherid):
+    """ Reads the fetcher from the DB, not the cache, as the caller acts on it. """
     try:
-        fetcher = db.query(models.Fetcher).filter(models.Fetcher.fetcherid == fetcherid).one()
+        return await run_db(db, crud.retrieve_fetcher, fetcherid, with_schedules=False, cached=False)
     except NoResultFound:
         raise HTTPException(status_code = status.HTTP_404_NOT_FOUND,
                             detail="Fetcher with ID {} was not found.".format(fetcherid))
 
+# Start a fetcher
+@app.post("/fetcher/{fetcherid}:start/", description="""
+    Starts a run of an active fetcher now, rather than when it is next due.
+    A run which comes up while the fetcher is in downtime is skipped.
+    """)
+async def start_fetcher(fetcherid: int, db: AnySession = Depends(get_db)):
+    fetcher = await get_fetcher_or_404(db, fetcherid)
+    if not fetcher_supervisor.is_started():
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="The fetcher supervisor is not running.")
+    if not fetcher.active:
+        return "Fetcher '{}' is not active, so it was not started.".format(fetcher.confname)
+    if not fetcher_supervisor.start_fetcher(fetcher):
+        return "Fetcher '{}' is already running.".format(fetcher.confname)
+    return "Successfully started fetcher '{}'.".format(fetcher.confname)
+
+# Stop a fetcher
+@app.post("/fetcher/{fetcherid}:stop/", description="""
+    Stops a fetcher's run if it is running, else noop.  It runs again when it
+    is next due.
+    """)
+async def stop_fetcher(fetcherid: int, db: AnySession = Depends(get_db)):
+    fetcher = await get_fetcher_or_404(db, fetcherid)
+    if not await fetcher_supervisor.stop_fetcher(fetcherid):
+        return "Fetcher '{}' is not running.".format(fetcher.confname)
+    return "Successfully stopped fetcher '{}'.".format(fetcher.confname)
+
+# Restart a fetcher
+@app.post("/fetcher/{fetcherid}:restart/", description="Restarts a fetcher if it is running, else noop.")
+async def restart_fetcher(fetcherid: int, db: AnySession = Depends(get_db)):
+    fetcher = await get_fetcher_or_404(db, fetcherid)
+    if not fetcher.active or not await fetcher_supervisor.restart_fetcher(fetcher):
+        return "Fetcher '{}' is not running, so it was not restarted.".format(fetcher.confname)
     return "Successfully restarted fetcher '{}'.".format(fetcher.confname)
 
 # Delete a fetcher
 @app.delete("/fetcher/{fetcherid}/", response_model=schemas.FetcherRead)
-def delete_fetcher(fetcherid: int, db: Session = Depends(get_db_session)):
+async def delete_fetcher(fetcherid: int, db: AnySession = Depends(get_db),
+        expand: list[FetcherExpandEnum] | None = EXPAND_QUERY):
     try:
-        fetcher = db.query(models.Fetcher).filter(models.Fetcher.fetcherid == fetcherid).one()
+        deletable_fetcher = await run_db(db, crud.delete_fetcher, fetcherid, expands_schedules(expand))
     except NoResultFound:
         raise HTTPException(status_code = status.HTTP_404_NOT_FOUND,
                             detail="Fetcher with ID {} was not found.".format(fetcherid))
 
-    deletable_fetcher = schemas.FetcherRead.from_orm(fetcher)
-    db.query(models.Fetcher).filter(models.Fetcher.fetcherid == fetcherid).delete()
-    db.commit()
     return deletable_fetcher  # to show the API user what was deleted for success messages & such.
 
 
 ##################### Customer Batch Fetcher Operations #######################
+PARTIAL_QUERY = Query(default=False,
+    description=("When false, any invalid item (such as a duplicate name) fails "
+        "the whole batch and nothing is created.  When true, the valid items are "
+        "created and the invalid ones are listed in `errors`."))
+
+# a batch operation call for creating fetchers.
+@app.post("/fetcher:batchCreate/", status_code=status.HTTP_201_CREATED,
+    response_model=schemas.BatchCreateResult, description="""
+    Creates many fetchers in one transaction.
+
+    Returns the new ID of each fetcher, in the same order as the request body.
+    """)
+async def batch_create_fetchers(fetchers: list[schemas.FetcherCreate],
+        partial: bool = PARTIAL_QUERY, db: AnySession = Depends(get_db)):
+    try:
+        return await run_db(db, crud.batch_create_fetchers, fetchers, partial)
+    except crud.BatchCreateError as exc:
+        raise HTTPException(status_code=500, detail=[error.dict() for error in exc.errors])
+    except sqlalchemy.exc.IntegrityError as exc:
+        raise HTTPException(status_code=500, detail=crud.describe_integrity_error(exc, schemas.FetcherCreate))
+
+# a batch operation call for finding the fetchers of many domains.
+@app.post("/fetcher:byDomain/", response_model=list[schemas.FetcherDomainMatch], description="""
+    Finds the fetchers of each listed domain, as GET /fetcher:byDomain/ does
+    for one, with one DB round trip per 999 candidate domains rather than one
+    request per domain.
+
+    Returns one match per listed domain, in the same order.
+    """)
+async def batch_retrieve_fetchers_by_domain(domains: schemas.BatchDomains,
+        subdomains: bool = SUBDOMAINS_QUERY, db: AnySession = Depends(get_db)):
+    return await run_db(db, crud.find_fetchers_by_domains, domains.domains, subdomains)
+
 # a batch operation call for restarting fetchers.
 @app.post("/fetcher:restart/", description="""
     Restarts any listed fetchers
@@ -271,120 +535,125 @@ def delete_fetcher(fetcherid: int, db: Session = Depends(get_db_session)):
 
     If successful, the response body is empty.
     """)
-def restart_fetchers(fetcher_ids: schemas.BatchFetcherIds, db: Session = Depends(get_db_session)):
-    # TODO: fill out later once on a real running system.
-    pass
+async def restart_fetchers(fetcher_ids: schemas.BatchFetcherIds, db: AnySession = Depends(get_db)):
+    running_ids = [fetcherid for fetcherid in fetcher_ids.ids if fetcher_supervisor.is_running(fetcherid)]
+    if running_ids:
+        for fetcher in await run_db(db, crud.retrieve_active_fetchers, running_ids):
+            await fetcher_supervisor.restart_fetcher(fetcher)
 
 # a batch operation call for activating and deactivating fetchers.
-@app.post("/fetcher:activate/", description="""
-    Activates any active fetchers in the list
+@app.post("/fetcher:activate/", response_model=schemas.BatchFetcherIds, description="""
+    Activates the listed fetchers, or every fetcher which matches a filter,
+    e.g. `{"filter": {"protocol": "IMAP4", "server": "mailbox.intradyn.com"}}`.
 
     Silently ignores any fetchers in the list which are already active or
     which do not exist.
 
-    If successful, the response body is empty.
+    Returns the IDs of the fetchers which were activated.
     """)
-def activate_fetchers(fetcher_ids: schemas.BatchFetcherIds, db: Session = Depends(get_db_session)):
-    db.query(models.Fetcher).filter(
-        models.Fetcher.fetcherid.in_(fetcher_ids.ids)).update({models.Fetcher.active: True})
-
-    db.commit()
+async def activate_fetchers(selection: schemas.BatchFetcherSelection, db: AnySession = Depends(get_db)):
+    return await run_db(db, crud.set_fetchers_active, selection, True)
 
-@app.post("/fetcher:deactivate/", description="""
-    Deactivates any active fetchers in the list
+@app.post("/fetcher:deactivate/", response_model=schemas.BatchFetcherIds, description="""
+    Deactivates the listed fetchers, or every fetcher which matches a filter
+    (see POST /fetcher:activate/).
 
     Silently ignores any fetchers in the list which are already disabled or
     which do not exist.
 
-    If successful, the response body is empty.
+    Returns the IDs of the fetchers which were deactivated.
     """)
-def deactivate_fetchers(fetcher_ids: schemas.BatchFetcherIds, db: Session = Depends(get_db_session)):
-    db.query(models.Fetcher).filter(
-        models.Fetcher.fetcherid.in_(fetcher_ids.ids)).update({models.Fetcher.active: False})
-
-    db.commit()
+async def deactivate_fetchers(selection: schemas.BatchFetcherSelection, db: AnySession = Depends(get_db)):
+    return await run_db(db, crud.set_fetchers_active, selection, False)
 
 # a batch operation to call for deleting fetchers.
-@app.post("/fetcher:delete/", description="""
-    Deletes many fetchers by fetcher ID.
+@app.post("/fetcher:delete/", response_model=schemas.BatchFetcherIds, description="""
+    Deletes the listed fetchers, or every fetcher which matches a filter (see
+    POST /fetcher:activate/).
 
     Silently ignores any fetchers in the list which are already deleted or
     never existed in the first place.
 
-    If successful, the response body is empty.
+    Returns the IDs of the fetchers which were deleted.
     """)
-def delete_fetchers(fetcher_ids: schemas.BatchFetcherIds, db: Session = Depends(get_db_session)):
-    db.query(models.Fetcher).filter(models.Fetcher.fetcherid.in_(fetcher_ids.ids)).delete()
-    db.commit()
+async def delete_fetchers(selection: schemas.BatchFetcherSelection, db: AnySession = Depends(get_db)):
+    return await run_db(db, crud.delete_fetchers, selection)
 
 
 ############################# Fetcher Schedules ###############################
+# a batch operation call for creating fetcher schedules.
+@app.post("/fetcherschedule:batchCreate/", status_code=status.HTTP_201_CREATED,
+    response_model=schemas.BatchCreateResult, description="""
+    Creates many fetcher schedules in one transaction.
+
+    Returns the new ID of each schedule, in the same order as the request body.
+    """)
+async def batch_create_fetcherschedules(schedules: list[schemas.FetcherScheduleCreate],
+        partial: bool = PARTIAL_QUERY, db: AnySession = Depends(get_db)):
+    try:
+        return await run_db(db, crud.batch_create_fetcherschedules, schedules, partial)
+    except crud.BatchCreateError as exc:
+        raise HTTPException(status_code=500, detail=[error.dict() for error in exc.errors])
+
 # Create a new fetcher
 @app.post("/fetcherschedule/", status_code=status.HTTP_201_CREATED, response_model=schemas.FetcherScheduleRead)
-def create_fetcherschedule(schedule: schemas.FetcherScheduleCreate, db: Session = Depends(get_db_session)):
-    new_schedule = models.FetcherSchedule(
-        fetcherid = schedule.fetcherid,
-        downtimedays = schedule.downtimedays,
-        downtimestart = schedule.downtimestart,
-        downtimeend = schedule.downtimeend,
-    )
-    db.add(new_schedule)
-    db.commit()
-    db.refresh(new_schedule)
-    return schemas.FetcherScheduleRead.from_orm(new_schedule)
+async def create_fetcherschedule(schedule: schemas.FetcherScheduleCreate, db: AnySession = Depends(get_db)):
+    try:
+        return await run_db(db, crud.create_fetcherschedule, schedule)
+    except sqlalchemy.exc.IntegrityError:
+        raise HTTPException(status_code = status.HTTP_404_NOT_FOUND,
+                            detail="Fetcher with ID {} was not found.".format(schedule.fetcherid))
 
 # Update an existing fetcher
 @app.put("/fetcherschedule/{fetcherscheduleid}/")
-def update_fetcherschedule(fetcherscheduleid: int, schedule: schemas.FetcherScheduleCreate, db: Session = Depends(get_db_session)):
-    schedule_query = db.query(models.FetcherSchedule).filter(models.FetcherSchedule.fetcherscheduleid == fetcherscheduleid)
+async def update_fetcherschedule(fetcherscheduleid: int, schedule: schemas.FetcherScheduleCreate, db: AnySession = Depends(get_db)):
     try:
-        existing_schedule = schedule_query.one()
+        return await run_db(db, crud.update_fetcherschedule, fetcherscheduleid, schedule)
     except NoResultFound:
         raise HTTPException(status_code = status.HTTP_404_NOT_FOUND,
                             detail="Fetcher schedule with ID {} was not found.".format(fetcherscheduleid))
-
-    existing_schedule.fetcherid = schedule.fetcherid
-    existing_schedule.downtimedays = schedule.downtimedays
-    existing_schedule.downtimestart = schedule.downtimestart
-    existing_schedule.downtimeend = schedule.downtimeend
-
-    db.add(existing_schedule)
-    db.commit()
-    db.refresh(existing_schedule)
-    return schemas.FetcherScheduleRead.from_orm(existing_schedule)
+    except sqlalchemy.exc.IntegrityError:
+        raise HTTPException(status_code = status.HTTP_404_NOT_FOUND,
+                            detail="Fetcher with ID {} was not found.".format(schedule.fetcherid))
 
 
 # Get all fetchers
-@app.get("/fetcherschedule/", response_model=list[schemas.FetcherScheduleRead])
-def retrieve_fetcherschedules(db: Session = Depends(get_db_session)):
-    schedules = db.query(models.FetcherSchedule).all()
-    fetcher_schedule_schemas = [schemas.FetcherScheduleRead.from_orm(schedule) for schedule in schedules]
-    return fetcher_schedule_schemas
+@app.get("/fetcherschedule/", response_model=list[schemas.FetcherScheduleRead],
+         dependencies=[Depends(conditional_get(SCHEDULE_TABLES))])
+async def retrieve_fetcherschedules(response: Response, db: AnySession = Depends(get_db),
+        limit: int | None = LIMIT_QUERY,
+        cursor: str | None = CURSOR_QUERY):
+    try:
+        fetcher_schedule_schemas, next_cursor = await run_db(db, crud.retrieve_fetcherschedules, limit, cursor,
+                                                             USE_FAST_JSON)
+    except ValueError as exc:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(exc))
+
+    if next_cursor is not None:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+    return fast_json_response(response, fetcher_schedule_schemas)
 
 
 # Get a specific fetcher
-@app.get("/fetcherschedule/{fetcherscheduleid}/", response_model=schemas.FetcherScheduleRead)
-def retrieve_fetcherschedule(fetcherscheduleid: int, db: Session = Depends(get_db_session)):
+@app.get("/fetcherschedule/{fetcherscheduleid}/", response_model=schemas.FetcherScheduleRead,
+         dependencies=[Depends(conditional_get(SCHEDULE_TABLES))])
+async def retrieve_fetcherschedule(fetcherscheduleid: int, response: Response, db: AnySession = Depends(get_db)):
     try:
-        schedule = db.query(models.FetcherSchedule).filter(models.FetcherSchedule.fetcherscheduleid == fetcherscheduleid).one()
+        return fast_json_response(response, await run_db(db, crud.retrieve_fetcherschedule, fetcherscheduleid,
+                                                         USE_FAST_JSON))
     except NoResultFound:
         raise HTTPException(status_code = status.HTTP_404_NOT_FOUND,
                             detail="Fetcher Schedule with ID {} was not found.".format(fetcherscheduleid))
-    return schemas.FetcherScheduleRead.from_orm(schedule)
 
 # Delete a fetcher
 @app.delete("/fetcherschedule/{fetcherscheduleid}/", response_model=schemas.FetcherScheduleRead)
-def delete_fetcherschedule(fetcherscheduleid: int, db: Session = Depends(get_db_session)):
+async def delete_fetcherschedule(fetcherscheduleid: int, db: AnySession = Depends(get_db)):
     try:
-        schedule = db.query(models.FetcherSchedule).filter(models.FetcherSchedule.fetcherscheduleid == fetcherscheduleid).one()
+        return await run_db(db, crud.delete_fetcherschedule, fetcherscheduleid)  # to show the API user what was deleted for success messages & such.
     except NoResultFound:
         raise HTTPException(status_code = status.HTTP_404_NOT_FOUND,
                             detail="Fetcher Schedule with ID {} was not found.".format(fetcherscheduleid))
 
-    db.query(models.FetcherSchedule).filter(models.FetcherSchedule.fetcherscheduleid == fetcherscheduleid).delete()
-    db.commit()
-    return schemas.FetcherScheduleRead.from_orm(schedule)  # to show the API user what was deleted for success messages & such.
-
 
 if __name__ == "__main__":
     # Run the API in a web server on localhost:8000.
@@ -0,0 +1,243 @@
+"""
+Request and DB query metrics, served at GET /metrics in the Prometheus text
+format.
+
+MetricsMiddleware times every request by route (the route's path template,
+so /fetcher/{fetcherid}/ rather than every fetcher's URL), counts them by
+status code and keeps the number in flight.  Hooks on the engines add the
+number and duration of the SQL statements each request runs, and flag a
+request which runs the same SELECT N_PLUS_ONE_THRESHOLD or more times, as
+lazy loading in a loop does.  With SERVER_TIMING, each response also gets a
+Server-Timing header with its DB time and query count, which browsers'
+developer tools show.
+
+The metrics are kept in memory per process, so each worker serves its own.
+"""
+
+import bisect
+import contextvars
+import logging
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.routing import Match
+
+
+logger = logging.getLogger(__name__)
+
+# Whether responses get a Server-Timing header.  Off by default as it tells
+# clients how the server spends its time.
+SERVER_TIMING = False
+# How many times one request may run the same SELECT before it is flagged.
+N_PLUS_ONE_THRESHOLD = 10
+
+# Upper bounds, in seconds, of the buckets of the duration histograms.
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# The route label of requests which didn't match a route, so that made up
+# URLs can't make up labels.
+UNMATCHED_ROUTE = "(unmatched)"
+
+
+################################### Metrics ###################################
+def format_labels(labels):
+    """ @return a dict of label name -> value as Prometheus {name="value",...}. """
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"')
+                                           .replace("\n", "\\n")) for name, value in labels.items()) + "}"
+
+class Counter:
+    """ A value per label set which only goes up, or with inc(-1) for a gauge, up and down. """
+    def __init__(self, name, help, type="counter"):
+        self.name = name
+        self.help = help
+        self.type = type
+        self._lock = threading.Lock()
+        # tuple of (label name, value) pairs -> value
+        self._values = {}
+
+    def inc(self, labels, amount=1):
+        key = tuple(labels.items())
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, labels):
+        return self._values.get(tuple(labels.items()), 0)
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.type)]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append("{}{} {}".format(self.name, format_labels(dict(key)), value))
+        return lines
+
+class Histogram:
+    def __init__(self, name, help, buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # tuple of (label name, value) pairs -> [count per bucket (and +Inf), sum]
+        self._values = {}
+
+    def observe(self, labels, value):
+        key = tuple(labels.items())
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def get_count(self, labels):
+        counts = self._values.get(tuple(labels.items()))
+        return 0 if counts is None else sum(counts[:-1])
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} histogram".format(self.name)]
+        with self._lock:
+            for key, counts in sorted(self._values.items()):
+                labels = dict(key)
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += count
+                    lines.append("{}_bucket{} {}".format(self.name, format_labels(dict(labels, le=bound)),
+                                                         cumulative))
+                lines.append("{}_sum{} {}".format(self.name, format_labels(labels), counts[-1]))
+                lines.append("{}_count{} {}".format(self.name, format_labels(labels), cumulative))
+        return lines
+
+requests_total = Counter("http_requests_total", "Requests by route and status code.")
+request_duration = Histogram("http_request_duration_seconds",
+    "Time from receiving a request to sending the end of its response.")
+requests_in_flight = Counter("http_requests_in_flight", "Requests being handled.", type="gauge")
+db_queries_total = Counter("db_queries_total", "SQL statements run by requests.")
+db_duration = Histogram("db_query_duration_seconds", "Time spent running SQL statements, per request.")
+db_n_plus_one_total = Counter("db_n_plus_one_total",
+    "Requests which ran the same SELECT at least {} times.".format(N_PLUS_ONE_THRESHOLD))
+cache_hits_total = Counter("cache_hits_total", "Reads served from a cache (see cache.py), by cache.")
+cache_misses_total = Counter("cache_misses_total", "Reads which went past a cache to the DB, by cache.")
+
+ALL_METRICS = [requests_total, request_duration, requests_in_flight, db_queries_total, db_duration,
+               db_n_plus_one_total, cache_hits_total, cache_misses_total]
+
+def render_metrics():
+    """ @return every metric in the Prometheus text format. """
+    lines = []
+    for metric in ALL_METRICS:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+############################### Request tracking ###############################
+class RequestStats:
+    """ The SQL statements run on behalf of one request. """
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        # SELECT statement -> times run
+        self.selects = {}
+
+# The RequestStats of the request being handled, if any.  Contexts are copied
+# into threadpool threads and tasks, and this object is shared, not copied.
+current_request_stats = contextvars.ContextVar("current_request_stats", default=None)
+
+def get_route_path(scope):
+    """ @return the path template of the route which will handle a request. """
+    partial = None
+    for route in scope["app"].router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+        if match == Match.PARTIAL and partial is None:
+            partial = route.path
+    return partial or UNMATCHED_ROUTE
+
+class MetricsMiddleware:
+    """
+    An ASGI middleware, rather than BaseHTTPMiddleware, so that streamed
+    responses such as the export and the change feed pass straight through.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        labels = {"method": scope["method"], "route": get_route_path(scope)}
+        stats = RequestStats()
+        token = current_request_stats.set(stats)
+        status_code = 500
+        started = time.perf_counter()
+
+        async def send_with_metrics(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if SERVER_TIMING:
+                    message = dict(message, headers=list(message.get("headers", [])) + [
+                        (b"server-timing", get_server_timing(stats, time.perf_counter() - started).encode())])
+            await send(message)
+
+        requests_in_flight.inc(labels)
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            requests_in_flight.inc(labels, -1)
+            current_request_stats.reset(token)
+            requests_total.inc(dict(labels, status=status_code))
+            request_duration.observe(labels, time.perf_counter() - started)
+            db_queries_total.inc(labels, stats.queries)
+            db_duration.observe(labels, stats.db_seconds)
+            check_n_plus_one(labels, stats)
+
+def get_server_timing(stats, seconds):
+    return 'db;dur={:.1f};desc="{} queries", app;dur={:.1f}'.format(
+        stats.db_seconds * 1000, stats.queries, seconds * 1000)
+
+def check_n_plus_one(labels, stats):
+    if not stats.selects:
+        return
+    statement, times = max(stats.selects.items(), key=lambda item: item[1])
+    if times >= N_PLUS_ONE_THRESHOLD:
+        db_n_plus_one_total.inc(labels)
+        logger.warning("%s %s ran the same SELECT %d times, which looks like N+1 queries: %s",
+                       labels["method"], labels["route"], times, " ".join(statement.split())[:200])
+
+
+################################ Engine hooks #################################
+# The start times of the statements running on a connection.
+QUERY_STARTED = "metrics_query_started"
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_request_stats.get() is not None:
+        conn.info.setdefault(QUERY_STARTED, []).append(time.perf_counter())
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current_request_stats.get()
+    if stats is None or not conn.info.get(QUERY_STARTED):
+        return
+    stats.queries += 1
+    stats.db_seconds += time.perf_counter() - conn.info[QUERY_STARTED].pop()
+    if statement.lstrip()[:6].upper() == "SELECT":
+        stats.selects[statement] = stats.selects.get(statement, 0) + 1
+
+def handle_error(exception_context):
+    # A statement which failed never gets to after_cursor_execute.
+    if exception_context.connection is not None and exception_context.connection.info.get(QUERY_STARTED):
+        exception_context.connection.info[QUERY_STARTED].pop()
+
+def instrument_engines():
+    """
+    Registers the hooks which add each statement run on behalf of a request
+    to its metrics, on every engine: database.engine, and the async engine's
+    sync_engine, which is only created when it is first used.
+    """
+    if not event.contains(Engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+        event.listen(Engine, "handle_error", handle_error)
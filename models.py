@@ -1,6 +1,7 @@
 from database import Base
 
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey
+import sqlalchemy
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, DateTime, ForeignKey, Index, DDL, event
 from sqlalchemy.types import Time
 from sqlalchemy.orm import relationship
 
@@ -17,21 +18,250 @@ class Fetcher(Base):
     protocol = Column(String)
     port = Column(Integer)
     quickdelete = Column(Boolean, default=False)
-    active = Column(Boolean, default=True)
+    # Never NULL, as the API requires it, so the fetcher list's default
+    # order (active desc) can seek to a page (see add_keyset_pagination).
+    active = Column(Boolean, nullable=False, default=True)
     uidvalidkey = Column(Integer)
     timelimit = Column(Integer, default=15)
     mailbox = Column(String, nullable=False, default='inbox')
     domains = Column(String)
+    # Set by the DB on every insert and update: see "Row versions" below.
+    rowversion = Column(BigInteger, nullable=False, server_default="0", index=True)
+    updatedat = Column(DateTime)
 
-    schedules = relationship("FetcherSchedule", back_populates="fetcher")
+    # The DB deletes a fetcher's schedules with it (ON DELETE CASCADE), so the
+    # ORM leaves that to the DB rather than loading them to delete them.
+    schedules = relationship("FetcherSchedule", back_populates="fetcher",
+                             cascade="all, delete-orphan", passive_deletes=True)
+
+    __table_args__ = (
+        # Each index ends in the fetcher list's default order (with its id
+        # tiebreaker), so filtering on its leading column and sorting the
+        # default way is one index scan with no sort step.
+        Index("ix_fetchers_active_confname", active.desc(), confname, fetcherid),
+        Index("ix_fetchers_protocol_active_confname", protocol, active.desc(), confname, fetcherid),
+        Index("ix_fetchers_server_active_confname", server, active.desc(), confname, fetcherid),
+    )
 
 class FetcherSchedule(Base):
     __tablename__ = "fetcherschedules"
 
     fetcherscheduleid = Column(Integer, primary_key=True)
-    fetcherid      = Column(Integer, ForeignKey("fetchers.fetcherid"), nullable=False)
+    fetcherid      = Column(Integer, ForeignKey("fetchers.fetcherid", ondelete="CASCADE"), nullable=False,
+                            index=True)
     downtimedays   = Column(String, nullable=False)
     downtimestart  = Column(Time, nullable=False)
     downtimeend    = Column(Time, nullable=False)
+    rowversion     = Column(BigInteger, nullable=False, server_default="0", index=True)
+    updatedat      = Column(DateTime)
 
     fetcher = relationship("Fetcher", back_populates="schedules")
+
+
+class FetcherDomain(Base):
+    """
+    One row per domain in a fetcher's comma separated `domains`, normalized
+    (see crud.normalize_domain), so that the fetchers of a domain can be
+    looked up by index.  crud keeps these in step with `domains`.
+    """
+    __tablename__ = "fetcherdomains"
+
+    domain    = Column(String, primary_key=True)
+    fetcherid = Column(Integer, ForeignKey("fetchers.fetcherid", ondelete="CASCADE"), primary_key=True,
+                       index=True)
+
+############################## Full-text search ###############################
+# The search index over each fetcher's confname, description, server and
+# domains is kept by the DB itself, so every write path (ORM, bulk statements
+# and raw SQL alike) keeps it in sync.  It isn't mapped: crud.search_fetchers
+# queries it.  fetcher.sql creates the same objects for SQLite.
+#
+# SQLite: an FTS5 table over the fetchers table (external content, so the text
+# isn't stored twice) kept up to date by triggers.  Its rank is bm25 weighted
+# towards the name, then the server and domains.
+FETCHER_SEARCH_SQLITE_DDL = [
+    """CREATE VIRTUAL TABLE fetchersearch USING fts5(
+        confname, description, server, domains,
+        content='fetchers', content_rowid='fetcherid', prefix='2 3')""",
+    "INSERT INTO fetchersearch(fetchersearch, rank) VALUES ('rank', 'bm25(10.0, 1.0, 5.0, 5.0)')",
+    """CREATE TRIGGER fetchers_search_insert AFTER INSERT ON fetchers BEGIN
+        INSERT INTO fetchersearch(rowid, confname, description, server, domains)
+        VALUES (new.fetcherid, new.confname, new.description, new.server, new.domains);
+    END""",
+    """CREATE TRIGGER fetchers_search_delete AFTER DELETE ON fetchers BEGIN
+        INSERT INTO fetchersearch(fetchersearch, rowid, confname, description, server, domains)
+        VALUES ('delete', old.fetcherid, old.confname, old.description, old.server, old.domains);
+    END""",
+    """CREATE TRIGGER fetchers_search_update AFTER UPDATE OF confname, description, server, domains
+            ON fetchers BEGIN
+        INSERT INTO fetchersearch(fetchersearch, rowid, confname, description, server, domains)
+        VALUES ('delete', old.fetcherid, old.confname, old.description, old.server, old.domains);
+        INSERT INTO fetchersearch(rowid, confname, description, server, domains)
+        VALUES (new.fetcherid, new.confname, new.description, new.server, new.domains);
+    END""",
+]
+
+# Postgres: a generated tsvector column with a GIN index.  Punctuation is
+# turned into spaces first so that e.g. mail.example.com is indexed as its
+# parts, the way SQLite's tokenizer does, rather than as one host name token.
+FETCHER_SEARCH_POSTGRES_DDL = [
+    """ALTER TABLE fetchers ADD COLUMN searchvector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('simple', translate(confname, '.@-_', '    ')), 'A') ||
+        setweight(to_tsvector('simple', translate(coalesce(server, '') || ' ' || coalesce(domains, ''),
+                                                  '.@-_,', '     ')), 'B') ||
+        setweight(to_tsvector('simple', translate(coalesce(description, ''), '.@-_', '    ')), 'C')
+    ) STORED""",
+    "CREATE INDEX ix_fetchers_searchvector ON fetchers USING GIN (searchvector)",
+]
+
+for statement in FETCHER_SEARCH_SQLITE_DDL:
+    event.listen(Fetcher.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+for statement in FETCHER_SEARCH_POSTGRES_DDL:
+    event.listen(Fetcher.__table__, "after_create", DDL(statement).execute_if(dialect="postgresql"))
+
+fetcher_search = sqlalchemy.table("fetchersearch", sqlalchemy.column("rowid"),
+                                  sqlalchemy.column("fetchersearch"), sqlalchemy.column("rank"))
+fetcher_searchvector = sqlalchemy.literal_column("fetchers.searchvector")
+
+
+################################ Row versions #################################
+# Every insert into or update of fetchers and fetcherschedules takes the next
+# number from the one-row syncstate table as the row's rowversion, and every
+# delete takes one for a row in tombstones, so "what changed since version N"
+# is an index range scan (see crud.retrieve_changes).  As the DB does it with
+# triggers, every write path (ORM, bulk statements and raw SQL alike) is
+# covered.  The syncstate row is locked from a write until its transaction
+# commits, so versions are handed out in commit order and a reader never sees
+# version N + 1 before N.  fetcher.sql creates the same objects for SQLite.
+sync_state = sqlalchemy.Table("syncstate", Base.metadata,
+    Column("version", BigInteger, nullable=False),
+    # Tombstones up to this version have been purged (see crud.purge_tombstones).
+    Column("purgedversion", BigInteger, nullable=False),
+)
+
+class Tombstone(Base):
+    """ Marks a deleted fetcher or schedule for clients which sync changes. """
+    __tablename__ = "tombstones"
+
+    tablename  = Column(String, primary_key=True)
+    id         = Column(Integer, primary_key=True)
+    rowversion = Column(BigInteger, nullable=False, index=True)
+    deletedat  = Column(DateTime, nullable=False)
+
+# (table, primary key column) of the versioned tables.
+VERSIONED_TABLES = [("fetchers", "fetcherid"), ("fetcherschedules", "fetcherscheduleid")]
+
+ROW_VERSION_DDL = ["INSERT INTO syncstate (version, purgedversion) VALUES (0, 0)"]
+
+# SQLite: AFTER triggers can't change the new row, so they UPDATE it.  The
+# update trigger skips the UPDATEs made by the triggers themselves, which
+# change rowversion.
+ROW_VERSION_SQLITE_DDL = []
+for table, id_column in VERSIONED_TABLES:
+    ROW_VERSION_SQLITE_DDL += [
+        """CREATE TRIGGER {table}_version_insert AFTER INSERT ON {table} BEGIN
+            UPDATE syncstate SET version = version + 1;
+            UPDATE {table} SET rowversion = (SELECT version FROM syncstate), updatedat = CURRENT_TIMESTAMP
+            WHERE {id_column} = new.{id_column};
+            DELETE FROM tombstones WHERE tablename = '{table}' AND id = new.{id_column};
+        END""".format(table=table, id_column=id_column),
+        """CREATE TRIGGER {table}_version_update AFTER UPDATE ON {table}
+                WHEN new.rowversion IS old.rowversion BEGIN
+            UPDATE syncstate SET version = version + 1;
+            UPDATE {table} SET rowversion = (SELECT version FROM syncstate), updatedat = CURRENT_TIMESTAMP
+            WHERE {id_column} = new.{id_column};
+        END""".format(table=table, id_column=id_column),
+        """CREATE TRIGGER {table}_version_delete AFTER DELETE ON {table} BEGIN
+            UPDATE syncstate SET version = version + 1;
+            INSERT OR REPLACE INTO tombstones (tablename, id, rowversion, deletedat)
+            VALUES ('{table}', old.{id_column}, (SELECT version FROM syncstate), CURRENT_TIMESTAMP);
+        END""".format(table=table, id_column=id_column),
+    ]
+
+# Postgres: one pair of trigger functions, given the primary key column's name.
+ROW_VERSION_POSTGRES_DDL = [
+    """CREATE FUNCTION set_rowversion() RETURNS trigger AS $$
+    BEGIN
+        UPDATE syncstate SET version = version + 1 RETURNING version INTO NEW.rowversion;
+        NEW.updatedat := now();
+        IF TG_OP = 'INSERT' THEN
+            DELETE FROM tombstones
+            WHERE tablename = TG_TABLE_NAME AND id = (to_jsonb(NEW) ->> TG_ARGV[0])::integer;
+        END IF;
+        RETURN NEW;
+    END $$ LANGUAGE plpgsql""",
+    """CREATE FUNCTION add_tombstone() RETURNS trigger AS $$
+    DECLARE
+        next_version bigint;
+    BEGIN
+        UPDATE syncstate SET version = version + 1 RETURNING version INTO next_version;
+        INSERT INTO tombstones (tablename, id, rowversion, deletedat)
+        VALUES (TG_TABLE_NAME, (to_jsonb(OLD) ->> TG_ARGV[0])::integer, next_version, now())
+        ON CONFLICT (tablename, id) DO UPDATE SET rowversion = EXCLUDED.rowversion, deletedat = EXCLUDED.deletedat;
+        RETURN OLD;
+    END $$ LANGUAGE plpgsql""",
+]
+for table, id_column in VERSIONED_TABLES:
+    ROW_VERSION_POSTGRES_DDL += [
+        """CREATE TRIGGER {table}_version BEFORE INSERT OR UPDATE ON {table}
+            FOR EACH ROW EXECUTE FUNCTION set_rowversion('{id_column}')""".format(table=table, id_column=id_column),
+        """CREATE TRIGGER {table}_tombstone AFTER DELETE ON {table}
+            FOR EACH ROW EXECUTE FUNCTION add_tombstone('{id_column}')""".format(table=table, id_column=id_column),
+    ]
+
+# After every table is created, as the triggers of each table use the others.
+for statement in ROW_VERSION_DDL:
+    event.listen(Base.metadata, "after_create", DDL(statement))
+for statement in ROW_VERSION_SQLITE_DDL:
+    event.listen(Base.metadata, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+for statement in ROW_VERSION_POSTGRES_DDL:
+    event.listen(Base.metadata, "after_create", DDL(statement).execute_if(dialect="postgresql"))
+
+
+########################### Change notifications ##############################
+# Postgres: every statement which writes fetchers or fetcherschedules sends a
+# notification on CHANGE_CHANNEL when its transaction commits, so that other
+# workers can drop what they cached of the rows (see bus.py).  The payload is
+#     {"origin": <the writer's fetcher.worker setting, or null>,
+#      "table": "fetchers", "op": "insert", "ids": [1, 2, 3]}
+# with "ids" null when the list doesn't fit in a notification.  SQLite has no
+# notifications, so bus.py polls the row versions instead.
+CHANGE_CHANNEL = "fetcher_changes"
+# Notification payloads must be under 8000 bytes.
+MAX_CHANGE_PAYLOAD = 7900
+
+CHANGE_NOTIFY_POSTGRES_DDL = [
+    """CREATE FUNCTION notify_changes() RETURNS trigger AS $$
+    DECLARE
+        ids jsonb;
+        payload text;
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            SELECT jsonb_agg(to_jsonb(old_rows) -> TG_ARGV[0]) INTO ids FROM old_rows;
+        ELSE
+            SELECT jsonb_agg(to_jsonb(new_rows) -> TG_ARGV[0]) INTO ids FROM new_rows;
+        END IF;
+        IF ids IS NULL THEN
+            RETURN NULL;
+        END IF;
+        payload := jsonb_build_object('origin', current_setting('fetcher.worker', true),
+            'table', TG_TABLE_NAME, 'op', lower(TG_OP), 'ids', ids)::text;
+        IF length(payload) > {max_payload} THEN
+            payload := jsonb_build_object('origin', current_setting('fetcher.worker', true),
+                'table', TG_TABLE_NAME, 'op', lower(TG_OP), 'ids', NULL)::text;
+        END IF;
+        PERFORM pg_notify('{channel}', payload);
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql""".format(max_payload=MAX_CHANGE_PAYLOAD, channel=CHANGE_CHANNEL),
+]
+# One trigger per event, as a trigger with transition tables can only have one.
+for table, id_column in VERSIONED_TABLES:
+    for op, transition_table in [("INSERT", "NEW TABLE AS new_rows"), ("UPDATE", "NEW TABLE AS new_rows"),
+                                 ("DELETE", "OLD TABLE AS old_rows")]:
+        CHANGE_NOTIFY_POSTGRES_DDL.append(
+            """CREATE TRIGGER {table}_notify_{op} AFTER {OP} ON {table} REFERENCING {transition_table}
+                FOR EACH STATEMENT EXECUTE FUNCTION notify_changes('{id_column}')""".format(
+                table=table, op=op.lower(), OP=op, transition_table=transition_table, id_column=id_column))
+
+for statement in CHANGE_NOTIFY_POSTGRES_DDL:
+    event.listen(Base.metadata, "after_create", DDL(statement).execute_if(dialect="postgresql"))
@@ -1,3 +1,6 @@
+import datetime
+import operator
+
 import pydantic
 from typing import Optional
 
@@ -20,3 +23,55 @@ class AllOptional(pydantic.main.ModelMetaclass):
         namespaces['__annotations__'] = annotations
         return super().__new__(self, name, bases, namespaces, **kwargs)
 
+
+
+ISOFORMAT_TYPES = (datetime.date, datetime.time, datetime.datetime)
+
+def make_serializer(schema_class, nested_serializers=None, fields=None):
+    """
+    @return serialize(obj), which turns an ORM object (or anything else with
+        the attributes schema_class reads) into the same JSON-ready dict as
+        jsonable_encoder(schema_class.from_orm(obj)): keyed by alias, in
+        field order.  The field list is worked out once, here, and no
+        pydantic model is built or validated per object, so it trusts obj's
+        attributes to already have the schema's types, as DB columns do.
+
+    @param nested_serializers: a dict of field name -> serializer for fields
+        which hold another schema or a list of them.
+    @param fields: the names of the only fields to serialize, or None for
+        every field.  The others are neither read from obj nor in the dict.
+    """
+    nested_serializers = nested_serializers or {}
+    only_fields = fields
+    fields = []
+    for name, field in schema_class.__fields__.items():
+        if only_fields is not None and name not in only_fields:
+            continue
+        if name in nested_serializers:
+            convert = _make_nested_converter(nested_serializers[name])
+        elif isinstance(field.outer_type_, type) and issubclass(field.outer_type_, ISOFORMAT_TYPES):
+            convert = operator.methodcaller("isoformat")
+        else:
+            convert = None
+        fields.append((field.alias, name, convert, field.default))
+
+    def serialize(obj):
+        data = {}
+        for alias, name, convert, default in fields:
+            value = getattr(obj, name, default)
+            if convert is not None and value is not None:
+                value = convert(value)
+            data[alias] = value
+        return data
+    return serialize
+
+def get_field_names(schema_class, aliases):
+    """ @return the names of the fields of schema_class with the given aliases, as a frozenset. """
+    return frozenset(name for name, field in schema_class.__fields__.items() if field.alias in aliases)
+
+def _make_nested_converter(serializer):
+    def convert(value):
+        if isinstance(value, list):
+            return [serializer(item) for item in value]
+        return serializer(value)
+    return convert
@@ -0,0 +1,176 @@
+"""
+Replays a capture of real API calls (see capture.py) against the app, to see
+how this build handles production's traffic: which routes got slower or
+faster, and which now fail.
+
+    python replay.py capture.jsonl --speed 4 --concurrency 20 --db-path copy-of-production.db
+
+Requests are sent straight to the ASGI app (see benchmark.call_app), with
+their captured headers such as If-None-Match and Last-Event-ID, at the pace
+they were captured at, `--speed` times faster (0 for no pauses at all), with
+at most `--concurrency` in flight.  The report, as JSON, has each route's
+latency next to its captured latency, its status codes and how many differ
+from the captured ones, and how far the replay fell behind the capture's
+pace.
+
+ETags are only good in the process which made them (see changes.EPOCH), so
+a captured 304 is usually a 200 when replayed.  Those are counted as
+`etag_misses` rather than as status mismatches.
+
+Writes are replayed too, so point --db-path at a copy of the DB rather than
+at one you want to keep.
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import sys
+import time
+
+import benchmark
+import metrics
+from main import app
+
+
+DEFAULT_SPEED = 1.0
+DEFAULT_CONCURRENCY = 10
+
+# Routes which aren't replayed, and why.
+SKIPPED_ROUTES = {
+    "GET /fetcher:watch/": "an endless event stream, so it would never finish",
+}
+
+
+def read_capture(path):
+    """ @return the entries of a capture file, in the order their requests arrived. """
+    with open(path) as file:
+        entries = [json.loads(line) for line in file if line.strip()]
+    return sorted(entries, key=lambda entry: entry["time"])
+
+def get_entry_body(entry):
+    if entry["body"] is None:
+        return None
+    if entry.get("body_encoding") == "base64":
+        return base64.b64decode(entry["body"])
+    return entry["body"].encode()
+
+def get_entry_route(entry):
+    """ @return "METHOD /path/template/" of the route which handles an entry. """
+    scope = {"type": "http", "app": app, "method": entry["method"], "path": entry["path"]}
+    return "{} {}".format(entry["method"], metrics.get_route_path(scope))
+
+async def replay(entries, speed=DEFAULT_SPEED, concurrency=DEFAULT_CONCURRENCY):
+    """
+    Sends the requests of the entries to the app.
+    @param speed: how many times faster than captured to send them, or 0 to
+        send each as soon as there is room for it.
+    @return the report dict.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = set()
+    # Per route: [(entry, status code, seconds)]
+    results = {}
+    skipped = {}
+    max_lag = 0.0
+    started = time.perf_counter()
+    first_time = entries[0]["time"] if entries else 0.0
+
+    async def send(entry, route, due):
+        nonlocal max_lag
+        try:
+            sent = time.perf_counter()
+            max_lag = max(max_lag, sent - due)
+            try:
+                status_code, _ = await benchmark.call_app(entry["method"], entry["path"], entry["query"],
+                                                          get_entry_body(entry), entry["content_type"] or "",
+                                                          entry.get("headers"))
+            except Exception:
+                status_code = 500
+            results.setdefault(route, []).append((entry, status_code, time.perf_counter() - sent))
+        finally:
+            semaphore.release()
+
+    for entry in entries:
+        route = get_entry_route(entry)
+        if route in SKIPPED_ROUTES or entry.get("truncated"):
+            skipped[route] = skipped.get(route, 0) + 1
+            continue
+        due = started + ((entry["time"] - first_time) / speed if speed else 0.0)
+        if due > time.perf_counter():
+            await asyncio.sleep(due - time.perf_counter())
+        await semaphore.acquire()
+        task = asyncio.create_task(send(entry, route, due))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    requests = sum(len(route_results) for route_results in results.values())
+    return {
+        "speed": speed,
+        "concurrency": concurrency,
+        "requests": requests,
+        "skipped": skipped,
+        "elapsed_s": round(elapsed, 3),
+        "captured_s": round(entries[-1]["time"] - first_time, 3) if entries else 0.0,
+        "throughput_rps": round(requests / elapsed, 1) if elapsed else None,
+        # How late the last request to start was.  Without pauses, there is no pace to keep.
+        "max_lag_ms": round(max_lag * 1000, 3) if speed else None,
+        "routes": {route: summarize_route(route_results) for route, route_results in sorted(results.items())},
+    }
+
+def summarize_route(route_results):
+    latencies = sorted(seconds for _, _, seconds in route_results)
+    captured = sorted(entry["duration_ms"] for entry, _, _ in route_results)
+    statuses = {}
+    for _, status_code, _ in route_results:
+        statuses[str(status_code)] = statuses.get(str(status_code), 0) + 1
+    etag_misses = sum(1 for entry, status_code, _ in route_results if (entry["status"], status_code) == (304, 200))
+    return {
+        "requests": len(route_results),
+        "errors": sum(1 for _, status_code, _ in route_results if status_code >= 500),
+        "status_mismatches": sum(1 for entry, status_code, _ in route_results
+                                 if status_code != entry["status"]) - etag_misses,
+        "etag_misses": etag_misses,
+        "statuses": statuses,
+        "p50_ms": round(benchmark.percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(benchmark.percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(benchmark.percentile(latencies, 99) * 1000, 3),
+        "captured_p50_ms": benchmark.percentile(captured, 50),
+        "captured_p95_ms": benchmark.percentile(captured, 95),
+        "captured_p99_ms": benchmark.percentile(captured, 99),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("capture", help="A file written by capture.CaptureMiddleware.")
+    parser.add_argument("--speed", type=float, default=DEFAULT_SPEED,
+                        help="How many times faster than captured to replay, or 0 for no pauses.")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="The most requests in flight at once.")
+    parser.add_argument("--db-path", help="A SQLite DB to replay against, rather than the app's own DB.")
+    parser.add_argument("--limit", type=int, help="Only replay the first this many requests.")
+    parser.add_argument("--output", help="Write the JSON report here rather than to stdout.")
+    args = parser.parse_args()
+
+    entries = read_capture(args.capture)[:args.limit]
+    restore = benchmark.use_db(args.db_path) if args.db_path else None
+    try:
+        report = asyncio.run(replay(entries, args.speed, args.concurrency))
+    finally:
+        if restore is not None:
+            restore()
+
+    for route, summary in report["routes"].items():
+        print("{}: {requests} requests, p50 {p50_ms}ms (captured {captured_p50_ms}ms), {errors} errors, "
+              "{status_mismatches} other statuses".format(route, **summary), file=sys.stderr)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
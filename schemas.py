@@ -1,5 +1,5 @@
 import datetime
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, root_validator
 from typing import List
 
 from pydanticutils import AllOptional
@@ -53,9 +53,69 @@ class FetcherPatch(FetcherCreate, metaclass=AllOptional):
 
 class FetcherRead(FetcherCreate):
     fetcherid: int = Field(alias='id')
-    schedules: List[FetcherScheduleRead] = []
+    schedules: List[FetcherScheduleRead] | None = Field(default=[],
+        description="null when the fetcher was read with `?expand=none`.")
     uidvalidkey: int | None = Field(alias='uid_validity_key')
 
 class BatchFetcherIds(BaseModel):
     ids: List[int] = []
 
+class FetcherFilter(BaseModel):
+    """ The same filters as GET /fetcher/ takes.  Fields which are null don't filter. """
+    active: bool | None = None
+    protocol: str | None = None
+    server: str | None = Field(default=None, description="An exact server.")
+    server_prefix: str | None = None
+    name_prefix: str | None = None
+
+class BatchFetcherSelection(BaseModel):
+    ids: List[int] | None = Field(default=None, description="The IDs of the fetchers.")
+    filter: FetcherFilter | None = Field(default=None,
+        description="Instead of `ids`: every fetcher which matches this filter.")
+
+    @root_validator(skip_on_failure=True)
+    def check_one_selection(cls, values):
+        if (values.get("ids") is None) == (values.get("filter") is None):
+            raise ValueError("Give either ids or filter.")
+        if values.get("filter") is not None and not values["filter"].dict(exclude_none=True):
+            raise ValueError("The filter must set at least one field.")
+        return values
+
+class BatchDomains(BaseModel):
+    domains: List[str] = []
+
+class FetcherDomainMatch(BaseModel):
+    domain: str
+    matched_domain: str | None = Field(default=None,
+        description=("The domain in the fetchers' `domains` which matched: `domain` itself or, "
+            "with `subdomains`, its closest parent domain.  null when no fetcher matched."))
+    ids: List[int] = []
+
+class BatchCreateError(BaseModel):
+    index: int = Field(description="Position of the failed item in the request body.")
+    detail: str
+
+class BatchCreateResult(BaseModel):
+    ids: List[int | None] = Field(
+        description="The new ID of each item in request order, or null where the item failed.")
+    errors: List[BatchCreateError] = []
+
+class ImportRejectedLine(BaseModel):
+    line: int
+    detail: str
+
+class ImportSummary(BaseModel):
+    inserted: int = 0
+    updated: int = 0
+    rejected: int = 0
+    rejected_lines: List[ImportRejectedLine] = []
+
+class FetcherChanges(BaseModel):
+    token: int = Field(description="Pass as `since` to get the changes after these.")
+    more: bool = Field(description="Whether `limit` cut the changes short.  If so, ask again with `token`.")
+    fetchers: List[FetcherRead] = Field(default=[],
+        description="Fetchers inserted or updated since `since`, with `schedules` null.")
+    schedules: List[FetcherScheduleRead] = Field(default=[],
+        description="Schedules inserted or updated since `since`.")
+    deleted_fetcher_ids: List[int] = []
+    deleted_schedule_ids: List[int] = []
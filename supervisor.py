@@ -0,0 +1,346 @@
+"""
+Runs the active fetchers in the background.
+
+A Supervisor wakes up every TICK_SECONDS, asks the DB which fetchers are
+active and out of downtime, and starts a run of each one whose last run
+finished at least POLL_SECONDS ago.  It also stops the runs of fetchers which
+have since been deactivated, deleted or gone into downtime.  A tick reads
+just the IDs of the runnable fetchers (from the downtime index and the
+active column), and only reads the whole rows of the ones it starts.
+
+Runs are asyncio tasks rather than threads, and at most max_concurrency of
+them talk to a mail server at once: the rest wait their turn on a semaphore.
+So thousands of fetchers cost thousands of idle tasks, not threads.  A run
+which goes past its fetcher's timelimit (in minutes, 0 or None for no limit)
+is cut short.
+
+A run whose fetcher is in downtime when its turn comes is skipped.  The
+downtime index is refreshed first, so that it has every schedule write this
+process has heard of.  Other processes' schedule writes are only heard of
+with bus.py running.  Without it, the index misses them until something
+makes it reload those schedules (see downtime.py).
+
+The app only runs a supervisor when database.USE_SUPERVISOR is set.
+
+What a run does is the `fetch` coroutine function the supervisor is given.
+The default, check_mailbox, logs in to the fetcher's IMAP or POP3 mailbox and
+counts the messages in it.
+"""
+
+import asyncio
+import collections
+import logging
+import ssl
+import time
+
+import crud
+import downtime
+from database import open_db_session, run_db
+
+
+logger = logging.getLogger(__name__)
+
+# How often the supervisor looks for fetchers to run.
+TICK_SECONDS = 10
+# How long after a run finishes before its fetcher runs again.
+POLL_SECONDS = 300
+# The most runs which talk to a mail server at once.
+MAX_CONCURRENCY = 100
+
+# state is one of "waiting" (for a free slot), "running", "succeeded",
+# "failed", "timed out", "stopped" or "skipped" (in downtime when its slot
+# came up).  started and finished are time.time() timestamps, or None.
+# messages is what `fetch` returned, and error says why a run didn't succeed.
+RunStatus = collections.namedtuple("RunStatus", ["state", "started", "finished", "messages", "error"])
+
+
+############################### Mailbox Checks ################################
+class FetchError(Exception):
+    """ Raised when a mail server refuses a fetcher's connection or commands. """
+
+IMAP_PORTS = {False: 143, True: 993}
+POP3_PORTS = {False: 110, True: 995}
+
+def uses_ssl(fetcher):
+    """ @return True for the IMAPS and POP3S protocols and their standard ports. """
+    return (fetcher.protocol or "").upper().endswith("S") or fetcher.port in (IMAP_PORTS[True], POP3_PORTS[True])
+
+async def open_mail_connection(fetcher, default_ports):
+    use_ssl = uses_ssl(fetcher)
+    return await asyncio.open_connection(fetcher.server, fetcher.port or default_ports[use_ssl],
+                                         ssl=ssl.create_default_context() if use_ssl else None)
+
+async def read_line(reader):
+    line = await reader.readline()
+    if not line:
+        raise FetchError("The server closed the connection.")
+    return line.decode(errors="replace").rstrip("\r\n")
+
+async def pop3_command(reader, writer, command):
+    """
+    Sends a POP3 command, or just reads the greeting when command is None.
+    @return the +OK response line.
+    """
+    if command is not None:
+        writer.write(command.encode() + b"\r\n")
+        await writer.drain()
+    line = await read_line(reader)
+    if not line.startswith("+OK"):
+        # Only the command's name is shown so that a password is never logged.
+        raise FetchError("POP3 {} failed: {}".format(command.split()[0] if command else "greeting", line))
+    return line
+
+async def check_pop3_mailbox(fetcher):
+    reader, writer = await open_mail_connection(fetcher, POP3_PORTS)
+    try:
+        await pop3_command(reader, writer, None)
+        await pop3_command(reader, writer, "USER " + (fetcher.userid or ""))
+        await pop3_command(reader, writer, "PASS " + (fetcher.password or ""))
+        stat = await pop3_command(reader, writer, "STAT")
+        await pop3_command(reader, writer, "QUIT")
+    finally:
+        writer.close()
+    try:
+        return int(stat.split()[1])
+    except (IndexError, ValueError):
+        raise FetchError("POP3 STAT gave an unexpected response: {}".format(stat))
+
+def imap_quote(value):
+    return '"' + (value or "").replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+async def imap_command(reader, writer, tag, command):
+    """ Sends a tagged IMAP command.  @return its untagged response lines. """
+    writer.write("{} {}\r\n".format(tag, command).encode())
+    await writer.drain()
+    untagged_lines = []
+    while True:
+        line = await read_line(reader)
+        if line.startswith(tag + " "):
+            if line.split()[1:2] != ["OK"]:
+                raise FetchError("IMAP {} failed: {}".format(command.split()[0], line))
+            return untagged_lines
+        untagged_lines.append(line)
+
+async def check_imap_mailbox(fetcher):
+    reader, writer = await open_mail_connection(fetcher, IMAP_PORTS)
+    try:
+        greeting = await read_line(reader)
+        if not greeting.startswith("* OK"):
+            raise FetchError("IMAP greeting failed: {}".format(greeting))
+        await imap_command(reader, writer, "a1", "LOGIN {} {}".format(
+            imap_quote(fetcher.userid), imap_quote(fetcher.password)))
+        # EXAMINE rather than SELECT opens the mailbox read-only.
+        untagged_lines = await imap_command(reader, writer, "a2", "EXAMINE " + imap_quote(fetcher.mailbox))
+        await imap_command(reader, writer, "a3", "LOGOUT")
+    finally:
+        writer.close()
+    for line in untagged_lines:
+        words = line.split()
+        if len(words) == 3 and words[2].upper() == "EXISTS" and words[1].isdigit():
+            return int(words[1])
+    return 0
+
+async def check_mailbox(fetcher):
+    """
+    Logs in to a fetcher's mailbox.
+    @return the number of messages in it.
+    @raise FetchError if the server refuses, or OSError if it can't be reached.
+    """
+    protocol = (fetcher.protocol or "").upper()
+    if protocol.startswith("IMAP"):
+        return await check_imap_mailbox(fetcher)
+    if protocol.startswith("POP"):
+        return await check_pop3_mailbox(fetcher)
+    raise FetchError("Fetcher protocol '{}' is not supported.".format(fetcher.protocol))
+
+
+################################# Supervisor ##################################
+async def load_runnable_fetcherids(at):
+    """ @return the IDs of the active fetchers which are not in downtime at datetime at. """
+    async with open_db_session() as db:
+        return (await run_db(db, crud.get_runnable_fetchers, at)).ids
+
+async def load_active_fetchers(fetcherids):
+    """ @return schemas of the fetchers in fetcherids which are still active. """
+    async with open_db_session() as db:
+        return await run_db(db, crud.retrieve_active_fetchers, fetcherids)
+
+async def refresh_downtime_index(downtime_index):
+    """ Brings downtime_index up to date with the writes this process has heard of. """
+    async with open_db_session() as db:
+        await run_db(db, downtime_index.refresh)
+
+class Supervisor:
+    def __init__(self, fetch=check_mailbox, load_runnable_ids=load_runnable_fetcherids,
+                 load_fetchers=load_active_fetchers, refresh_downtime=refresh_downtime_index,
+                 max_concurrency=MAX_CONCURRENCY, tick_seconds=TICK_SECONDS,
+                 poll_seconds=POLL_SECONDS, seconds_per_timelimit=60,
+                 downtime_index=downtime.downtime_index):
+        """
+        @param fetch: async fetch(fetcher_schema) which does a run.
+        @param load_runnable_ids: async load_runnable_ids(at) which returns
+            the IDs of the fetchers which may run at datetime at.
+        @param load_fetchers: async load_fetchers(fetcherids) which returns
+            the schemas of those of the fetchers which may still run.
+        @param refresh_downtime: async refresh_downtime(downtime_index),
+            called before a run checks whether its fetcher is in downtime.
+        @param seconds_per_timelimit: what one unit of a fetcher's timelimit
+            is worth, so tests can use a shorter minute.
+        """
+        self._fetch = fetch
+        self._load_runnable_ids = load_runnable_ids
+        self._load_fetchers = load_fetchers
+        self._refresh_downtime = refresh_downtime
+        self._max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._tick_seconds = tick_seconds
+        self._poll_seconds = poll_seconds
+        self._seconds_per_timelimit = seconds_per_timelimit
+        self._downtime_index = downtime_index
+
+        self._tick_task = None
+        # fetcherid -> the asyncio.Task of its current run
+        self._runs = {}
+        # fetcherid -> the RunStatus of its current or last run
+        self._statuses = {}
+        # fetcherid -> time.monotonic() when its last run finished
+        self._last_finished = {}
+
+    def is_started(self):
+        return self._tick_task is not None
+
+    def is_running(self, fetcherid):
+        return fetcherid in self._runs
+
+    def get_status(self, fetcherid):
+        """ @return the RunStatus of the fetcher's current or last run, or None. """
+        return self._statuses.get(fetcherid)
+
+    ########################## Starting & Stopping ##########################
+    async def start(self):
+        """ Starts looking for fetchers to run every tick_seconds. """
+        if self._tick_task is None:
+            # A fresh semaphore in case the last start was on another event loop.
+            self._semaphore = asyncio.Semaphore(self._max_concurrency)
+            self._tick_task = asyncio.create_task(self._tick_forever())
+
+    async def stop(self):
+        """ Stops looking for fetchers to run and stops every run. """
+        if self._tick_task is not None:
+            self._tick_task.cancel()
+            await asyncio.gather(self._tick_task, return_exceptions=True)
+            self._tick_task = None
+        for fetcherid in list(self._runs):
+            await self.stop_fetcher(fetcherid)
+
+    def start_fetcher(self, fetcher):
+        """
+        Starts a run of a fetcher now, whenever its last run finished.
+        @return False if it is already running.
+        """
+        if fetcher.fetcherid in self._runs:
+            return False
+        self._statuses[fetcher.fetcherid] = RunStatus("waiting", None, None, None, None)
+        self._runs[fetcher.fetcherid] = asyncio.create_task(self._run(fetcher))
+        return True
+
+    async def stop_fetcher(self, fetcherid):
+        """
+        Stops the run of a fetcher and waits for it to end.
+        @return False if it wasn't running.
+        """
+        run = self._runs.get(fetcherid)
+        if run is None:
+            return False
+        run.cancel()
+        await asyncio.gather(run, return_exceptions=True)
+        return True
+
+    async def restart_fetcher(self, fetcher):
+        """
+        Stops the run of a fetcher and starts a new one with the given
+        settings.  @return False, and does nothing, if it wasn't running.
+        """
+        if not await self.stop_fetcher(fetcher.fetcherid):
+            return False
+        return self.start_fetcher(fetcher)
+
+    async def join(self):
+        """ Waits for every current run to end. """
+        while self._runs:
+            await asyncio.gather(*self._runs.values(), return_exceptions=True)
+
+    ############################### Scheduling ###############################
+    async def _tick_forever(self):
+        while True:
+            try:
+                await self.run_due_fetchers()
+            except Exception:
+                logger.exception("Could not look for fetchers to run.")
+            await asyncio.sleep(self._tick_seconds)
+
+    async def run_due_fetchers(self):
+        """
+        Stops the runs of fetchers which may no longer run, then starts a run
+        of each fetcher which may run and is due.
+        @return the fetcherids which were started.
+        """
+        runnable_ids = set(await self._load_runnable_ids(downtime.to_local_time()))
+        for fetcherid in list(self._runs):
+            if fetcherid not in runnable_ids:
+                await self.stop_fetcher(fetcherid)
+
+        now = time.monotonic()
+        due_ids = []
+        for fetcherid in sorted(runnable_ids):
+            last_finished = self._last_finished.get(fetcherid)
+            if fetcherid not in self._runs and (last_finished is None or
+                                                now - last_finished >= self._poll_seconds):
+                due_ids.append(fetcherid)
+        if not due_ids:
+            return []
+
+        started_ids = []
+        for fetcher in await self._load_fetchers(due_ids):
+            if self.start_fetcher(fetcher):
+                started_ids.append(fetcher.fetcherid)
+        return started_ids
+
+    async def _run(self, fetcher):
+        fetcherid = fetcher.fetcherid
+        started = None
+        try:
+            async with self._semaphore:
+                # The fetcher may have gone into downtime while it waited.
+                try:
+                    await self._refresh_downtime(self._downtime_index)
+                except Exception:
+                    logger.exception("Could not refresh the downtime index, so it may be out of date.")
+                if self._downtime_index.is_in_downtime(fetcherid, downtime.to_local_time()):
+                    self._statuses[fetcherid] = RunStatus("skipped", None, time.time(), None, None)
+                    return
+
+                started = time.time()
+                self._statuses[fetcherid] = RunStatus("running", started, None, None, None)
+                timeout = fetcher.timelimit * self._seconds_per_timelimit if fetcher.timelimit else None
+                try:
+                    messages = await asyncio.wait_for(self._fetch(fetcher), timeout)
+                except asyncio.TimeoutError:
+                    self._statuses[fetcherid] = RunStatus("timed out", started, time.time(), None,
+                        "The run took longer than its time limit of {} minutes.".format(fetcher.timelimit))
+                except Exception as exc:
+                    logger.warning("Fetcher %s failed: %s", fetcher.confname, exc)
+                    self._statuses[fetcherid] = RunStatus("failed", started, time.time(), None,
+                                                          str(exc) or type(exc).__name__)
+                else:
+                    self._statuses[fetcherid] = RunStatus("succeeded", started, time.time(), messages, None)
+        except asyncio.CancelledError:
+            self._statuses[fetcherid] = RunStatus("stopped", started, time.time(), None, None)
+            raise
+        finally:
+            if self._runs.get(fetcherid) is asyncio.current_task():
+                del self._runs[fetcherid]
+            self._last_finished[fetcherid] = time.monotonic()
+
+
+fetcher_supervisor = Supervisor()
@@ -0,0 +1,75 @@
+"""
+Deletes, in the background, the schedules and domains left behind by
+fetchers which were deleted before deletes cascaded to them (see
+crud.delete_fetchers_cascade), or with SQLite's foreign keys off.  It also
+purges the tombstones of rows deleted more than TOMBSTONE_DAYS ago (see
+crud.retrieve_changes).
+
+Orphans are deleted SWEEP_BATCH_SIZE at a time, one transaction per batch, so
+that a big backlog never holds the DB's write lock for long.
+"""
+
+import asyncio
+import datetime
+import logging
+
+import crud
+from database import open_db_session, run_db
+
+
+logger = logging.getLogger(__name__)
+
+# How often to look for orphans.
+SWEEP_SECONDS = 60 * 60
+# The most orphans to delete in one transaction.
+SWEEP_BATCH_SIZE = 500
+# How long clients which sync changes have to see a delete.
+TOMBSTONE_DAYS = 30
+
+_sweep_task = None
+
+
+async def sweep_orphans(batch_size=SWEEP_BATCH_SIZE):
+    """ Deletes every orphan.  @return the number of schedule rows and domain rows deleted. """
+    total_schedules = total_domains = 0
+    async with open_db_session() as db:
+        while True:
+            schedules, domains = await run_db(db, crud.delete_orphans, batch_size)
+            total_schedules += schedules
+            total_domains += domains
+            if not schedules and not domains:
+                break
+    if total_schedules or total_domains:
+        logger.info("Deleted %d orphaned schedules and %d orphaned domains.", total_schedules, total_domains)
+    return total_schedules, total_domains
+
+async def purge_tombstones(days=TOMBSTONE_DAYS):
+    """ @return the number of tombstones deleted. """
+    deleted_before = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    async with open_db_session() as db:
+        purged = await run_db(db, crud.purge_tombstones, deleted_before)
+    if purged:
+        logger.info("Purged %d tombstones.", purged)
+    return purged
+
+async def _sweep_forever():
+    while True:
+        try:
+            await sweep_orphans()
+            await purge_tombstones()
+        except Exception:
+            logger.exception("Could not sweep orphans.")
+        await asyncio.sleep(SWEEP_SECONDS)
+
+async def start():
+    """ Sweeps now, and then every SWEEP_SECONDS. """
+    global _sweep_task
+    if _sweep_task is None:
+        _sweep_task = asyncio.create_task(_sweep_forever())
+
+async def stop():
+    global _sweep_task
+    if _sweep_task is not None:
+        _sweep_task.cancel()
+        await asyncio.gather(_sweep_task, return_exceptions=True)
+        _sweep_task = None
@@ -6,28 +6,165 @@ Run like so:
 
 """
 
-from fastapi.testclient import TestClient
+import asyncio
+import base64
+import json
+import re
+import socketserver
+import threading
+import time
+import types
+from contextlib import contextmanager
 
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import main
 from main import app
-from database import get_db_session
+from database import get_db_session, get_async_db_session
+from supervisor import Supervisor, fetcher_supervisor
+from feed import ChangeFeed, fetcher_feed
+import changes
+import crud
+import database
+import downtime
+import fastapiutils
+import sweeper
+import benchmark
+import bus
+import cache
+import capture
+import replay
+import metrics
 import models
+import schemas
 import pytest
 
 client = TestClient(app)
 
-# This is a hack to empty out the DB which won't work for large-scale testing
-# with tons of tables.
-# TODO: replace with something similar to our cvxthree drop & recreate all tables logic.
-@pytest.fixture()
-def test_db():
-    db = next(get_db_session())
-    db.query(models.Fetcher).delete()
-    db.query(models.FetcherSchedule).delete()
-    db.execute("delete from sqlite_sequence where name='Fetchers';")
-    db.execute("delete from sqlite_sequence where name='FetcherSchedules';")
-    db.commit()
+################################ Test database ################################
+def make_memory_engine():
+    """
+    @return an engine on a private in-memory SQLite DB with the app's schema.
+        StaticPool makes every checkout the same connection, so the DB lives
+        as long as the engine.
+    """
+    memory_engine = create_engine("sqlite://", connect_args={"check_same_thread": False},
+                                  poolclass=StaticPool)
+    event.listen(memory_engine, "connect", database.enable_sqlite_foreign_keys)
+
+    # pysqlite begins and commits transactions behind SQLAlchemy's back,
+    # which breaks SAVEPOINTs.  Leave it to SQLAlchemy.
+    @event.listens_for(memory_engine, "connect")
+    def disable_pysqlite_transactions(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(memory_engine, "begin")
+    def begin(connection):
+        connection.exec_driver_sql("BEGIN")
+
+    database.Base.metadata.create_all(memory_engine)
+    return memory_engine
+
+@pytest.fixture(scope="session")
+def memory_engine():
+    memory_engine = make_memory_engine()
+    yield memory_engine
+    memory_engine.dispose()
+
+@pytest.fixture(scope="session", autouse=True)
+def checked_in_db_untouched():
+    """ Fails the run if any test wrote to the app's own DB, which is checked in with its seed data. """
+    with open(database.engine.url.database, "rb") as file:
+        contents = file.read()
     yield
-    db.close()
+    with open(database.engine.url.database, "rb") as file:
+        assert file.read() == contents, "A test wrote to " + database.engine.url.database
+
+def make_file_db(monkeypatch, path):
+    """
+    Points database.SessionLocal and the async sessions at a new SQLite DB at
+    path, for tests which need real commits, as the async driver's separate
+    connection does.
+    @return the sync and async engines.
+    """
+    file_engine = create_engine("sqlite:///" + path, connect_args={"check_same_thread": False})
+    event.listen(file_engine, "connect", database.enable_sqlite_foreign_keys)
+    database.Base.metadata.create_all(file_engine)
+    async_engine = create_async_engine("sqlite+aiosqlite:///" + path)
+    event.listen(async_engine.sync_engine, "connect", database.enable_sqlite_foreign_keys)
+    monkeypatch.setattr(database, "SessionLocal", sessionmaker(autocommit=False, autoflush=False, bind=file_engine))
+    monkeypatch.setattr(database, "async_engine", async_engine)
+    monkeypatch.setattr(database, "AsyncSessionLocal", sessionmaker(autocommit=False, autoflush=False,
+                                                                    bind=async_engine, class_=AsyncSession))
+    return file_engine, async_engine
+
+def forget_rolled_back_writes():
+    """
+    A test's writes disappear without a commit, so nothing told the caches
+    about them.
+    """
+    changes.bump_versions(database.Base.metadata.tables)
+    downtime.downtime_index.invalidate()
+    cache.fetcher_cache.clear()
+    cache.schedule_cache.clear()
+
+@pytest.fixture()
+def file_db(tmp_path, monkeypatch):
+    """ Gives the test its own SQLite file, with both sync and async sessions on it. """
+    file_engine, async_engine = make_file_db(monkeypatch, str(tmp_path / "test.db"))
+    with file_engine.connect() as connection:
+        yield connection
+    file_engine.dispose()
+    asyncio.run(async_engine.dispose())
+    forget_rolled_back_writes()
+
+@pytest.fixture()
+def test_db(request, memory_engine, monkeypatch):
+    """
+    Runs the test in a transaction on the in-memory DB which is rolled back
+    at the end, so every test starts from the same empty tables and IDs.
+
+    Every session the app opens, in routes and background tasks alike, comes
+    from database.SessionLocal, which is pointed at the test's connection.
+    Each session works inside a SAVEPOINT, which its commits and rollbacks
+    end and then start again, so they never end the test's transaction.
+
+    With database.USE_ASYNC, the routes' sessions can't share a sync
+    connection, so the test gets a file_db instead.
+
+    @return the test's connection.
+    """
+    if database.USE_ASYNC:
+        yield request.getfixturevalue("file_db")
+        return
+
+    connection = memory_engine.connect()
+    transaction = connection.begin()
+
+    def make_session():
+        session = Session(bind=connection, autoflush=False)
+        savepoint = connection.begin_nested()
+
+        @event.listens_for(session, "after_transaction_end")
+        def restart_savepoint(session, transaction):
+            nonlocal savepoint
+            if not savepoint.is_active:
+                savepoint = connection.begin_nested()
+        return session
+
+    monkeypatch.setattr(database, "SessionLocal", make_session)
+    try:
+        yield connection
+    finally:
+        transaction.rollback()
+        connection.close()
+        forget_rolled_back_writes()
 
 
 ############################# GET list tests #################################
@@ -321,6 +458,26 @@ def test_put_fetcher_nonexistant_id(test_db):
     assert response.status_code == 404
     assert response.json() == {'detail': 'Fetcher with ID 3 was not found.'}
 
+def test_put_fetcher_duplicate_name(test_db):
+    """
+     * PUT and PATCH on /fetcher/2/ with the name of fetcher 1 return a 500
+       which says so, as POST /fetcher/ does, and leave fetcher 2 as it was.
+    """
+    post_fetcher("fetcher01")
+    post_fetcher("fetcher02", domains="example.com")
+    detail = "Configuration name 'fetcher01' is already used by another fetcher."
+
+    response = client.put("/fetcher/2/", json=fetcher_json("fetcher01", domains="example.org"))
+    assert response.status_code == 500
+    assert response.json() == {"detail": detail}
+    response = client.patch("/fetcher/2/", json={"confname": "fetcher01", "description": "patched"})
+    assert response.status_code == 500
+    assert response.json() == {"detail": detail}
+
+    fetcher = client.get("/fetcher/2/").json()
+    assert (fetcher["name"], fetcher["description"]) == ("fetcher02", "Fetch from Intradyns journaling mailbox")
+    assert get_domain_match("example.com")["ids"] == [2]
+
 ############################## DELETE tests ##################################
 def test_delete_fetcher(test_db):
     """
@@ -742,3 +899,1648 @@ def test_restart_deactivate_fetchers(test_db):
 # TODO: add tests related to CRUDING fetcher schedules
 # TODO: add tests related to returning fetcher schedules in the GET fetcher payload
 # TODO: add tests related to order_by param on fetchers.
+
+
+############################# Pagination tests ################################
+def fetcher_json(name, **fields):
+    """ @return a default fetcher payload named name, with fields changed. """
+    fetcher_json = {
+        "name": name,
+        "server": "mailbox.intradyn.com",
+        "description": "Fetch from Intradyns journaling mailbox",
+        "username": "macie",
+        "password": "123abc",
+        "protocol": "IMAP4",
+        "port": 143,
+        "quick_delete": True,
+        "active": True,
+        "time_limit": 0,
+        "mailbox": "INBOX",
+        "domains": None
+    }
+    fetcher_json.update(fields)
+    return fetcher_json
+
+def post_fetcher(name, **fields):
+    """ POSTs a fetcher built from fetcher_json and returns the response JSON. """
+    response = client.post("/fetcher/", json=fetcher_json(name, **fields))
+    assert response.status_code == 201
+    return response.json()
+
+def get_all_pages(url, limit, **params):
+    """ Follows the X-Next-Cursor header until the last page of a list. """
+    items = []
+    cursor = None
+    while True:
+        page_params = dict(params, limit=limit)
+        if cursor is not None:
+            page_params["cursor"] = cursor
+        response = client.get(url, params=page_params)
+        assert response.status_code == 200
+        assert len(response.json()) <= limit
+        items += response.json()
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            return items
+
+def test_fetcher_list_pages_match_unpaginated_list(test_db):
+    """
+     * GET /fetcher/?limit=2 pages through the list in the same order as the
+       unpaginated GET /fetcher/, for the default order and multi-column
+       orders including a column with NULLs in it.
+    """
+    post_fetcher("fetcher03", active=False)
+    post_fetcher("fetcher01", protocol=None)
+    post_fetcher("fetcher05", active=False, protocol=None)
+    post_fetcher("fetcher02", protocol="POP3")
+    post_fetcher("fetcher04")
+
+    for order_by in [None, ["active desc", "name asc"], ["protocol desc", "name desc"], ["protocol", "active"]]:
+        params = {} if order_by is None else {"order_by": order_by}
+        expected_ids = [fetcher['id'] for fetcher in client.get("/fetcher/", params=params).json()]
+        assert len(expected_ids) == 5
+        paged_ids = [fetcher['id'] for fetcher in get_all_pages("/fetcher/", 2, **params)]
+        assert paged_ids == expected_ids
+
+def test_fetcher_list_page_seeks_index(test_db):
+    """
+     * A page after a cursor in the default order seeks the fetcher list's
+       index to the cursor, rather than scanning every fetcher before it.
+    """
+    post_fetcher("fetcher01")
+    post_fetcher("fetcher02")
+    cursor = client.get("/fetcher/", params={"limit": 1}).headers["X-Next-Cursor"]
+
+    query, _ = fastapiutils.add_keyset_pagination(Session(bind=test_db).query(models.Fetcher),
+        ["active desc", "name asc"], {"active": models.Fetcher.active, "name": models.Fetcher.confname},
+        models.Fetcher.fetcherid, cursor, 1)
+    statement = query.statement.compile(test_db, compile_kwargs={"literal_binds": True})
+    plan = [row.detail for row in test_db.exec_driver_sql("EXPLAIN QUERY PLAN {}".format(statement))]
+    assert plan == ["SEARCH fetchers USING INDEX ix_fetchers_active_confname (active<?)"]
+
+def test_fetcher_list_last_page_has_no_cursor(test_db):
+    """
+     * GET /fetcher/ with a limit larger than the list returns every fetcher
+       and no X-Next-Cursor header.
+    """
+    post_fetcher("fetcher01")
+    post_fetcher("fetcher02")
+
+    response = client.get("/fetcher/", params={"limit": 2})
+    assert response.status_code == 200
+    assert [fetcher['id'] for fetcher in response.json()] == [1, 2]
+    assert "X-Next-Cursor" not in response.headers
+
+def test_fetcher_list_bad_cursor(test_db):
+    """
+     * GET /fetcher/ returns a 400 for a cursor which isn't valid or which
+       was issued for a different order_by, including a crafted one whose
+       sort key isn't a list of plain values.
+    """
+    post_fetcher("fetcher01")
+    post_fetcher("fetcher02")
+
+    response = client.get("/fetcher/", params={"cursor": "garbage"})
+    assert response.status_code == 400
+
+    cursor = client.get("/fetcher/", params={"limit": 1}).headers["X-Next-Cursor"]
+    response = client.get("/fetcher/", params={"limit": 1, "cursor": cursor, "order_by": "server"})
+    assert response.status_code == 400
+
+    payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    for key in [[{}] * len(payload["key"]), [[1]] * len(payload["key"]), {"id": 1}, "1"]:
+        crafted = base64.urlsafe_b64encode(json.dumps(dict(payload, key=key)).encode()).decode()
+        response = client.get("/fetcher/", params={"limit": 1, "cursor": crafted})
+        assert response.status_code == 400, key
+
+def test_fetcherschedule_list_pages(test_db):
+    """
+     * GET /fetcherschedule/?limit=2 pages through every schedule by ID.
+    """
+    fetcher = post_fetcher("fetcher01")
+    for _ in range(5):
+        response = client.post("/fetcherschedule/", json={
+            "fetcher_id": fetcher['id'],
+            "downtime_days": "0,6",
+            "downtime_start": "08:15",
+            "downtime_end": "17:30"
+        })
+        assert response.status_code == 201
+
+    paged_ids = [schedule['id'] for schedule in get_all_pages("/fetcherschedule/", 2)]
+    assert paged_ids == [1, 2, 3, 4, 5]
+
+
+######################### Schedule loading tests ##############################
+@contextmanager
+def count_queries():
+    """
+    Counts the SQL statements run against the DB inside the with block, other
+    than the SAVEPOINTs which keep test_db's transaction open.
+    """
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if not statement.startswith(("SAVEPOINT ", "RELEASE SAVEPOINT ", "ROLLBACK TO SAVEPOINT ")):
+            statements.append(statement)
+    event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(Engine, "before_cursor_execute", before_cursor_execute)
+
+def post_schedule(fetcherid):
+    response = client.post("/fetcherschedule/", json={
+        "fetcher_id": fetcherid,
+        "downtime_days": "0,6",
+        "downtime_start": "08:15",
+        "downtime_end": "17:30"
+    })
+    assert response.status_code == 201
+    return response.json()
+
+def test_fetcher_list_query_count_is_constant(test_db):
+    """
+     * GET /fetcher/ runs the same number of queries for 2 fetchers as for 6,
+       and still returns every fetcher's schedules.
+    """
+    for i in range(2):
+        fetcher = post_fetcher("fetcher0{}".format(i))
+        post_schedule(fetcher['id'])
+        post_schedule(fetcher['id'])
+
+    with count_queries() as statements:
+        response = client.get("/fetcher/")
+    small_count = len(statements)
+    assert [len(fetcher['schedules']) for fetcher in response.json()] == [2, 2]
+
+    for i in range(2, 6):
+        fetcher = post_fetcher("fetcher0{}".format(i))
+        post_schedule(fetcher['id'])
+
+    with count_queries() as statements:
+        response = client.get("/fetcher/")
+    assert len(statements) == small_count
+    assert [len(fetcher['schedules']) for fetcher in response.json()] == [2, 2, 1, 1, 1, 1]
+
+def test_fetcher_expand_none_skips_schedules(test_db):
+    """
+     * GET /fetcher/?expand=none and GET /fetcher/1/?expand=none return null
+       schedules without querying the schedules table.
+    """
+    fetcher = post_fetcher("fetcher01")
+    post_schedule(fetcher['id'])
+
+    with count_queries() as statements:
+        response = client.get("/fetcher/", params={"expand": "none"})
+    assert response.status_code == 200
+    assert response.json()[0]['schedules'] is None
+    assert not [statement for statement in statements if "fetcherschedules" in statement]
+
+    response = client.get("/fetcher/1/", params={"expand": "none"})
+    assert response.status_code == 200
+    assert response.json()['schedules'] is None
+
+    response = client.get("/fetcher/1/")
+    assert response.status_code == 200
+    assert len(response.json()['schedules']) == 1
+
+
+############################ Async session tests ##############################
+def test_routes_with_async_session(file_db):
+    """
+     * With an AsyncSession (as when database.USE_ASYNC is True) fetchers and
+       schedules can be created, listed, updated and deleted.
+    """
+    app.dependency_overrides[get_db_session] = get_async_db_session
+    try:
+        fetcher = post_fetcher("fetcher01")
+        post_schedule(fetcher['id'])
+
+        response = client.get("/fetcher/")
+        assert response.status_code == 200
+        assert [len(fetcher['schedules']) for fetcher in response.json()] == [1]
+
+        response = client.patch("/fetcher/1/", json={"active": False})
+        assert response.status_code == 200
+        assert response.json()['active'] == False
+
+        response = client.delete("/fetcherschedule/1/")
+        assert response.status_code == 200
+
+        response = client.delete("/fetcher/1/")
+        assert response.status_code == 200
+        assert response.json()['schedules'] == []
+
+        response = client.get("/fetcher/1/")
+        assert response.status_code == 404
+    finally:
+        del app.dependency_overrides[get_db_session]
+
+
+############################## ETag tests ####################################
+def assert_not_modified(url):
+    """ GETs url twice and checks that the second GET is a 304 without any DB queries. """
+    response = client.get(url)
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+
+    with count_queries() as statements:
+        response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert response.content == b""
+    assert statements == []
+    return etag
+
+def assert_modified(url, old_etag):
+    response = client.get(url, headers={"If-None-Match": old_etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != old_etag
+
+def test_fetcher_etags(test_db):
+    """
+     * GET /fetcher/ and GET /fetcher/1/ answer a matching If-None-Match with
+       a 304 and no DB queries.
+     * Creating, updating, patching, batch activating/deactivating/deleting,
+       deleting a fetcher and adding a schedule all change the ETag.
+    """
+    post_fetcher("fetcher01")
+    writes = [
+        lambda: post_fetcher("fetcher02"),
+        lambda: client.put("/fetcher/1/", json={
+            "name": "fetcher01", "server": "mailbox.foo.com", "description": "Foo",
+            "username": "macie", "password": "123abc", "protocol": "IMAP4", "port": 143,
+            "quick_delete": True, "active": True, "time_limit": 0, "mailbox": "INBOX",
+            "domains": None}),
+        lambda: client.patch("/fetcher/1/", json={"server": "mailbox.bar.com"}),
+        lambda: client.post("/fetcher:deactivate/", json={"ids": [1]}),
+        lambda: client.post("/fetcher:activate/", json={"ids": [1]}),
+        lambda: post_schedule(1),
+        lambda: client.post("/fetcher:delete/", json={"ids": [2]}),
+    ]
+    for write in writes:
+        list_etag = assert_not_modified("/fetcher/")
+        detail_etag = assert_not_modified("/fetcher/1/")
+        write()
+        assert_modified("/fetcher/", list_etag)
+        assert_modified("/fetcher/1/", detail_etag)
+
+    list_etag = assert_not_modified("/fetcher/")
+    client.delete("/fetcher/1/")
+    assert_modified("/fetcher/", list_etag)
+
+def test_fetcherschedule_etags(test_db):
+    """
+     * GET /fetcherschedule/ answers a matching If-None-Match with a 304.
+     * Updating a fetcher doesn't change its ETag but adding a schedule does.
+    """
+    post_fetcher("fetcher01")
+    post_schedule(1)
+    etag = assert_not_modified("/fetcherschedule/")
+    assert_not_modified("/fetcherschedule/1/")
+
+    client.patch("/fetcher/1/", json={"server": "mailbox.bar.com"})
+    response = client.get("/fetcherschedule/", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    post_schedule(1)
+    assert_modified("/fetcherschedule/", etag)
+
+def test_failed_write_keeps_etag(test_db):
+    """
+     * A create which is rolled back because of a duplicate name doesn't
+       change the ETag.
+    """
+    post_fetcher("fetcher01")
+    etag = assert_not_modified("/fetcher/")
+    response = client.post("/fetcher/", json={"name": "fetcher01", "server": "x",
+        "description": "x", "quick_delete": False, "active": True, "mailbox": "INBOX"})
+    assert response.status_code == 500
+    response = client.get("/fetcher/", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+
+########################### Batch create tests ################################
+def test_batch_create_fetchers(test_db):
+    """
+     * POST /fetcher:batchCreate/ creates every fetcher and returns their IDs
+       in request order.
+     * The fetchers can then be read back with GET /fetcher/{id}/.
+    """
+    post_fetcher("fetcher00")
+    names = ["fetcher{:03}".format(i) for i in range(1, 201)]
+    response = client.post("/fetcher:batchCreate/", json=[fetcher_json(name) for name in names])
+    assert response.status_code == 201
+    assert response.json() == {"ids": list(range(2, 202)), "errors": []}
+
+    for fetcherid, name in [(2, names[0]), (101, names[99]), (201, names[199])]:
+        response = client.get("/fetcher/{}/".format(fetcherid))
+        assert response.status_code == 200
+        assert response.json()['name'] == name
+
+def test_batch_create_fetchers_errors(test_db):
+    """
+     * POST /fetcher:batchCreate/ with a name that is already used, or used
+       twice in the batch, creates nothing and lists the bad items.
+     * With ?partial=true it creates the other fetchers and reports the bad
+       items with null IDs.
+    """
+    post_fetcher("fetcher01")
+    batch = [fetcher_json("fetcher02"), fetcher_json("fetcher01"),
+             fetcher_json("fetcher03"), fetcher_json("fetcher02")]
+
+    response = client.post("/fetcher:batchCreate/", json=batch)
+    assert response.status_code == 500
+    assert response.json() == {"detail": [
+        {"index": 1, "detail": "Configuration name 'fetcher01' is already used by another fetcher."},
+        {"index": 3, "detail": "Configuration name 'fetcher02' is used more than once in this batch."},
+    ]}
+    assert len(client.get("/fetcher/").json()) == 1
+
+    response = client.post("/fetcher:batchCreate/", params={"partial": True}, json=batch)
+    assert response.status_code == 201
+    assert response.json()['ids'] == [2, None, 3, None]
+    assert [error['index'] for error in response.json()['errors']] == [1, 3]
+    assert sorted(fetcher['name'] for fetcher in client.get("/fetcher/").json()) == [
+        "fetcher01", "fetcher02", "fetcher03"]
+
+def test_batch_create_fetchers_null_fields(test_db, monkeypatch):
+    """
+     * POST /fetcher:batchCreate/ lists the items with a null field the DB
+       requires as errors, like any other bad item, and with ?partial=true
+       creates the rest.
+     * If the DB still rejects an item, with ?partial=true the items are
+       inserted one at a time and only the rejected ones fail, with what the
+       DB rejected them for.
+    """
+    batch = [fetcher_json("fetcher01", server=None), fetcher_json("fetcher02"),
+             fetcher_json("fetcher03", description=None)]
+    expected_errors = [{"index": 0, "detail": "'server' must not be null."},
+                       {"index": 2, "detail": "'description' must not be null."}]
+
+    response = client.post("/fetcher:batchCreate/", json=batch)
+    assert response.status_code == 500
+    assert response.json() == {"detail": expected_errors}
+
+    response = client.post("/fetcher:batchCreate/", params={"partial": True}, json=batch)
+    assert response.status_code == 201
+    assert response.json() == {"ids": [None, 1, None], "errors": expected_errors}
+
+    monkeypatch.setattr(crud, "get_not_null_error", lambda model, item: None)
+    batch = [fetcher_json("fetcher04"), fetcher_json("fetcher05", server=None), fetcher_json("fetcher06")]
+    response = client.post("/fetcher:batchCreate/", json=batch)
+    assert response.status_code == 500
+    assert response.json() == {"detail": "'server' must not be null."}
+
+    response = client.post("/fetcher:batchCreate/", params={"partial": True}, json=batch)
+    assert response.status_code == 201
+    assert response.json() == {"ids": [2, None, 3],
+                               "errors": [{"index": 1, "detail": "'server' must not be null."}]}
+    assert [fetcher["name"] for fetcher in client.get("/fetcher/").json()] == [
+        "fetcher02", "fetcher04", "fetcher06"]
+
+    # Postgres says which constraint failed in the error's diag.
+    orig = Exception("duplicate key value violates unique constraint")
+    orig.pgcode = "23505"
+    orig.diag = types.SimpleNamespace(column_name=None, constraint_name="fetchers_confname_key",
+                                      table_name="fetchers")
+    assert crud.get_integrity_error_constraint(IntegrityError("INSERT", {}, orig)) == ("unique", "confname")
+
+def test_batch_create_fetcherschedules(test_db):
+    """
+     * POST /fetcherschedule:batchCreate/?partial=true creates the schedules
+       of existing fetchers and reports the ones whose fetcher doesn't exist.
+    """
+    post_fetcher("fetcher01")
+    schedule = {"downtime_days": "1,2", "downtime_start": "22:00", "downtime_end": "06:00"}
+    response = client.post("/fetcherschedule:batchCreate/", params={"partial": True}, json=[
+        dict(schedule, fetcher_id=1), dict(schedule, fetcher_id=7), dict(schedule, fetcher_id=1)])
+    assert response.status_code == 201
+    assert response.json() == {"ids": [1, None, 2], "errors": [
+        {"index": 1, "detail": "Fetcher with ID 7 was not found."}]}
+
+    response = client.get("/fetcher/1/")
+    assert [schedule['id'] for schedule in response.json()['schedules']] == [1, 2]
+    assert response.json()['schedules'][0]['downtime_start'] == "22:00:00"
+
+
+############################## Export tests ###################################
+def test_export_fetchers(test_db):
+    """
+     * GET /fetcher:export/ streams one JSON line per fetcher, in ID order and
+       in the same format as GET /fetcher/{id}/, across more than one batch.
+    """
+    response = client.post("/fetcher:batchCreate/",
+        json=[fetcher_json("fetcher{:04}".format(i)) for i in range(1, 1202)])
+    assert response.status_code == 201
+    post_schedule(1)
+    post_schedule(1200)
+
+    response = client.get("/fetcher:export/")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = response.text.splitlines()
+    assert len(lines) == 1201
+    exported = [json.loads(line) for line in lines]
+    assert [fetcher['id'] for fetcher in exported] == list(range(1, 1202))
+    for fetcherid in [1, 2, 1200]:
+        assert exported[fetcherid - 1] == client.get("/fetcher/{}/".format(fetcherid)).json()
+
+def test_export_fetchers_with_async_session(file_db):
+    """
+     * GET /fetcher:export/ gives the same output with an AsyncSession.
+    """
+    post_fetcher("fetcher01")
+    post_fetcher("fetcher02")
+    post_schedule(2)
+    expected = client.get("/fetcher:export/").text
+
+    app.dependency_overrides[get_db_session] = get_async_db_session
+    try:
+        assert client.get("/fetcher:export/").text == expected
+    finally:
+        del app.dependency_overrides[get_db_session]
+
+
+############################## Import tests ###################################
+def ndjson(*items):
+    return "".join((item if isinstance(item, str) else json.dumps(item)) + "\n" for item in items)
+
+def test_import_fetchers(test_db):
+    """
+     * POST /fetcher:import/ creates one fetcher per valid line, committing
+       every chunk_size fetchers.
+     * Blank lines are skipped, and invalid lines and lines whose name is
+       already used are rejected with their line numbers.
+    """
+    post_fetcher("fetcher01")
+    body = ndjson(
+        fetcher_json("fetcher02"),
+        fetcher_json("fetcher01"),             # 2: name already used
+        "",
+        "{not json",                           # 4: not JSON
+        fetcher_json("fetcher03", port=0),     # 5: port out of range
+        fetcher_json("fetcher04"),
+        fetcher_json("fetcher02"),             # 7: name used earlier in the file
+        fetcher_json("fetcher05"),
+    )
+    response = client.post("/fetcher:import/", params={"chunk_size": 2}, data=body,
+        headers={"Content-Type": "application/x-ndjson"})
+    assert response.status_code == 200
+    summary = response.json()
+    assert (summary['inserted'], summary['updated'], summary['rejected']) == (3, 0, 4)
+    assert [rejected['line'] for rejected in summary['rejected_lines']] == [2, 4, 5, 7]
+    assert "port" in summary['rejected_lines'][2]['detail']
+
+    names = sorted(fetcher['name'] for fetcher in client.get("/fetcher/").json())
+    assert names == ["fetcher01", "fetcher02", "fetcher04", "fetcher05"]
+
+def test_import_fetchers_null_fields(test_db, monkeypatch):
+    """
+     * POST /fetcher:import/ rejects just the lines with a null field the DB
+       requires, not the rest of their chunk.
+     * If the DB still rejects a chunk, it is written a line at a time, and
+       only the lines the DB rejects are rejected.
+    """
+    body = ndjson(fetcher_json("fetcher01"), fetcher_json("fetcher02", description=None),
+                  fetcher_json("fetcher03"))
+    response = client.post("/fetcher:import/", data=body)
+    assert response.json() == {"inserted": 2, "updated": 0, "rejected": 1, "rejected_lines": [
+        {"line": 2, "detail": "'description' must not be null."}]}
+
+    monkeypatch.setattr(crud, "get_not_null_error", lambda model, item: None)
+    body = ndjson(fetcher_json("fetcher04"), fetcher_json("fetcher05", server=None),
+                  fetcher_json("fetcher06"))
+    response = client.post("/fetcher:import/", data=body)
+    assert response.json() == {"inserted": 2, "updated": 0, "rejected": 1, "rejected_lines": [
+        {"line": 2, "detail": "'server' must not be null."}]}
+    assert [fetcher["name"] for fetcher in client.get("/fetcher/").json()] == [
+        "fetcher01", "fetcher03", "fetcher04", "fetcher06"]
+
+def test_import_fetchers_upsert(test_db):
+    """
+     * POST /fetcher:import/?upsert=true updates fetchers whose name is
+       already used, and an exported fetcher list imports back unchanged.
+    """
+    post_fetcher("fetcher01")
+    post_fetcher("fetcher02")
+    export = client.get("/fetcher:export/").text
+
+    body = ndjson(fetcher_json("fetcher01", server="mailbox.foo.com"), fetcher_json("fetcher03"))
+    response = client.post("/fetcher:import/", params={"upsert": True}, data=body)
+    assert response.json() == {"inserted": 1, "updated": 1, "rejected": 0, "rejected_lines": []}
+    assert client.get("/fetcher/1/").json()['server'] == "mailbox.foo.com"
+
+    response = client.post("/fetcher:import/", params={"upsert": True}, data=export)
+    assert response.json() == {"inserted": 0, "updated": 2, "rejected": 0, "rejected_lines": []}
+    assert client.get("/fetcher/1/").json()['server'] == "mailbox.intradyn.com"
+    assert len(client.get("/fetcher/").json()) == 3
+
+
+############################# Downtime tests ##################################
+def get_downtime_ids(url, at):
+    response = client.get(url, params={"at": at})
+    assert response.status_code == 200
+    return response.json()['ids']
+
+def test_fetchers_in_downtime(test_db):
+    """
+     * GET /fetcher:inDowntime/ lists the fetchers whose schedules cover the
+       given time, including windows which cross midnight and the end of the
+       week (Saturday night into Sunday morning).
+     * GET /fetcher:runnable/ lists the active fetchers which aren't.
+    """
+    post_fetcher("fetcher01")
+    post_fetcher("fetcher02")
+    post_fetcher("fetcher03", active=False)
+    client.post("/fetcherschedule/", json={"fetcher_id": 1, "downtime_days": "6",
+        "downtime_start": "22:00", "downtime_end": "06:00"})
+    client.post("/fetcherschedule/", json={"fetcher_id": 2, "downtime_days": "1,2,3,4,5",
+        "downtime_start": "08:00", "downtime_end": "17:30"})
+
+    # 2024-01-06 is a Saturday.
+    assert get_downtime_ids("/fetcher:inDowntime/", "2024-01-06T21:59:00") == []
+    assert get_downtime_ids("/fetcher:inDowntime/", "2024-01-06T22:00:00") == [1]
+    assert get_downtime_ids("/fetcher:inDowntime/", "2024-01-07T05:59:00") == [1]
+    assert get_downtime_ids("/fetcher:inDowntime/", "2024-01-07T06:00:00") == []
+    assert get_downtime_ids("/fetcher:inDowntime/", "2024-01-05T23:00:00") == []
+    assert get_downtime_ids("/fetcher:inDowntime/", "2024-01-08T12:00:00") == [2]
+    assert get_downtime_ids("/fetcher:inDowntime/", "2024-01-08T17:30:00") == []
+
+    assert get_downtime_ids("/fetcher:runnable/", "2024-01-06T23:00:00") == [2]
+    assert get_downtime_ids("/fetcher:runnable/", "2024-01-08T12:00:00") == [1]
+    assert get_downtime_ids("/fetcher:runnable/", "2024-01-08T18:00:00") == [1, 2]
+
+def test_fetchers_in_downtime_follows_writes(test_db):
+    """
+     * GET /fetcher:inDowntime/ reflects schedules which are added, updated
+       and deleted, and fetchers which are deleted, after it was last called.
+    """
+    post_fetcher("fetcher01")
+    post_fetcher("fetcher02")
+    monday_noon = "2024-01-08T12:00:00"
+    assert get_downtime_ids("/fetcher:inDowntime/", monday_noon) == []
+
+    client.post("/fetcherschedule/", json={"fetcher_id": 1, "downtime_days": "1",
+        "downtime_start": "11:00", "downtime_end": "13:00"})
+    client.post("/fetcherschedule/", json={"fetcher_id": 2, "downtime_days": "1",
+        "downtime_start": "00:00", "downtime_end": "00:00"})
+    assert get_downtime_ids("/fetcher:inDowntime/", monday_noon) == [1, 2]
+
+    client.put("/fetcherschedule/1/", json={"fetcher_id": 1, "downtime_days": "2",
+        "downtime_start": "11:00", "downtime_end": "13:00"})
+    assert get_downtime_ids("/fetcher:inDowntime/", monday_noon) == [2]
+    assert get_downtime_ids("/fetcher:inDowntime/", "2024-01-09T12:00:00") == [1]
+
+    client.delete("/fetcherschedule/1/")
+    assert get_downtime_ids("/fetcher:inDowntime/", "2024-01-09T12:00:00") == []
+
+    client.post("/fetcher:delete/", json={"ids": [2]})
+    assert get_downtime_ids("/fetcher:inDowntime/", monday_noon) == []
+
+
+
+############################### Filter tests ##################################
+def get_fetcher_names(**params):
+    response = client.get("/fetcher/", params=params)
+    assert response.status_code == 200
+    return [fetcher['name'] for fetcher in response.json()]
+
+def test_fetcher_list_filters(test_db):
+    """
+     * GET /fetcher/ filters by active, protocol, server, server_prefix and
+       name_prefix, and combines them, keeping its sort order and paging.
+     * Prefixes are case sensitive.
+    """
+    post_fetcher("alpha01", server="mail.example.com", protocol="IMAP4")
+    post_fetcher("alpha02", server="mail.example.org", protocol="POP3", active=False)
+    post_fetcher("beta01", server="mx.example.com", protocol="POP3")
+    post_fetcher("Alpha03", server="mail.example.com", protocol="POP3")
+
+    assert get_fetcher_names(active=True) == ["Alpha03", "alpha01", "beta01"]
+    assert get_fetcher_names(active=False) == ["alpha02"]
+    assert get_fetcher_names(protocol="POP3") == ["Alpha03", "beta01", "alpha02"]
+    assert get_fetcher_names(server="mail.example.com") == ["Alpha03", "alpha01"]
+    assert get_fetcher_names(server_prefix="mail.") == ["Alpha03", "alpha01", "alpha02"]
+    assert get_fetcher_names(server_prefix="MAIL.") == []
+    assert get_fetcher_names(name_prefix="alpha") == ["alpha01", "alpha02"]
+    assert get_fetcher_names(name_prefix="alpha", protocol="POP3", active=False) == ["alpha02"]
+    assert get_fetcher_names(server_prefix="mail.", order_by="name desc") == ["alpha02", "alpha01", "Alpha03"]
+
+    fetchers = get_all_pages("/fetcher/", 1, protocol="POP3")
+    assert [fetcher['name'] for fetcher in fetchers] == ["Alpha03", "beta01", "alpha02"]
+
+
+
+############################### Search tests ##################################
+def get_search_names(q, **params):
+    response = client.get("/fetcher:search/", params=dict(params, q=q))
+    assert response.status_code == 200
+    return [fetcher['name'] for fetcher in response.json()]
+
+def test_search_fetchers(test_db):
+    """
+     * GET /fetcher:search/ finds fetchers by word prefixes in their name,
+       description, server and domains, with every word having to match.
+     * Name matches rank above server and domains matches, which rank above
+       description matches.
+     * The index follows creates, updates, imports and deletes.
+    """
+    post_fetcher("acme", server="mail.acme.com", description="Journal mailbox")
+    post_fetcher("globex", server="imap.globex.net", description="Old acme archive",
+                 domains="globex.net,acmecorp.com")
+    post_fetcher("initech", server="pop.initech.org", description="Journaling for initech")
+
+    assert get_search_names("acme") == ["acme", "globex"]
+    assert get_search_names("ACM") == ["acme", "globex"]
+    assert get_search_names("journ") == ["acme", "initech"]
+    assert get_search_names("journ initech") == ["initech"]
+    assert get_search_names("acmecorp.com") == ["globex"]
+    assert get_search_names("nothing") == []
+    assert get_search_names("...") == []
+    assert get_search_names("acme", limit=1) == ["acme"]
+
+    client.patch("/fetcher/3/", json={"description": "Weekly acme backup"})
+    assert get_search_names("acme") == ["acme", "globex", "initech"]
+    assert get_search_names("journ") == ["acme"]
+
+    client.post("/fetcher:import/", data=ndjson(fetcher_json("umbrella", description="acme spinoff")))
+    assert "umbrella" in get_search_names("spinoff acme")
+
+    client.post("/fetcher:delete/", json={"ids": [1, 2]})
+    assert sorted(get_search_names("acme")) == ["initech", "umbrella"]
+
+
+
+############################### Domain tests ##################################
+def get_domain_match(domain, **params):
+    response = client.get("/fetcher:byDomain/", params=dict(params, domain=domain))
+    assert response.status_code == 200
+    return response.json()
+
+def test_fetchers_by_domain(test_db):
+    """
+     * GET /fetcher:byDomain/ finds the fetchers which list a domain, case
+       insensitively, and falls back to the closest parent domain unless
+       subdomains is false.
+     * POST /fetcher:byDomain/ answers for many domains at once, in order.
+    """
+    post_fetcher("fetcher01", domains="example.com, Example.org")
+    post_fetcher("fetcher02", domains="mail.example.com,example.net")
+    post_fetcher("fetcher03", domains="example.net")
+    post_fetcher("fetcher04")
+
+    assert get_domain_match("EXAMPLE.com") == {"domain": "EXAMPLE.com", "matched_domain": "example.com", "ids": [1]}
+    assert get_domain_match("example.net")["ids"] == [2, 3]
+    assert get_domain_match("mail.example.com")["ids"] == [2]
+    assert get_domain_match("a.b.example.com") == \
+        {"domain": "a.b.example.com", "matched_domain": "example.com", "ids": [1]}
+    assert get_domain_match("a.example.org", subdomains=False) == \
+        {"domain": "a.example.org", "matched_domain": None, "ids": []}
+    assert get_domain_match("example.info")["ids"] == []
+
+    response = client.post("/fetcher:byDomain/", json={"domains": ["x.example.org", "example.net", "nowhere.test"]})
+    assert response.status_code == 200
+    assert [match["ids"] for match in response.json()] == [[1], [2, 3], []]
+
+def test_fetchers_by_domain_follows_writes(test_db):
+    """
+     * The domain index follows PUT, PATCH, delete, batch create, batch
+       delete and import.
+    """
+    post_fetcher("fetcher01", domains="example.com")
+    client.patch("/fetcher/1/", json={"domains": "example.org"})
+    assert get_domain_match("example.com")["ids"] == []
+    assert get_domain_match("example.org")["ids"] == [1]
+
+    client.put("/fetcher/1/", json=fetcher_json("fetcher01", domains=None))
+    assert get_domain_match("example.org")["ids"] == []
+
+    client.post("/fetcher:batchCreate/", json=[fetcher_json("fetcher02", domains="example.com"),
+                                               fetcher_json("fetcher03", domains="example.com")])
+    client.post("/fetcher:import/", params={"upsert": True},
+        data=ndjson(fetcher_json("fetcher01", domains="example.com"), fetcher_json("fetcher04", domains="example.com")))
+    assert get_domain_match("example.com")["ids"] == [1, 2, 3, 4]
+
+    client.post("/fetcher:delete/", json={"ids": [2, 3]})
+    client.delete("/fetcher/4/")
+    assert get_domain_match("example.com")["ids"] == [1]
+
+
+
+
+############################ Batch selection tests ############################
+def test_batch_operations_return_changed_ids(test_db):
+    """
+     * POST /fetcher:activate/, :deactivate/ and :delete/ return the IDs of the
+       fetchers they changed, leaving out ones which were already in that
+       state or don't exist.
+     * They take a filter instead of IDs.
+     * Giving both or neither, or an empty filter, is a 422.
+    """
+    post_fetcher("fetcher01", protocol="IMAP4", server="mail.example.com")
+    post_fetcher("fetcher02", protocol="POP3", server="mail.example.com")
+    post_fetcher("fetcher03", protocol="IMAP4", server="mx.example.com", active=False)
+
+    response = client.post("/fetcher:deactivate/", json={"ids": [1, 3, 5]})
+    assert response.status_code == 200
+    assert response.json() == {"ids": [1]}
+
+    response = client.post("/fetcher:activate/", json={"filter": {"protocol": "IMAP4"}})
+    assert response.json() == {"ids": [1, 3]}
+    response = client.post("/fetcher:activate/", json={"filter": {"protocol": "IMAP4"}})
+    assert response.json() == {"ids": []}
+
+    response = client.post("/fetcher:delete/", json={"filter": {"server_prefix": "mail.", "protocol": "POP3"}})
+    assert response.json() == {"ids": [2]}
+    assert [fetcher['id'] for fetcher in client.get("/fetcher/").json()] == [1, 3]
+
+    for body in [{}, {"ids": [1], "filter": {"active": True}}, {"filter": {}}]:
+        response = client.post("/fetcher:delete/", json=body)
+        assert response.status_code == 422
+    assert len(client.get("/fetcher/").json()) == 2
+
+def test_batch_operations_with_many_ids(test_db):
+    """
+     * Batch operations take more IDs than SQLite allows bound parameters in
+       one statement, in the same number of statements as a few IDs.
+    """
+    count = 3000
+    response = client.post("/fetcher:batchCreate/",
+        json=[fetcher_json("fetcher{:04}".format(i), domains="example.com") for i in range(count)])
+    ids = response.json()['ids']
+
+    with count_queries() as statements:
+        response = client.post("/fetcher:deactivate/", json={"ids": ids + [count + 1]})
+    assert response.json() == {"ids": ids}
+    statement_count = len(statements)
+
+    with count_queries() as statements:
+        response = client.post("/fetcher:activate/", json={"ids": ids[:10]})
+    assert response.json() == {"ids": ids[:10]}
+    assert len(statements) <= statement_count
+
+    response = client.post("/fetcher:delete/", json={"ids": ids[5:]})
+    assert response.json() == {"ids": ids[5:]}
+    assert [fetcher['id'] for fetcher in client.get("/fetcher/").json()] == ids[:5]
+    assert get_domain_match("example.com")["ids"] == ids[:5]
+
+
+
+############################ Cascading delete tests ###########################
+def test_delete_fetchers_cascades(test_db):
+    """
+     * Deleting fetchers, one at a time or in a batch, deletes their schedules
+       and domains, in as many statements for thousands as for one.
+     * A schedule can't be added to a fetcher which doesn't exist.
+    """
+    count = 1500
+    ids = client.post("/fetcher:batchCreate/",
+        json=[fetcher_json("fetcher{:04}".format(i), domains="example.com") for i in range(count)]).json()['ids']
+    client.post("/fetcherschedule:batchCreate/", json=[{"fetcher_id": fetcherid, "downtime_days": "1",
+        "downtime_start": "11:00", "downtime_end": "13:00"} for fetcherid in ids])
+
+    with count_queries() as statements:
+        response = client.post("/fetcher:delete/", json={"ids": ids[:1]})
+    assert response.json() == {"ids": ids[:1]}
+    statement_count = len(statements)
+
+    with count_queries() as statements:
+        response = client.post("/fetcher:delete/", json={"ids": ids[1:-1]})
+    assert response.json() == {"ids": ids[1:-1]}
+    assert len(statements) <= statement_count + 3  # filling the temporary table
+
+    response = client.delete("/fetcher/{}/".format(ids[-1]))
+    assert response.status_code == 200
+    assert client.get("/fetcherschedule/").json() == []
+    assert get_domain_match("example.com")["ids"] == []
+
+    response = client.post("/fetcherschedule/", json={"fetcher_id": ids[0], "downtime_days": "1",
+        "downtime_start": "11:00", "downtime_end": "13:00"})
+    assert response.status_code == 404
+
+@contextmanager
+def without_foreign_keys(connection):
+    """
+    Lets rows which break foreign keys be written on the connection.  Inside
+    test_db's transaction foreign keys can't be turned off, only deferred to
+    its commit, which never comes.
+    """
+    if connection.in_transaction():
+        connection.exec_driver_sql("PRAGMA defer_foreign_keys = ON")
+        yield
+        return
+    connection.exec_driver_sql("PRAGMA foreign_keys = OFF")
+    try:
+        yield
+    finally:
+        connection.exec_driver_sql("PRAGMA foreign_keys = ON")
+
+def test_sweep_orphans(test_db):
+    """
+     * The sweeper deletes schedules and domains whose fetcher is gone, left
+       behind from before deletes cascaded, in batches.
+     * Deleting just domains changes the ETag of GET /fetcher:byDomain/.
+    """
+    post_fetcher("fetcher01", domains="example.com")
+    post_schedule(1)
+    with without_foreign_keys(test_db):
+        for fetcherid in [7, 8, 9]:
+            test_db.exec_driver_sql("INSERT INTO fetcherschedules (fetcherid, downtimedays, downtimestart, "
+                "downtimeend) VALUES ({}, '1', '11:00:00.000000', '13:00:00.000000')".format(fetcherid))
+            test_db.exec_driver_sql("INSERT INTO fetcherdomains (domain, fetcherid) "
+                "VALUES ('example.org', {})".format(fetcherid))
+
+    assert asyncio.run(sweeper.sweep_orphans(batch_size=2)) == (3, 3)
+    assert asyncio.run(sweeper.sweep_orphans(batch_size=2)) == (0, 0)
+    assert [schedule['fetcher_id'] for schedule in client.get("/fetcherschedule/").json()] == [1]
+    assert get_domain_match("example.com")["ids"] == [1]
+    assert get_domain_match("example.org")["ids"] == []
+
+    with without_foreign_keys(test_db):
+        test_db.exec_driver_sql("INSERT INTO fetcherdomains (domain, fetcherid) VALUES ('example.org', 10)")
+    response = client.get("/fetcher:byDomain/", params={"domain": "example.org"})
+    assert response.json()["ids"] == [10]
+    assert asyncio.run(sweeper.sweep_orphans()) == (0, 1)
+    response = client.get("/fetcher:byDomain/", params={"domain": "example.org"},
+                          headers={"If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 200
+    assert response.json()["ids"] == []
+
+
+############################ Update path tests ################################
+def test_patch_fetcher_query_count(test_db):
+    """
+     * PATCH /fetcher/{id}/ writes and reads back the fetcher with one UPDATE
+       ... RETURNING (an UPDATE and a SELECT on SQLite), plus one SELECT of
+       its schedules unless ?expand=none.
+     * Null fields in a PATCH are left as they are.
+     * PATCH /fetcher/{id}/ and PUT /fetcherschedule/{id}/ 404 when the row
+       doesn't exist.
+    """
+    post_fetcher("fetcher01")
+    post_schedule(1)
+
+    with count_queries() as statements:
+        response = client.patch("/fetcher/1/", params={"expand": "none"},
+                                json={"server": "mailbox.foo.com", "description": None})
+    assert response.status_code == 200
+    assert response.json()['server'] == "mailbox.foo.com"
+    assert response.json()['description'] == "Fetch from Intradyns journaling mailbox"
+    assert response.json()['schedules'] is None
+    assert [statement.split()[0] for statement in statements] == ["UPDATE", "SELECT"]
+
+    response = client.patch("/fetcher/1/", json={"active": False})
+    assert response.json()['active'] == False
+    assert len(response.json()['schedules']) == 1
+    assert client.get("/fetcher/1/").json() == response.json()
+
+    response = client.patch("/fetcher/9/", json={"active": False})
+    assert response.status_code == 404
+    response = client.put("/fetcherschedule/9/", json={"fetcher_id": 1, "downtime_days": "1",
+        "downtime_start": "11:00", "downtime_end": "13:00"})
+    assert response.status_code == 404
+
+
+def test_fast_json_matches_validated_json(test_db, monkeypatch):
+    """
+     * With main.USE_FAST_JSON, the GET routes which list or read fetchers and
+       schedules return byte for byte the same JSON as without it, for
+       fetchers with and without schedules, times, nulls and non-ASCII text.
+     * The X-Next-Cursor and ETag headers are still sent.
+    """
+    post_fetcher("fetcher01", description="Relevé du journal ✓", domains="example.com")
+    post_fetcher("fetcher02", username=None, port=None)
+    post_schedule(1)
+    post_schedule(1)
+
+    urls = [("/fetcher/", {}), ("/fetcher/", {"limit": 1}), ("/fetcher/", {"expand": "none"}),
+            ("/fetcher/1/", {}), ("/fetcher/2/", {"expand": "none"}), ("/fetcher:search/", {"q": "releve"}),
+            ("/fetcherschedule/", {"limit": 1}), ("/fetcherschedule/2/", {})]
+    slow_responses = [client.get(url, params=params) for url, params in urls]
+    monkeypatch.setattr(main, "USE_FAST_JSON", True)
+    fast_responses = [client.get(url, params=params) for url, params in urls]
+
+    for slow_response, fast_response in zip(slow_responses, fast_responses):
+        assert fast_response.status_code == 200
+        assert fast_response.content == slow_response.content
+        assert fast_response.headers["content-type"] == "application/json"
+        assert fast_response.headers["ETag"] == slow_response.headers["ETag"]
+        assert fast_response.headers.get("X-Next-Cursor") == slow_response.headers.get("X-Next-Cursor")
+    assert fast_responses[1].headers["X-Next-Cursor"] is not None
+    assert client.get("/fetcher/9/").status_code == 404
+
+
+def test_fetcher_sparse_fields(test_db, monkeypatch):
+    """
+     * GET /fetcher/?fields=... and GET /fetcher/{id}/?fields=... return just
+       the asked for fields, by the names the API shows them.
+     * Only those columns are selected from the DB, and schedules are only
+       loaded if they are asked for.  (A cached detail read reads the whole
+       fetcher once, for every shape.)
+     * Paging by a column which isn't one of the fields still works.
+     * An unknown field is a 422.
+    """
+    for i in range(1, 6):
+        post_fetcher("fetcher{:02}".format(i), protocol="POP3" if i % 2 else "IMAP4")
+    post_schedule(1)
+
+    with count_queries() as statements:
+        response = client.get("/fetcher/", params={"fields": ["name", "server"]})
+    assert response.status_code == 200
+    assert response.json()[0] == {"name": "fetcher01", "server": "mailbox.intradyn.com"}
+    assert len(statements) == 1
+    assert "password" not in statements[0] and "description" not in statements[0]
+
+    monkeypatch.setattr(cache, "USE_CACHE", False)
+    with count_queries() as statements:
+        response = client.get("/fetcher/1/", params={"fields": ["id", "schedules"]})
+    monkeypatch.setattr(cache, "USE_CACHE", True)
+    assert response.json() == {"id": 1, "schedules": [
+        {"fetcher_id": 1, "downtime_days": "0,6", "downtime_start": "08:15:00", "downtime_end": "17:30:00",
+         "id": 1}]}
+    assert len(statements) == 2
+    assert "confname" not in statements[0]
+
+    response = client.get("/fetcher/1/", params={"fields": ["schedules"], "expand": "none"})
+    assert response.json() == {"schedules": None}
+
+    params = {"fields": "name", "order_by": ["protocol desc", "name"]}
+    pages = get_all_pages("/fetcher/", 2, **params)
+    assert pages == client.get("/fetcher/", params=params).json()
+    assert [fetcher["name"] for fetcher in pages] == [
+        "fetcher01", "fetcher03", "fetcher05", "fetcher02", "fetcher04"]
+
+    assert client.get("/fetcher/", params={"fields": "confname"}).status_code == 422
+    assert client.get("/fetcher/9/", params={"fields": "name"}).status_code == 404
+
+
+def get_changes(since, **params):
+    response = client.get("/fetcher:changes/", params=dict(params, since=since))
+    assert response.status_code == 200
+    return response.json()
+
+def test_fetcher_changes(test_db):
+    """
+     * GET /fetcher:changes/?since=<token> returns the fetchers and schedules
+       inserted or updated, and the IDs of those deleted (by any route,
+       including the batch :delete and cascades), since the token, with a new
+       token.
+     * With ?limit=, the changes come in order in pages of at most limit,
+       however many of them are of one kind.
+     * A token from before purged tombstones is a 410, even to a client
+       which holds the ETag of its last 200.
+    """
+    start = get_changes(0)
+    assert start["fetchers"] == [] and start["deleted_fetcher_ids"] == []
+
+    for i in range(1, 4):
+        post_fetcher("fetcher{:02}".format(i))
+    post_schedule(1)
+    changes = get_changes(start["token"])
+    assert [fetcher["name"] for fetcher in changes["fetchers"]] == ["fetcher01", "fetcher02", "fetcher03"]
+    assert all(fetcher["schedules"] is None for fetcher in changes["fetchers"])
+    assert [schedule["id"] for schedule in changes["schedules"]] == [1]
+    assert changes["more"] == False
+    token = changes["token"]
+    assert get_changes(token)["fetchers"] == []
+
+    client.patch("/fetcher/2/", json={"active": False})
+    client.post("/fetcher:delete/", json={"ids": [1, 3]})
+    changes = get_changes(token)
+    assert [(fetcher["id"], fetcher["active"]) for fetcher in changes["fetchers"]] == [(2, False)]
+    assert changes["schedules"] == []
+    assert sorted(changes["deleted_fetcher_ids"]) == [1, 3]
+    assert changes["deleted_schedule_ids"] == [1]
+
+    pages = []
+    since = start["token"]
+    while True:
+        page = get_changes(since, limit=2)
+        pages.append(page)
+        since = page["token"]
+        if not page["more"]:
+            break
+    assert [len(page["fetchers"] + page["schedules"] + page["deleted_fetcher_ids"] +
+                page["deleted_schedule_ids"]) for page in pages] == [2, 2]
+    assert [fetcher["id"] for page in pages for fetcher in page["fetchers"]] == [2]
+    assert since == changes["token"]
+
+    etag = client.get("/fetcher:changes/", params={"since": token}).headers["ETag"]
+    assert asyncio.run(sweeper.purge_tombstones(days=1)) == 0
+    assert asyncio.run(sweeper.purge_tombstones(days=-1)) == 3
+    response = client.get("/fetcher:changes/", params={"since": token}, headers={"If-None-Match": etag})
+    assert response.status_code == 410
+    assert get_changes(changes["token"])["deleted_fetcher_ids"] == []
+
+    # More fetchers than fit in a page.
+    for i in range(4, 7):
+        post_fetcher("fetcher{:02}".format(i))
+    page = get_changes(changes["token"], limit=2)
+    assert [fetcher["name"] for fetcher in page["fetchers"]] == ["fetcher04", "fetcher05"]
+    assert page["more"] == True
+    page = get_changes(page["token"], limit=2)
+    assert [fetcher["name"] for fetcher in page["fetchers"]] == ["fetcher06"]
+    assert page["more"] == False
+
+
+class FeedReader:
+    """ Reads the events of a feed stream, which can send several in one chunk, skipping comments. """
+    def __init__(self, stream):
+        self.stream = stream
+        self.events = []
+
+    async def read(self):
+        """ @return (id, event, data) of the next event. """
+        while not self.events:
+            chunk = (await asyncio.wait_for(anext(self.stream), 5)).decode()
+            for message in chunk.split("\n\n"):
+                if message and not message.startswith((":", "retry:")):
+                    fields = dict(line.split(": ", 1) for line in message.split("\n"))
+                    self.events.append((fields["id"], fields["event"], json.loads(fields["data"])))
+        return self.events.pop(0)
+
+def test_fetcher_feed(test_db):
+    """
+     * The feed has an event for each committed write to fetchers and
+       schedules, from every route, with the IDs written.
+     * A stream opened with a Last-Event-ID gets the events after it, and one
+       with an ID it doesn't know gets a reset.
+    """
+    async def watch():
+        stream = fetcher_feed.stream()
+        assert (await anext(stream)).startswith(b"retry: ")
+        reader = FeedReader(stream)
+        post_fetcher("fetcher01")
+        post_fetcher("fetcher02")
+        post_schedule(2)
+        client.post("/fetcher:deactivate/", json={"ids": [1, 2]})
+        client.post("/fetcher:delete/", json={"ids": [1]})
+        client.delete("/fetcherschedule/1/")
+
+        events = [await reader.read() for _ in range(6)]
+        assert [(event, data) for _, event, data in events] == [
+            ("fetcher.create", {"ids": [1]}), ("fetcher.create", {"ids": [2]}),
+            ("schedule.create", {"ids": [1]}), ("fetcher.deactivate", {"ids": [1, 2]}),
+            ("fetcher.delete", {"ids": [1]}), ("schedule.delete", {"ids": [1]})]
+
+        resumed = fetcher_feed.stream(events[2][0])
+        await anext(resumed)
+        resumed_reader = FeedReader(resumed)
+        assert [await resumed_reader.read() for _ in range(3)] == events[3:]
+        await resumed.aclose()
+
+        unknown = fetcher_feed.stream("0-1")
+        await anext(unknown)
+        assert (await FeedReader(unknown).read())[1:] == ("reset", {"ids": None})
+        await unknown.aclose()
+
+        await stream.aclose()
+        assert fetcher_feed.get_subscriber_count() == 0
+    asyncio.run(watch())
+
+
+def test_fetcher_feed_backpressure():
+    """
+     * A subscriber which falls more than queue_size events behind gets one
+       reset in place of them, without holding up the others.
+     * A Last-Event-ID older than the buffered events gets a reset.
+    """
+    feed = ChangeFeed(buffer_size=4, queue_size=3)
+    def commit(fetcherid):
+        feed.on_commit([changes.Change(models.Fetcher.__tablename__, "update", frozenset([fetcherid]))])
+
+    async def watch():
+        slow, fast = feed.stream(), feed.stream()
+        await anext(slow)
+        await anext(fast)
+        slow_reader, fast_reader = FeedReader(slow), FeedReader(fast)
+        first_id = None
+        for fetcherid in range(1, 6):
+            commit(fetcherid)
+            await asyncio.sleep(0)
+            event_id, event, data = await fast_reader.read()
+            assert (event, data) == ("fetcher.update", {"ids": [fetcherid]})
+            first_id = first_id or event_id
+        # Events 1 - 3 filled its queue, so 4 became a reset, after which it
+        # carries on as usual.
+        assert (await slow_reader.read())[1:] == ("reset", {"ids": None})
+        assert (await slow_reader.read())[1:] == ("fetcher.update", {"ids": [5]})
+
+        stale = feed.stream(first_id)
+        await anext(stale)
+        assert (await FeedReader(stale).read())[1] == "reset"
+        for stream in [slow, fast, stale]:
+            await stream.aclose()
+    asyncio.run(watch())
+
+
+def test_metrics(file_db, monkeypatch):
+    """
+     * Requests are counted by route template and status code, and timed,
+       along with the SQL statements they run.
+     * GET /metrics serves the metrics in the Prometheus text format.
+     * With metrics.SERVER_TIMING, responses have a Server-Timing header.
+     * A request which runs the same SELECT N_PLUS_ONE_THRESHOLD times is
+       flagged.
+    """
+    detail = {"method": "GET", "route": "/fetcher/{fetcherid}/"}
+    requests_before = metrics.requests_total.get(dict(detail, status=200))
+    queries_before = metrics.db_queries_total.get(detail)
+    post_fetcher("fetcher01")
+    post_schedule(1)
+    assert client.get("/fetcher/1/").status_code == 200
+    assert client.get("/fetcher/9/").status_code == 404
+    assert client.get("/no/such/thing").status_code == 404
+
+    assert metrics.requests_total.get(dict(detail, status=200)) == requests_before + 1
+    # The fetcher and its schedules, and then the fetcher which wasn't found.
+    assert metrics.db_queries_total.get(detail) == queries_before + 3
+    assert metrics.requests_in_flight.get(detail) == 0
+
+    response = client.get("/metrics")
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    lines = response.text.splitlines()
+    assert any(line.startswith('http_requests_total{method="GET",route="(unmatched)",status="404"} ')
+               for line in lines)
+    assert 'http_requests_in_flight{method="GET",route="/metrics"} 1' in lines
+    assert any(line.startswith('http_request_duration_seconds_bucket{method="GET",route="/fetcher/{fetcherid}/",'
+                               'le="+Inf"}') for line in lines)
+    assert "# TYPE db_query_duration_seconds histogram" in lines
+
+    assert "Server-Timing" not in client.get("/fetcher/1/").headers
+    monkeypatch.setattr(metrics, "SERVER_TIMING", True)
+    assert re.fullmatch(r'db;dur=[0-9.]+;desc="2 queries", app;dur=[0-9.]+',
+                        client.get("/fetcher/").headers["Server-Timing"])
+
+    labels = {"method": "GET", "route": "test"}
+    stats = metrics.RequestStats()
+    token = metrics.current_request_stats.set(stats)
+    try:
+        db = next(get_db_session())
+        for _ in range(metrics.N_PLUS_ONE_THRESHOLD):
+            db.query(models.Fetcher).filter(models.Fetcher.fetcherid == 1).one()
+        db.close()
+    finally:
+        metrics.current_request_stats.reset(token)
+    assert stats.queries == metrics.N_PLUS_ONE_THRESHOLD
+    metrics.check_n_plus_one(labels, stats)
+    assert metrics.db_n_plus_one_total.get(labels) == 1
+
+
+############################# Supervisor tests ################################
+class FakeMailServer(socketserver.ThreadingTCPServer):
+    """
+    A local POP3 or IMAP server which accepts the password "secret", has
+    `messages` messages, and takes `delay` seconds to answer STAT / EXAMINE.
+    """
+    daemon_threads = True
+
+    def __init__(self, protocol, messages, delay):
+        super().__init__(("127.0.0.1", 0), FakeMailHandler)
+        self.protocol = protocol
+        self.messages = messages
+        self.delay = delay
+        self.released = threading.Event()
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.max_connections = 0
+
+    def handle_error(self, request, client_address):
+        pass  # Clients which are stopped mid-run hang up on us.
+
+class FakeMailHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        with self.server.lock:
+            self.server.connections += 1
+            self.server.max_connections = max(self.server.max_connections, self.server.connections)
+        try:
+            if self.server.protocol == "POP3":
+                self.handle_pop3()
+            else:
+                self.handle_imap()
+        finally:
+            with self.server.lock:
+                self.server.connections -= 1
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle_pop3(self):
+        self.reply("+OK fake POP3 server ready")
+        for line in self.rfile:
+            command, _, argument = line.decode().strip().partition(" ")
+            if command == "PASS" and argument != "secret":
+                self.reply("-ERR bad password")
+            elif command == "STAT":
+                self.server.released.wait(self.server.delay)
+                self.reply("+OK {} 4096".format(self.server.messages))
+            else:
+                self.reply("+OK")
+            if command == "QUIT":
+                return
+
+    def handle_imap(self):
+        self.reply("* OK fake IMAP server ready")
+        for line in self.rfile:
+            tag, command, argument = (line.decode().strip().split(" ", 2) + ["", ""])[:3]
+            if command == "LOGIN" and not argument.endswith('"secret"'):
+                self.reply(tag + " NO bad password")
+            elif command == "EXAMINE":
+                self.server.released.wait(self.server.delay)
+                self.reply("* {} EXISTS".format(self.server.messages))
+                self.reply("* 0 RECENT")
+                self.reply(tag + " OK [READ-ONLY] EXAMINE completed")
+            else:
+                self.reply(tag + " OK completed")
+            if command == "LOGOUT":
+                return
+
+@contextmanager
+def fake_mail_server(protocol, messages=3, delay=0):
+    server = FakeMailServer(protocol, messages, delay)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield server
+    finally:
+        server.released.set()
+        server.shutdown()
+        server.server_close()
+
+def supervised_fetcher(fetcherid, server, **fields):
+    """ @return a FetcherRead for a fetcher of the fake mail server. """
+    fields = {"server": "127.0.0.1", "port": server.server_address[1], "protocol": server.protocol,
+              "password": "secret", **fields}
+    return schemas.FetcherRead.parse_obj(dict(fetcher_json("fetcher{:02}".format(fetcherid), **fields),
+                                              id=fetcherid))
+
+def get_list_loaders(fetchers, loaded_ids=None):
+    """
+    @return Supervisor arguments which load the fetchers to run from a list
+        of FetcherReads, which may change between ticks.
+    @param loaded_ids: a list to add the IDs of the fetchers loaded to.
+    """
+    async def load_runnable_ids(at):
+        return [fetcher.fetcherid for fetcher in fetchers]
+
+    async def load_fetchers(fetcherids):
+        if loaded_ids is not None:
+            loaded_ids.extend(fetcherids)
+        return [fetcher for fetcher in fetchers if fetcher.fetcherid in fetcherids]
+
+    async def refresh_downtime(downtime_index):
+        pass
+    return {"load_runnable_ids": load_runnable_ids, "load_fetchers": load_fetchers,
+            "refresh_downtime": refresh_downtime}
+
+def run_supervised(fetchers, **supervisor_args):
+    """ Runs each of the fetchers once with a new Supervisor.  @return the Supervisor. """
+    async def run():
+        supervisor = Supervisor(**get_list_loaders(fetchers), **supervisor_args)
+        await supervisor.run_due_fetchers()
+        await supervisor.join()
+        return supervisor
+    return asyncio.run(run())
+
+class FakeDowntimeIndex:
+    def __init__(self, fetcherids):
+        self.fetcherids = fetcherids
+
+    def is_in_downtime(self, fetcherid, at):
+        return fetcherid in self.fetcherids
+
+def test_supervisor_checks_mailboxes():
+    """
+     * A run logs in to its fetcher's POP3 or IMAP mailbox and counts the
+       messages in it.
+     * A run which the server refuses fails, and says why.
+    """
+    with fake_mail_server("POP3", messages=3) as pop3_server, \
+            fake_mail_server("IMAP4", messages=5) as imap_server:
+        supervisor = run_supervised([
+            supervised_fetcher(1, pop3_server),
+            supervised_fetcher(2, imap_server),
+            supervised_fetcher(3, pop3_server, password="wrong"),
+            supervised_fetcher(4, imap_server, password="wrong"),
+        ])
+
+    assert [supervisor.get_status(fetcherid).state for fetcherid in [1, 2, 3, 4]] == \
+        ["succeeded", "succeeded", "failed", "failed"]
+    assert supervisor.get_status(1).messages == 3
+    assert supervisor.get_status(2).messages == 5
+    assert "bad password" in supervisor.get_status(3).error
+    assert "bad password" in supervisor.get_status(4).error
+    assert not supervisor.is_running(1)
+
+def test_supervisor_limits():
+    """
+     * No more than max_concurrency runs talk to a mail server at once.
+     * A run which goes past its fetcher's time limit is cut short.
+     * A run whose fetcher is in downtime when its turn comes is skipped.
+    """
+    with fake_mail_server("POP3", delay=0.2) as server:
+        fetchers = [supervised_fetcher(fetcherid, server) for fetcherid in range(1, 9)]
+        fetchers.append(supervised_fetcher(9, server, time_limit=1))
+        fetchers.append(supervised_fetcher(10, server))
+        supervisor = run_supervised(fetchers, max_concurrency=3, seconds_per_timelimit=0.1,
+                                    downtime_index=FakeDowntimeIndex({10}))
+        assert server.max_connections == 3
+
+    assert [supervisor.get_status(fetcherid).state for fetcherid in range(1, 9)] == ["succeeded"] * 8
+    assert supervisor.get_status(9).state == "timed out"
+    assert supervisor.get_status(10).state == "skipped"
+
+def test_supervisor_stops_fetchers_which_may_no_longer_run():
+    """
+     * Each tick, the supervisor stops the runs of fetchers which are no
+       longer active or have gone into downtime, and doesn't start fetchers
+       which are already running or have run recently.
+     * A tick only loads the fetchers which are due to start.
+    """
+    with fake_mail_server("POP3", delay=30) as server:
+        fetchers = [supervised_fetcher(1, server), supervised_fetcher(2, server)]
+        loaded_ids = []
+
+        async def run():
+            supervisor = Supervisor(**get_list_loaders(fetchers, loaded_ids))
+            assert await supervisor.run_due_fetchers() == [1, 2]
+            assert loaded_ids == [1, 2]
+            await asyncio.sleep(0.1)
+            assert supervisor.get_status(1).state == "running"
+            assert supervisor.get_status(2).state == "running"
+
+            fetchers.pop()
+            assert await supervisor.run_due_fetchers() == []
+            assert supervisor.is_running(1)
+            assert not supervisor.is_running(2)
+            assert supervisor.get_status(2).state == "stopped"
+
+            fetchers.append(supervised_fetcher(2, server))
+            assert await supervisor.run_due_fetchers() == []
+            assert loaded_ids == [1, 2]
+
+            await supervisor.stop()
+            assert supervisor.get_status(1).state == "stopped"
+        asyncio.run(run())
+
+def test_supervisor_routes(file_db, monkeypatch):
+    """
+     * The supervisor starts with the app, when database.USE_SUPERVISOR is
+       set, and runs its active fetchers.
+     * POST /fetcher/{id}:restart/ and POST /fetcher:restart/ restart fetchers
+       which are running, and do nothing for ones which aren't.
+     * POST /fetcher/{id}:start/ and POST /fetcher/{id}:stop/ start and stop
+       a fetcher's run.  A run started while its fetcher is in downtime is
+       skipped, even right after the schedule which puts it there is
+       written.
+    """
+    with fake_mail_server("POP3", delay=30) as server:
+        post_fetcher("fetcher01", server="127.0.0.1", port=server.server_address[1],
+                     protocol="POP3", password="secret")
+        post_fetcher("fetcher02", active=False)
+        with TestClient(app):
+            assert not fetcher_supervisor.is_started()
+
+        monkeypatch.setattr(database, "USE_SUPERVISOR", True)
+        with TestClient(app) as supervised_client:
+            response = supervised_client.post("/fetcher/1:start/")
+            assert response.status_code == 200
+            assert fetcher_supervisor.is_running(1)
+
+            response = supervised_client.post("/fetcher/1:restart/")
+            assert response.json() == "Successfully restarted fetcher 'fetcher01'."
+            response = supervised_client.post("/fetcher:restart/", json={"ids": [1, 2, 5]})
+            assert response.status_code == 200
+            assert fetcher_supervisor.is_running(1)
+
+            response = supervised_client.post("/fetcher/2:start/")
+            assert response.json() == "Fetcher 'fetcher02' is not active, so it was not started."
+
+            response = supervised_client.post("/fetcher/1:stop/")
+            assert response.json() == "Successfully stopped fetcher 'fetcher01'."
+            assert fetcher_supervisor.get_status(1).state == "stopped"
+            response = supervised_client.post("/fetcher/1:restart/")
+            assert response.json() == "Fetcher 'fetcher01' is not running, so it was not restarted."
+
+            response = supervised_client.post("/fetcher/1:start/")
+            assert response.json() == "Successfully started fetcher 'fetcher01'."
+            response = supervised_client.post("/fetcher/5:start/")
+            assert response.status_code == 404
+
+            supervised_client.post("/fetcher/1:stop/")
+            response = supervised_client.post("/fetcherschedule/", json={"fetcher_id": 1,
+                "downtime_days": "0,1,2,3,4,5,6", "downtime_start": "00:00", "downtime_end": "00:00"})
+            assert response.status_code == 201
+            response = supervised_client.post("/fetcher/1:start/")
+            assert response.json() == "Successfully started fetcher 'fetcher01'."
+            deadline = time.monotonic() + 5
+            while fetcher_supervisor.is_running(1) and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert fetcher_supervisor.get_status(1).state == "skipped"
+
+        assert not fetcher_supervisor.is_started()
+        assert not fetcher_supervisor.is_running(1)
+
+    # Without the app running, there is no supervisor to start a run.
+    response = client.post("/fetcher/1:start/")
+    assert response.status_code == 503
+
+def test_benchmark(tmp_path):
+    """
+     * The benchmark seeds its own DB and sends every route's requests to it
+       without errors.
+     * Every route is either benchmarked or skipped with a reason.
+    """
+    results = benchmark.run_benchmark(fetchers=50, concurrency=[1, 2], requests=4,
+                                      db_path=str(tmp_path / "benchmark.db"))
+    assert results["unbenchmarked_routes"] == []
+    assert {result["concurrency"] for result in results["results"]} == {1, 2}
+    for result in results["results"]:
+        assert result["errors"] == 0, result
+        assert result["requests"] > 0
+        assert result["p50_ms"] <= result["p95_ms"] <= result["p99_ms"]
+
+    # The app is pointed back at its own DB.
+    assert main.get_db not in app.dependency_overrides
+
+def test_capture_and_replay(test_db, tmp_path, monkeypatch):
+    """
+     * With capture.CAPTURE_PATH set, each request is appended to it, with
+       its status and duration, and with passwords and credential headers
+       left out.
+     * replay.py sends the captured requests again, with their headers, and
+       reports each route's latency and status codes next to the captured
+       ones, counting 304s which come back as 200s apart.
+    """
+    capture_path = tmp_path / "capture.jsonl"
+    monkeypatch.setattr(capture, "CAPTURE_PATH", str(capture_path))
+    try:
+        response = client.post("/fetcher/", json=fetcher_json("fetcher01"))
+        assert response.status_code == 201
+        fetcherid = response.json()["id"]
+        response = client.get("/fetcher/", params={"limit": 10})
+        assert response.status_code == 200
+        etag = response.headers["ETag"]
+        assert client.get("/fetcher/", params={"limit": 10},
+                          headers={"If-None-Match": etag, "Authorization": "Bearer secret"}).status_code == 304
+        assert client.get("/fetcher/999999/").status_code == 404
+    finally:
+        capture.close_capture()
+    monkeypatch.setattr(capture, "CAPTURE_PATH", None)
+
+    entries = replay.read_capture(capture_path)
+    assert [(entry["method"], entry["path"], entry["query"], entry["status"]) for entry in entries] == [
+        ("POST", "/fetcher/", "", 201),
+        ("GET", "/fetcher/", "limit=10", 200),
+        ("GET", "/fetcher/", "limit=10", 304),
+        ("GET", "/fetcher/999999/", "", 404),
+    ]
+    assert json.loads(entries[0]["body"])["password"] == capture.REDACTED_PASSWORD
+    assert "123abc" not in capture_path.read_text()
+    assert entries[2]["headers"]["if-none-match"] == etag
+    assert "Bearer secret" not in capture_path.read_text()
+    assert all("host" not in entry["headers"] and "content-type" not in entry["headers"] for entry in entries)
+    assert all(entry["duration_ms"] > 0 for entry in entries)
+
+    # Uncaptured, so that the replayed create doesn't clash with it.
+    assert client.delete("/fetcher/{}/".format(fetcherid)).status_code == 200
+    report = asyncio.run(replay.replay(entries, speed=0, concurrency=1))
+    assert report["requests"] == 4
+    assert set(report["routes"]) == {"POST /fetcher/", "GET /fetcher/", "GET /fetcher/{fetcherid}/"}
+    assert report["routes"]["GET /fetcher/{fetcherid}/"]["statuses"] == {"404": 1}
+    # The replayed create changed the list, so its old ETag is stale.
+    assert report["routes"]["GET /fetcher/"]["statuses"] == {"200": 2}
+    assert report["routes"]["GET /fetcher/"]["etag_misses"] == 1
+    for summary in report["routes"].values():
+        assert summary["errors"] == summary["status_mismatches"] == 0
+
+    # With a current ETag, the replayed request is answered 304.
+    etag = client.get("/fetcher/", params={"limit": 10}).headers["ETag"]
+    report = asyncio.run(replay.replay([dict(entries[2], headers={"if-none-match": etag})], speed=0))
+    assert report["routes"]["GET /fetcher/"]["statuses"] == {"304": 1}
+    assert report["routes"]["GET /fetcher/"]["status_mismatches"] == 0
+
+@pytest.mark.parametrize("fast_json", [False, True])
+def test_fetcher_cache(test_db, monkeypatch, fast_json):
+    """
+     * GET /fetcher/{id}/ and GET /fetcherschedule/{id}/ read a row from the
+       DB once, and then from the cache, counting hits and misses.  Every
+       shape a fetcher is read in (with or without schedules, as a schema or,
+       with main.USE_FAST_JSON, a dict, and any ?fields=) shares one entry.
+     * Every write drops the cached rows it wrote: PATCH, the bulk
+       :deactivate and :delete, and schedule writes, which drop every
+       fetcher.
+     * The start, stop, restart and delete routes read the DB, not the
+       cache, so they don't act on a row deleted by a process this one
+       hasn't heard from.
+    """
+    monkeypatch.setattr(main, "USE_FAST_JSON", fast_json)
+    post_fetcher("fetcher01")
+    post_schedule(1)
+    labels = {"cache": "fetchers"}
+    hits_before = metrics.cache_hits_total.get(labels)
+    misses_before = metrics.cache_misses_total.get(labels)
+
+    assert client.get("/fetcher/1/").status_code == 200
+    with count_queries() as statements:
+        assert len(client.get("/fetcher/1/").json()["schedules"]) == 1
+        assert client.get("/fetcher/1/", params={"expand": "none"}).json()["schedules"] is None
+        assert client.get("/fetcher/1/", params={"fields": "name"}).json() == {"name": "fetcher01"}
+    assert statements == []
+    assert metrics.cache_hits_total.get(labels) == hits_before + 3
+    assert metrics.cache_misses_total.get(labels) == misses_before + 1
+    with count_queries() as statements:
+        assert client.post("/fetcher/1:restart/").status_code == 200
+    assert len(statements) == 1
+
+    assert client.patch("/fetcher/1/", json={"description": "patched"}).status_code == 200
+    assert client.get("/fetcher/1/").json()["description"] == "patched"
+    assert client.get("/fetcher/1/", params={"expand": "none"}).json()["description"] == "patched"
+
+    post_schedule(1)
+    with count_queries() as statements:
+        assert client.get("/fetcher/1/", params={"expand": "none"}).status_code == 200
+        assert len(client.get("/fetcher/1/").json()["schedules"]) == 2
+    # The fetcher and its schedules, once.
+    assert len(statements) == 2
+
+    labels = {"cache": "schedules"}
+    hits_before = metrics.cache_hits_total.get(labels)
+    assert client.get("/fetcherschedule/1/").json()["downtime_days"] == "0,6"
+    assert client.get("/fetcherschedule/1/").json()["downtime_start"] == "08:15:00"
+    assert metrics.cache_hits_total.get(labels) == hits_before + 1
+    response = client.put("/fetcherschedule/1/", json={"fetcher_id": 1, "downtime_days": "1",
+        "downtime_start": "08:15", "downtime_end": "17:30"})
+    assert response.status_code == 200
+    assert client.get("/fetcherschedule/1/").json()["downtime_days"] == "1"
+    assert client.delete("/fetcherschedule/1/").status_code == 200
+    assert client.get("/fetcherschedule/1/").status_code == 404
+
+    response = client.post("/fetcher:deactivate/", json={"filter": {"name_prefix": "fetcher"}})
+    assert response.json() == {"ids": [1]}
+    assert client.get("/fetcher/1/").json()["active"] == False
+    assert client.post("/fetcher:delete/", json={"ids": [1]}).status_code == 200
+    assert client.get("/fetcher/1/").status_code == 404
+    assert client.post("/fetcher/1:restart/").status_code == 404
+
+    fetcherid = post_fetcher("fetcher02")["id"]
+    scheduleid = post_schedule(fetcherid)["id"]
+    assert client.get("/fetcher/{}/".format(fetcherid)).status_code == 200
+    assert client.get("/fetcherschedule/{}/".format(scheduleid)).status_code == 200
+    # As another process would, unheard of without bus.py.
+    test_db.exec_driver_sql("DELETE FROM fetchers WHERE fetcherid = ?", (fetcherid,))
+    assert client.get("/fetcher/{}/".format(fetcherid)).status_code == 200
+    for action in ["start", "stop", "restart"]:
+        assert client.post("/fetcher/{}:{}/".format(fetcherid, action)).status_code == 404
+    assert client.delete("/fetcher/{}/".format(fetcherid)).status_code == 404
+    assert client.delete("/fetcherschedule/{}/".format(scheduleid)).status_code == 404
+
+def test_invalidation_bus(file_db):
+    """
+     * With SQLite, the bus hears the rows other processes write and delete
+       from the row versions and tombstones, and passes them on to the
+       listeners which asked for remote writes, such as the fetcher cache.
+     * With Postgres, it passes on the notifications of other processes'
+       writes, and not those of its own.
+     * The bus itself is abstract: only its subclasses know how to listen.
+    """
+    with pytest.raises(TypeError):
+        bus.InvalidationBus(file_db.engine)
+    post_fetcher("fetcher01")
+    post_fetcher("fetcher02")
+    assert client.get("/fetcher/1/").json()["description"] == "Fetch from Intradyns journaling mailbox"
+    heard = []
+    changes.add_listener(heard.extend, remote=True)
+    poller = bus.SQLitePoller(file_db.engine)
+    other_worker = create_engine(file_db.engine.url)
+    poller.start()
+    try:
+        assert poller.ready.wait(5)
+        with other_worker.begin() as connection:
+            connection.exec_driver_sql("UPDATE fetchers SET description = 'elsewhere' WHERE fetcherid = 1")
+            connection.exec_driver_sql("DELETE FROM fetchers WHERE fetcherid = 2")
+        deadline = time.monotonic() + 5
+        while len(heard) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        poller.stop()
+        other_worker.dispose()
+        changes.remove_listener(heard.extend)
+    assert set(heard) == {changes.Change("fetchers", "update", frozenset([1])),
+                          changes.Change("fetchers", "delete", frozenset([2]))}
+    assert client.get("/fetcher/1/").json()["description"] == "elsewhere"
+    assert client.get("/fetcher/2/").status_code == 404
+
+    def notify(origin, table, op, ids):
+        return types.SimpleNamespace(payload=json.dumps({"origin": origin, "table": table, "op": op, "ids": ids}))
+    listener = bus.PostgresListener(file_db.engine)
+    assert listener.parse_notifies([
+        notify(database.WORKER_ID, "fetchers", "update", [1]),
+        notify("elsewhere", "fetchers", "update", [1, 2]),
+        notify("elsewhere", "fetcherschedules", "delete", None),
+        notify(None, "fetchers", "insert", list(range(bus.MAX_IDS + 1))),
+    ]) == [
+        changes.Change("fetchers", "update", frozenset([1, 2])),
+        changes.Change("fetcherschedules", "delete", None),
+        changes.Change("fetchers", "insert", None),
+    ]